@@ -1,12 +1,20 @@
 # 匯入 Flask 框架及相關模組
-from flask import Flask, request, jsonify, render_template, session, send_file
+from flask import Flask, Response, request, jsonify, render_template, session, send_file
 from gpt_utils import extract_resolution_suggestion
 from gpt_utils import extract_problem_with_custom_prompt
+from gpt_utils import invalidate_semantic_cache
+from gpt_utils import extract_batch_with_custom_prompt
+import gpt_utils
+from gpt_utils import start_upload_llm_budget
 from gptChat import run_offline_gpt
+from job_queue import JobQueue, JobStore
+from risk_scoring import DEFAULT_WEIGHTS, ScoringContext, rescore_results
+from table_reader import read_table, preview_table, original_upload_path, table_extension, SUPPORTED_TABLE_EXTENSIONS
 from concurrent.futures import ThreadPoolExecutor, as_completed
 from collections import defaultdict
 from collections import Counter
 import hashlib
+import uuid
 import subprocess
 import sys
 from pathlib import Path
@@ -26,12 +34,12 @@ import glob
 # 匯入 webbrowser 用於開啟網頁
 import webbrowser
 import socket
-# 匯入 traceback 用於錯誤追蹤
-import traceback
 # 匯入 Werkzeug 的工具函數確保檔案名稱安全
 from werkzeug.utils import secure_filename
 # ✅ 匯入語意分析模組
 from SmartScoring1 import is_high_risk, is_escalated, is_multi_user, extract_keywords, recommend_solution, is_actionable_resolution, load_embeddings, load_examples_from_json
+from SmartScoring1 import batch_semantic_flags  # 整批語意比對
+from SmartScoring1 import sync_sentence_embeddings  # 語句庫異動時只重算變更的句子
 # ✅ 預先 encode 一筆資料以加速首次請求
 from SmartScoring1 import bert_model  # 確保你有從 SmartScoring 載入模型
 from SmartScoring1 import extract_cluster_name  # 匯入自定的 cluster 命名函式
@@ -39,7 +47,6 @@ from tqdm import tqdm
 from sentence_transformers import util
 # ✅ 匯入關鍵字抽取模組
 from datetime import datetime
-from sklearn.cluster import KMeans
 import numpy as np
 from datetime import datetime
 import time
@@ -48,22 +55,21 @@ import asyncio
 import math
 import requests
 import threading
+import queue
 import json
 import tempfile
 from jsonschema import validate, ValidationError
+from log_config import get_logger, SAMPLED
 
+logger = get_logger(__name__)
 
 
 
-KMEANS_MIN_COUNT = 4         # 最少資料筆數
-KMEANS_MIN_RANGE = 5.0       # 分數最大最小值差
-KMEANS_MIN_STDDEV = 3.0      # 標準差下限
-
 
 start = time.time()
-print("🔥 預熱語意模型中...")
+logger.info("🔥 預熱語意模型中...")
 bert_model.encode("warmup")  # 預熱一次，避免第一次使用太慢
-print(f"✅ 模型預熱完成，用時：{time.time() - start:.2f} 秒")
+logger.info("✅ 模型預熱完成，用時：%.2f 秒", time.time() - start)
 
 # 建立 Flask 應用
 app = Flask(__name__)
@@ -73,11 +79,15 @@ app.secret_key = 'gwegweqgt22e'
 app.config['SESSION_TYPE'] = 'filesystem'
 
 # ------------------------------------------------------------------------------
-# 設定上傳資料夾與大小限制（10MB）
+# 設定上傳資料夾與大小限制（預設 10MB）
 UPLOAD_FOLDER = 'uploads'
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
-app.config['MAX_CONTENT_LENGTH'] = 10 * 1024 * 1024  # 限制檔案大小為 10MB
-ALLOWED_EXTENSIONS = {'xlsx'}  # 僅允許上傳 xlsx 檔案
+# 分析仍是整份資料一次處理，預設維持 10MB；確定主機記憶體足夠時再以 MAX_UPLOAD_MB 調高
+MAX_UPLOAD_MB = int(os.environ.get("MAX_UPLOAD_MB", "10"))
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_MB * 1024 * 1024
+ALLOWED_EXTENSIONS = SUPPORTED_TABLE_EXTENSIONS  # 允許 xlsx / csv / parquet
+ANALYSIS_JOB_WORKERS = int(os.environ.get("ANALYSIS_JOB_WORKERS", "2"))  # 背景分析工作（/upload mode=job）同時執行的數量；0 表示交給 analysis_worker.py 的行程池
+SSE_KEEPALIVE_SECONDS = 15  # 串流分析時，超過此秒數沒有事件就送一次 keep-alive
 
 
 basedir = os.path.abspath(os.path.dirname(__file__))  # 取得當前 app.py 的絕對目錄
@@ -106,6 +116,50 @@ def safe_value(val):
     else:
         return val
 
+
+# 取出整欄字串（與逐列 str(row.get(col, 'not filled')).strip() 結果一致）
+def column_texts(df, column, default='not filled'):
+    if column not in df.columns:
+        return [default] * len(df)
+    return [str(v).strip() for v in df[column]]
+
+
+# 依欄位順位整欄合併文字（取代逐列 combine_fields_with_priority）：
+# 依序取非空欄位以換行串接，總長超過 limit 時從最後一個欄位開始捨棄，但至少保留第一個非空欄位
+def combine_fields_vectorized(df, field_order, limit):
+    fields = [f for f in field_order if f in df.columns]
+    if not fields:
+        return pd.Series('', index=df.index)
+
+    texts, present = [], []
+    for f in fields:
+        mask = df[f].notna()
+        texts.append(df[f].where(mask).map(str, na_action='ignore').str.strip().fillna(''))
+        present.append(mask.to_numpy())
+    lengths = [t.str.len().to_numpy() for t in texts]
+
+    # 保留到第 j 欄（含）時的合併長度 = 已保留字數 + 換行數
+    cum_len = np.zeros(len(df), dtype=np.int64)
+    cum_cnt = np.zeros(len(df), dtype=np.int64)
+    keep_upto = np.full(len(df), -1)          # 最後一個保留的欄位位置
+    first_present = np.full(len(df), -1)
+    for j, (mask, length) in enumerate(zip(present, lengths)):
+        cum_len += np.where(mask, length, 0)
+        cum_cnt += mask
+        fits = mask & (cum_len + cum_cnt - 1 <= limit)
+        keep_upto = np.where(fits, j, keep_upto)
+        first_present = np.where(mask & (first_present < 0), j, first_present)
+    keep_upto = np.where(keep_upto < 0, first_present, keep_upto)
+
+    combined = pd.Series('', index=df.index)
+    started = np.zeros(len(df), dtype=bool)
+    for j, (mask, text) in enumerate(zip(present, texts)):
+        use = mask & (j <= keep_upto)
+        piece = np.where(started, '\n', '') + text
+        combined = combined.where(~use, combined + piece)
+        started |= use
+    return combined.str.strip()
+
 # ------------------------------------------------------------------------------
 
 
@@ -163,45 +217,6 @@ def download_clustered_file():
 
 
 
-# 根據分數判斷風險等級（支援 KMeans 分群）
-kmeans_thresholds = None  # 全域變數，存儲 KMeans 分群門檻
-
-
-def get_risk_level(score):
-    global kmeans_thresholds
-    level = ''
-
-    if kmeans_thresholds and len(kmeans_thresholds) == 4:
-        thresholds = sorted(kmeans_thresholds)
-        if score >= thresholds[3]:
-            level = '高風險'
-        elif score >= thresholds[2]:
-            level = '中風險'
-        elif score >= thresholds[1]:
-            level = '低風險'
-        else:
-            level = '忽略'
-        print(f"📊 KMeans：impactScore: {score} → 分級：{level}（使用動態門檻）")
-    else:
-        if score >= 18:
-            level = '高風險'
-        elif score >= 12:
-            level = '中風險'
-        elif score >= 6:
-            level = '低風險'
-        else:
-            level = '忽略'
-        print(f"📊 固定門檻：impactScore: {score} → 分級：{level}")
-
-    return level
-
-# 在分析完成後自動設定 kmeans_thresholds
-# （請放在 KMeans 分群完成後）
-def set_kmeans_thresholds_from_centroids(centroids):
-    global kmeans_thresholds
-    kmeans_thresholds = sorted(centroids)
-    print(f"✅ 已設定 KMeans 分群門檻（sorted）：{kmeans_thresholds}")
-
 # ------------------------------------------------------------------------------
 
 
@@ -274,7 +289,52 @@ def cluster_excel_export(results, export_dir="excel_result_Clustered"):
     print("✅ 分群 Excel 檔案已儲存！")
 
 
+def refresh_cluster_exports(results, export_dir="excel_result_Clustered"):
+    """已分群的結果重算分數後：先從各 Cluster 檔移除這次分析的舊列（同 analysisTime 且同 id），再以新結果重新匯出。"""
+    keys = {(str(r.get('analysisTime')), str(r.get('id'))) for r in results}
+    for path in glob.glob(os.path.join(export_dir, 'Cluster-*.xlsx')):
+        old_df = pd.read_excel(path)
+        if 'analysisTime' not in old_df.columns or 'id' not in old_df.columns:
+            continue
+        stale = pd.Series(
+            [(str(t), str(i)) in keys for t, i in zip(old_df['analysisTime'], old_df['id'])],
+            index=old_df.index
+        )
+        if not stale.any():
+            continue
+        if stale.all():
+            os.remove(path)
+        else:
+            old_df[~stale].to_excel(path, index=False)
+        print(f"🧹 已從 {path} 移除舊分數 {int(stale.sum())} 筆")
+    cluster_excel_export(results, export_dir)
+
+# ------------------------------------------------------------------------------
 
+TIME_CLUSTER_WINDOW = pd.Timedelta(hours=24)  # 同元件 ±24 小時內視為同一群
+
+
+def compute_time_cluster_scores(df, window=TIME_CLUSTER_WINDOW):
+    """
+    一次算出所有列的 time_cluster_score（與原本逐列掃描 df 的結果相同）：
+    依 Role/Component 分組、排序 Opened，再以 searchsorted 計算 ±window 內的事件數（含自己）。
+    Opened 為空或 Role/Component 為空的列維持 1 分。
+    """
+    scores = np.ones(len(df), dtype=int)
+    opened = df['Opened']
+    for _, positions in df.groupby('Role/Component', sort=False).indices.items():
+        times = opened.iloc[positions]
+        valid = times.notna().to_numpy()
+        if not valid.any():
+            continue
+        valid_positions = positions[valid]
+        values = times[valid].to_numpy(dtype='datetime64[ns]')
+        sorted_values = np.sort(values)
+        lower = np.searchsorted(sorted_values, values - window.to_timedelta64(), side='left')
+        upper = np.searchsorted(sorted_values, values + window.to_timedelta64(), side='right')
+        counts = upper - lower
+        scores[valid_positions] = np.where(counts >= 3, 3, np.where(counts == 2, 2, 1))
+    return scores
 
 
 
@@ -285,113 +345,120 @@ def analyze_excel(filepath, weights=None, resolution_priority=None, summary_prio
 
 
 # 用於同步 Flask 路由呼叫 async 分析邏輯
-async def analyze_excel_async(filepath, weights=None, resolution_priority=None, summary_priority=None):
+async def analyze_excel_async(filepath, weights=None, resolution_priority=None, summary_priority=None, on_event=None):
+    """
+    on_event：選用的回呼，每完成一列就收到 {'type': 'row'} 與 {'type': 'progress'} 事件（供 /upload-stream 使用）。
+    開啟批次擷取時，每完成一批模型呼叫另收到 {'type': 'batch'}；回呼丟出例外即中止分析（背景工作的取消）。
+    回傳結果的順序與 Excel 列順序一致，不受完成先後影響。
+    """
     start_time = time.time()
-    default_weights = {
-        'keyword': 5.0,
-        'multi_user': 3.0,
-        'escalation': 2.0,
-        'config_item': 5.0,
-        'role_component': 3.0,
-        'time_cluster': 2.0
-    }
-    weights = {**default_weights, **(weights or {})}
-    print(f"🟩 本次分析開始，將即時讀取三類語句 json 檔案...")
+    start_upload_llm_budget()  # 本次上傳所有列的 LLM 重試共用一個時間預算
+    scoring = ScoringContext(weights)  # 本次分析專屬的權重與分級門檻
+    weights = scoring.weights
+    logger.info("🟩 本次分析開始，將即時讀取三類語句 json 檔案...")
     # ⭐ 讀取語句和 embedding
     high_risk_examples, high_risk_embeddings = load_embeddings("high_risk")
     escalation_examples, escalation_embeddings = load_embeddings("escalate")
     multi_user_examples, multi_user_embeddings = load_embeddings("multi_user")
 
-    df = pd.read_excel(filepath)
+    df = read_table(filepath)  # 串流讀取（openpyxl read-only / CSV chunk / Parquet batch）
 
 
     # ✅ 欄位順位 fallback 預設
     resolution_priority = resolution_priority or ['Description', 'Short description', 'Close notes']
     summary_priority = summary_priority or ['Short description', 'Description']
 
-    def combine_fields_with_priority(row, field_order, limit):
-        parts = []
-        for f in field_order:
-            if f in row and pd.notna(row[f]):
-                parts.append(str(row[f]).strip())
+    # ✅ 產生 resolution_input / summary_input 給 GPT 用（整欄運算）
+    df['resolution_input'] = combine_fields_vectorized(df, resolution_priority, 10000)
+    df['summary_input'] = combine_fields_vectorized(df, summary_priority, 8000)
 
-        combined = "\n".join(parts)
-        while len(combined) > limit and len(parts) > 1:
-            removed = parts.pop()
-            print(f"🔁 移除欄位：{removed[:20]}...")
-            combined = "\n".join(parts)
 
-        # 額外：印出實際使用的欄位名稱
-        used_fields = field_order[:len(parts)]
-        print(f"✅ 實際使用欄位：{used_fields}，合併長度：{len(combined)}")
-        return combined.strip()
-
-    # ✅ 產生 resolution_input / summary_input 給 GPT 用
-    df['resolution_input'] = df.apply(lambda row: combine_fields_with_priority(row, resolution_priority, 10000), axis=1)
-    df['summary_input'] = df.apply(lambda row: combine_fields_with_priority(row, summary_priority, 8000), axis=1)
-
-
-    component_counts = df['Role/Component'].value_counts()
-    configuration_item_counts = df['Configuration item'].value_counts()
-    configuration_item_max = configuration_item_counts.max()
     df['Opened'] = pd.to_datetime(df['Opened'], errors='coerce')
     analysis_time = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
 
-    # 非同步處理
-    tasks = [
-        analyze_row_async(
-            row, idx, df, weights, component_counts, configuration_item_counts, configuration_item_max, analysis_time,
-            high_risk_examples, high_risk_embeddings,
-            escalation_examples, escalation_embeddings,
-            multi_user_examples, multi_user_embeddings,
-            row['resolution_input'], row['summary_input']  # ✅ 新增這兩欄
+    # ✅ 語意比對改為整批：每個欄位只 encode 一次，再以矩陣運算取得所有列的旗標
+    t_semantic = time.time()
+    keyword_flags = batch_semantic_flags(column_texts(df, 'Short description'), high_risk_examples, high_risk_embeddings, tag="高風險")
+    user_impact_flags = batch_semantic_flags(column_texts(df, 'Description'), multi_user_examples, multi_user_embeddings, tag="多人")
+    escalation_flags = batch_semantic_flags(column_texts(df, 'Close notes'), escalation_examples, escalation_embeddings, tag="升級")
+    logger.info("⏱️ 語意比對完成（%d 筆），用時：%.2f 秒", len(df), time.time() - t_semantic)
+
+    # ✅ 24h 時間群聚分數一次算完（排序 + searchsorted，取代逐列掃描整張表）
+    time_cluster_scores = compute_time_cluster_scores(df)
+
+    # ✅ 所有分數整欄計算；暫定分級用固定門檻，全部完成後再視分布改用 KMeans 門檻
+    features = scoring.build_features(df, keyword_flags, user_impact_flags, escalation_flags, time_cluster_scores)
+    score_table = scoring.score()
+    score_table['riskLevel'] = scoring.risk_levels(score_table['impact'])
+    score_rows = score_table.to_dict(orient='records')
+    feature_rows = features.to_dict(orient='records')  # 存進結果，供 /rescore 以新權重重算
+
+    # ✅ 選用：跨列批次擷取 solution / summary（多筆包成一次模型呼叫）
+    batched_suggestions = batched_summaries = None
+    batch_extraction = gpt_utils.batch_extraction_enabled()  # 每次分析開始時讀取環境變數，同一次分析內前後一致
+    if batch_extraction:
+        row_ids = [f"Row#{idx+1}" for idx in df.index]
+        batched_suggestions, batched_summaries = await asyncio.gather(
+            extract_batch_with_custom_prompt(df['resolution_input'].tolist(), "solution", source_ids=row_ids, on_event=on_event),
+            extract_batch_with_custom_prompt(df['summary_input'].tolist(), "ai_summary", source_ids=row_ids, on_event=on_event)
         )
-        for idx, row in df.iterrows()
-    ]
-    results_raw = await asyncio.gather(*tasks, return_exceptions=True)
-    results = [r for r in results_raw if r and not isinstance(r, Exception)]
+
+    # 非同步處理：每列完成就先收下（串流模式會立刻送出），最後再依原始列順序排好
+    async def analyze_at(pos, idx, row):
+        try:
+            result = await analyze_row_async(
+                row, idx, weights, analysis_time, score_rows[pos],
+                row['resolution_input'], row['summary_input'],  # ✅ 新增這兩欄
+                precomputed_ai=(batched_suggestions[pos], batched_summaries[pos]) if batch_extraction else None
+            )
+        except Exception as e:
+            logger.error("❌ 第 %d 列分析失敗：%s", idx + 1, e)
+            result = None
+        if result:
+            result['scoreFeatures'] = feature_rows[pos]
+        return pos, result
+
+    tasks = [analyze_at(pos, idx, row) for pos, (idx, row) in enumerate(df.iterrows())]
+    total_rows = len(tasks)
+    results_by_pos = {}
+    rows_start = time.time()
+    for finished, next_done in enumerate(asyncio.as_completed(tasks), 1):
+        pos, result = await next_done
+        if result:
+            results_by_pos[pos] = result
+        if on_event:
+            if result:
+                on_event({'type': 'row', 'index': pos, 'data': result})
+            elapsed = time.time() - rows_start
+            on_event({
+                'type': 'progress',
+                'done': finished,
+                'total': total_rows,
+                'elapsed': round(elapsed, 2),
+                'eta': round(elapsed / finished * (total_rows - finished), 2)
+            })
+    results = [results_by_pos[pos] for pos in sorted(results_by_pos)]
 
     # ✅ 防呆：沒有任何成功的結果就直接回傳避免崩潰
     if not results:
-        print("⚠️ 所有資料都無法分析，請檢查欄位是否缺失")
+        logger.warning("⚠️ 所有資料都無法分析，請檢查欄位是否缺失")
         return {
             'data': [],
             'analysisTime': analysis_time
         }
 
-    all_scores = [r['impactScore'] for r in results]
-    score_range = max(all_scores) - min(all_scores)
-    score_std = np.std(all_scores)
-
-    print(f"📈 分群判斷指標：count={len(all_scores)}, range={score_range:.2f}, stddev={score_std:.2f}")
-
-    if (
-        len(all_scores) >= KMEANS_MIN_COUNT and
-        score_range >= KMEANS_MIN_RANGE and
-        score_std >= KMEANS_MIN_STDDEV
-    ):
-        kmeans = KMeans(n_clusters=4, random_state=42)
-        labels = kmeans.fit_predict(np.array(all_scores).reshape(-1, 1))
-        centroids = kmeans.cluster_centers_.flatten()
-        set_kmeans_thresholds_from_centroids(centroids)
-        print(f"📊 KMeans 分群標籤：{labels}")
-        label_map = {}
-        for i, idx in enumerate(np.argsort(centroids)[::-1]):
-            label_map[idx] = ['高風險', '中風險', '低風險', '忽略'][i]
-        for i, r in enumerate(results):
-            r['riskLevel'] = label_map[labels[i]]
-        print(f"📌 KMeans 分群中心：{sorted(centroids, reverse=True)}")
-    else:
-        print("⚠️ 不啟用 KMeans，改用固定門檻分級")
-        for r in results:
-            r['riskLevel'] = get_risk_level(r['impactScore'])
+    # ✅ 整批分級：分數夠分散時以 KMeans 群中心的中點為門檻，否則維持固定門檻
+    impact_scores = [r['impactScore'] for r in results]
+    scoring.fit_risk_bins(impact_scores)
+    for r, level in zip(results, scoring.risk_levels(impact_scores)):
+        r['riskLevel'] = level
 
     total_time = time.time() - start_time
     avg_time = total_time / len(results)
 
-    print(f"\n🎯 所有分析總耗時：{total_time:.2f} 秒")
-    print(f"📊 單筆平均耗時：{avg_time:.2f} 秒")
-    print("\n✅ 所有資料分析完成！")
+    logger.info("🎯 所有分析總耗時：%.2f 秒", total_time)
+    logger.info("📊 單筆平均耗時：%.2f 秒", avg_time)
+    logger.info("✅ 所有資料分析完成！")
     return {
         'data': results,
         'analysisTime': analysis_time
@@ -402,14 +469,8 @@ async def analyze_excel_async(filepath, weights=None, resolution_priority=None,
 
 
 
-async def analyze_row_async(row, idx, df, weights, component_counts, configuration_item_counts, configuration_item_max, analysis_time,     
-    high_risk_examples, high_risk_embeddings,
-    escalation_examples, escalation_embeddings,
-    multi_user_examples, multi_user_embeddings,
-    resolution_text, summary_input):
-    print(f"[分析 Row#{idx+1}] 本次用的高風險語句數：{len(high_risk_examples)}，倒數兩句：{high_risk_examples[-2:] if high_risk_examples else '空'}")
-    print(f"[分析 Row#{idx+1}] 本次用的升級語句數：{len(escalation_examples)}，倒數兩句：{escalation_examples[-2:] if escalation_examples else '空'}")
-    print(f"[分析 Row#{idx+1}] 本次用的影響多使用者語句數：{len(multi_user_examples)}，倒數兩句：{multi_user_examples[-2:] if multi_user_examples else '空'}")
+async def analyze_row_async(row, idx, weights, analysis_time, scores, resolution_text, summary_input, precomputed_ai=None):
+    # 分數（severity / frequency / impact / 暫定 riskLevel）已由 analyze_excel_async 整欄算好，這裡只做 LLM 擷取與組裝結果
     try:
         # 原始欄位保留
         description_text = row.get('Description', 'not filled')
@@ -423,14 +484,14 @@ async def analyze_row_async(row, idx, df, weights, component_counts, configurati
 
         # 若全部內容皆為空，直接跳過此筆
         if not (desc or short_desc or close_notes):
-            print(f"⚠️ 第 {idx+1} 筆內容全為空白，略過分析")
+            logger.debug("⚠️ 第 %d 筆內容全為空白，略過分析", idx + 1, extra=SAMPLED)
             return None
 
         # ✅ 改用合併後欄位（已由前段 fallback 處理）
-        print(f"🧠 [Row#{idx+1}] 使用 resolution_text（長度：{len(resolution_text)}）")
-        print(f"📌 Resolution 欄位原始合併內容：\n{resolution_text[:1000]}")
-        print(f"🧠 [Row#{idx+1}] 使用 summary_input（長度：{len(summary_input)}）")
-        print(f"📌 Summary 欄位原始合併內容：\n{summary_input[:1000]}")
+        logger.debug("🧠 [Row#%d] resolution_text 長度 %d，summary_input 長度 %d",
+                     idx + 1, len(resolution_text), len(summary_input), extra=SAMPLED)
+        logger.debug("📌 [Row#%d] Resolution 合併內容：\n%s\n📌 Summary 合併內容：\n%s",
+                     idx + 1, resolution_text[:1000], summary_input[:1000], extra=SAMPLED)
 
 
 
@@ -446,39 +507,10 @@ async def analyze_row_async(row, idx, df, weights, component_counts, configurati
         #     print(f"🟢 [Row#{idx+1}] resolution_text 使用 desc + short_desc + close_notes")
 
 
-        keyword_score = is_high_risk(short_desc, high_risk_examples, high_risk_embeddings)
-        user_impact_score = is_multi_user(desc, multi_user_examples, multi_user_embeddings)
-        escalation_score = is_escalated(close_notes, escalation_examples, escalation_embeddings)
-
-        config_raw = configuration_item_counts.get(row.get('Configuration item'), 0)
-        configuration_item_freq = config_raw / configuration_item_max if configuration_item_max > 0 else 0
-
-        role_comp = row.get('Role/Component', 'not filled')
-        count = component_counts.get(role_comp, 0)
-        role_component_freq = 3 if count >= 5 else 2 if count >= 3 else 1 if count == 2 else 0
-
-        this_time = row.get('Opened', 'not filled')
-        if pd.isnull(this_time):
-            time_cluster_score = 1
-        else:
-            others = df[df['Role/Component'] == role_comp]
-            close_events = others[(others['Opened'] >= this_time - pd.Timedelta(hours=24)) &
-                                  (others['Opened'] <= this_time + pd.Timedelta(hours=24))]
-            count_cluster = len(close_events)
-            time_cluster_score = 3 if count_cluster >= 3 else 2 if count_cluster == 2 else 1
-
-        severity_score = round(
-            keyword_score * weights['keyword'] +
-            user_impact_score * weights['multi_user'] +
-            escalation_score * weights['escalation'], 2
-        )
-        frequency_score = round(
-            configuration_item_freq * weights['config_item'] +
-            role_component_freq * weights['role_component'] +
-            time_cluster_score * weights['time_cluster'], 2
-        )
-        impact_score = round(math.sqrt(severity_score**2 + frequency_score**2), 2)
-        risk_level = get_risk_level(impact_score)
+        severity_score = scores['severity']
+        frequency_score = scores['frequency']
+        impact_score = scores['impact']
+        risk_level = scores['riskLevel']
 
         # ==== 判斷 summary 輸入長度 ====
         # summary_input = f"{short_desc}\n{desc}".strip()
@@ -493,15 +525,18 @@ async def analyze_row_async(row, idx, df, weights, component_counts, configurati
 
 
 
-        # GPT 處理允許失敗
+        # GPT 處理允許失敗（批次模式已先擷取好）
         try:
-            ai_suggestion, ai_summary = await asyncio.gather(
-                extract_resolution_suggestion(resolution_text, source_id=f"Row#{idx+1}"),
-                extract_problem_with_custom_prompt(summary_input, source_id=f"Row#{idx+1}")
-            )
+            if precomputed_ai is not None:
+                ai_suggestion, ai_summary = precomputed_ai
+            else:
+                ai_suggestion, ai_summary = await asyncio.gather(
+                    extract_resolution_suggestion(resolution_text, source_id=f"Row#{idx+1}"),
+                    extract_problem_with_custom_prompt(summary_input, source_id=f"Row#{idx+1}")
+                )
 
         except Exception as e:
-            print(f"⚠️ GPT 擷取失敗：{e}")
+            logger.warning("⚠️ GPT 擷取失敗：%s", e)
             ai_suggestion = "（AI 擷取失敗）"
             ai_summary = "（AI 擷取失敗）"
 
@@ -534,7 +569,7 @@ async def analyze_row_async(row, idx, df, weights, component_counts, configurati
         }
 
     except Exception as e:
-        print(f"❌ 分析第 {idx + 1} 筆失敗：", e)
+        logger.error("❌ 分析第 %d 筆失敗：%s", idx + 1, e)
         return None
 
 
@@ -584,6 +619,7 @@ def save_sentence():
     data.append({"text": new_entry['text']})
     with open(path, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    sync_sentence_embeddings(tag, data)
 
     return get_sentence_db()
 
@@ -605,6 +641,7 @@ def delete_sentence():
     new_data = [d for d in data if d['text'] != text]
     with open(path, 'w', encoding='utf-8') as f:
         json.dump(new_data, f, ensure_ascii=False, indent=2)
+    sync_sentence_embeddings(tag, new_data)
 
     return get_sentence_db()
 
@@ -637,6 +674,7 @@ def edit_sentence():
 
     with open(path, 'w', encoding='utf-8') as f:
         json.dump(data, f, ensure_ascii=False, indent=2)
+    sync_sentence_embeddings(tag, data)
 
     return get_sentence_db()
 
@@ -758,7 +796,13 @@ def save_gpt_prompt_map():
         }
     }
 
+    old_mapping = read_json(MAP_FILE, {})
     write_json(MAP_FILE, new_mapping)
+
+    # ✅ prompt 有變更的用途才清掉舊快取
+    for task, setting in new_mapping.items():
+        if (old_mapping.get(task) or {}).get("prompt") != setting["prompt"]:
+            invalidate_semantic_cache(task)
     return jsonify(success=True, mapping=new_mapping)
 
 def get_prompt_for_use(use_type):
@@ -773,7 +817,7 @@ def get_prompt_for_use(use_type):
 # 定義首頁路由
 @app.route('/')
 def index():
-    return render_template('FrontEnd.html')  # 渲染首頁模板
+    return render_template('FrontEnd.html', max_upload_mb=MAX_UPLOAD_MB)  # 渲染首頁模板
 
 # 定義結果頁面路由
 @app.route('/result')
@@ -937,9 +981,8 @@ def preview_excel():
         return jsonify({'error': '未提供檔案'})
 
     try:
-        df = pd.read_excel(file)
-        columns = df.columns.tolist()
-        rows = df.head(50).fillna('').astype(str).to_dict(orient='records')  # 預覽前 50 筆資料
+        columns, head = preview_table(file.stream, file.filename, limit=50)  # 讀到第 50 筆就停止
+        rows = head.fillna('').astype(str).to_dict(orient='records')  # 預覽前 50 筆資料
         return jsonify({'columns': columns, 'rows': rows})
     except Exception as e:
         return jsonify({'error': str(e)})
@@ -956,22 +999,23 @@ def ping():
 
 
 
-@app.route('/upload', methods=['POST'])
-def upload_file():
-    print("📥 收到上傳請求")
-
+def parse_upload_request():
+    """
+    解析 /upload 與 /upload-stream 共用的表單並儲存原始檔。
+    成功回傳 (params, None)；失敗回傳 (None, (錯誤回應, 狀態碼))。
+    """
     if 'file' not in request.files:
         print("❌ 沒有 file 欄位")
-        return jsonify({'error': '沒有找到檔案欄位'}), 400
+        return None, (jsonify({'error': '沒有找到檔案欄位'}), 400)
 
     file = request.files['file']
     if file.filename == '':
         print("⚠️ 檔案名稱為空")
-        return jsonify({'error': '未選擇檔案'}), 400
+        return None, (jsonify({'error': '未選擇檔案'}), 400)
 
     if not allowed_file(file.filename):
         print("⚠️ 檔案類型不符")
-        return jsonify({'error': '請上傳 .xlsx 檔案'}), 400
+        return None, (jsonify({'error': '請上傳 .xlsx、.csv 或 .parquet 檔案'}), 400)
 
     # 接收權重設定
     weights = None
@@ -982,7 +1026,7 @@ def upload_file():
             print("📥 收到權重設定：", weights)
         except Exception as e:
             print(f"⚠️ 權重解析失敗：{e}")
-            return jsonify({'error': '權重解析失敗'}), 400
+            return None, (jsonify({'error': '權重解析失敗'}), 400)
     else:
         print("ℹ️ 未提供自訂權重，使用預設值分析")
 
@@ -994,53 +1038,221 @@ def upload_file():
         print("📌 Summary 順位欄位：", summary_priority)
     except Exception as e:
         print(f"⚠️ 欄位順位解析失敗：{e}")
-        return jsonify({'error': '欄位順位解析失敗'}), 400
+        return None, (jsonify({'error': '欄位順位解析失敗'}), 400)
 
     # 產生時間戳記與檔名
-    timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
+    # 加上隨機尾碼：同一秒內的多個上傳不會共用（覆寫）同一組檔案
+    timestamp = f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{uuid.uuid4().hex[:6]}"
     uid = f"result_{timestamp}"
-    original_filename = f"original_{timestamp}.xlsx"
+    original_filename = f"original_{timestamp}.{table_extension(file.filename)}"
     original_path = os.path.join('uploads', original_filename)
 
     try:
         file.save(original_path)
         print(f"📁 原始檔已儲存：{original_path}")
     except Exception as e:
-        return jsonify({'error': f'儲存原始檔失敗：{str(e)}'}), 500
+        logger.exception("❌ 儲存原始檔失敗：%s", e)
+        return None, (jsonify({'error': f'儲存原始檔失敗：{str(e)}'}), 500)
+
+    return {
+        'uid': uid,
+        'path': original_path,
+        'weights': weights,
+        'resolution_priority': resolution_priority,
+        'summary_priority': summary_priority
+    }, None
+
+
+def trigger_kb_build():
+    # 自動觸發建庫腳本
+    print("🚀 自動執行 build_kb.py 建立知識庫")
+    # 呼叫本地的 Python 執行 build_kb.py（保證和 Flask 用同一個解譯器）
+    script_path = os.path.join(os.path.dirname(__file__), "build_kb.py")
+    print("🚀 嘗試用 sys.executable 執行：", script_path)
+    subprocess.Popen([sys.executable, script_path])
+
+
+def run_analysis_job(job, on_event):
+    params = job['params']
+    analysis_result = asyncio.run(analyze_excel_async(
+        params['path'],
+        weights=params['weights'],
+        resolution_priority=params['resolution_priority'],
+        summary_priority=params['summary_priority'],
+        on_event=on_event
+    ))
+    save_analysis_files(analysis_result, job['uid'])
+    print(f"✅ 背景分析完成，共 {len(analysis_result['data'])} 筆")
+    trigger_kb_build()
+
+
+# 🧵 背景分析工作佇列（工作狀態存於 jobs/，重啟後會繼續未完成的工作）
+analysis_jobs = JobQueue(JobStore(os.path.join(basedir, 'jobs')), run_analysis_job, workers=ANALYSIS_JOB_WORKERS)
+
+
+@app.route('/upload', methods=['POST'])
+def upload_file():
+    print("📥 收到上傳請求")
+
+    params, error = parse_upload_request()
+    if error:
+        return error
+    uid, weights = params['uid'], params['weights']
+
+    # mode=job：排入背景佇列，立刻回傳工作編號（之後用 /jobs/<id> 查詢）
+    if request.form.get('mode') == 'job':
+        job = analysis_jobs.submit(params, uid)
+        return jsonify({'jobId': job['id'], 'uid': uid, 'status': job['status']}), 202
 
     try:
         # 呼叫分析主邏輯
         analysis_result = analyze_excel(
-            original_path,
+            params['path'],
             weights=weights,
-            resolution_priority=resolution_priority,
-            summary_priority=summary_priority
+            resolution_priority=params['resolution_priority'],
+            summary_priority=params['summary_priority']
         )
         results = analysis_result['data']
         save_analysis_files(analysis_result, uid)
         print(f"✅ 分析完成，共 {len(results)} 筆")
 
+        trigger_kb_build()
+
+        session['analysis_data'] = results
+        return jsonify({'data': results, 'uid': uid, 'weights': weights}), 200
 
+    except Exception as e:
+        logger.exception("❌ 分析時發生錯誤：%s", e)
+        return jsonify({'error': str(e)}), 500
 
 
-        # 自動觸發建庫腳本
-        print("🚀 自動執行 build_kb.py 建立知識庫")
-        # 呼叫本地的 Python 執行 build_kb.py（保證和 Flask 用同一個解譯器）
-        script_path = os.path.join(os.path.dirname(__file__), "build_kb.py")
-        print("🚀 嘗試用 sys.executable 執行：", script_path)
-        subprocess.Popen([sys.executable, script_path])
+# ⚖️ 以新權重重算既有結果（使用結果內的 scoreFeatures，不重跑 LLM）
+# body：{"uid": "result_20250423_152301", "weights": {...}, "save": false}
+# save=true 時改寫 JSON 與 Excel 報表（已分群的結果一併更新 Cluster 檔），下載與分群畫面才會跟 JSON 一致
+@app.route('/rescore', methods=['POST'])
+def rescore():
+    body = request.get_json(silent=True) or {}
+    uid = body.get('uid', '')
+    weights = body.get('weights') or {}
+    if not re.fullmatch(r'result_[\w]+', uid):
+        return jsonify({'error': 'uid 格式不正確'}), 400
+    if not isinstance(weights, dict) or any(k not in DEFAULT_WEIGHTS for k in weights):
+        return jsonify({'error': f'權重欄位需為 {list(DEFAULT_WEIGHTS)}'}), 400
+    try:
+        weights = {k: float(v) for k, v in weights.items()}
+    except (TypeError, ValueError):
+        return jsonify({'error': '權重需為數字'}), 400
 
+    json_path = os.path.join(basedir, 'json_data', f"{uid}.json")
+    if not os.path.exists(json_path):
+        return jsonify({'error': '找不到對應的 JSON 檔案'}), 404
+    with open(json_path, 'r', encoding='utf-8') as f:
+        result = json.load(f)
 
+    t_start = time.time()
+    rescored = rescore_results(result.get('data', []), weights)
+    if rescored == 0:
+        return jsonify({'error': '此結果沒有保存評分特徵（scoreFeatures），請重新分析一次'}), 409
+    print(f"⚖️ 已以新權重重算 {uid}：{rescored} 筆，用時 {time.time() - t_start:.3f} 秒")
 
-        
+    if body.get('save'):
+        # JSON 與 Excel 報表（含已分群的 Cluster 檔）一起改寫；不重新送 Power Automate
+        write_analysis_reports(result, uid)
+        print(f"💾 已覆寫 {uid} 的 JSON 與報表")
 
-        session['analysis_data'] = results
-        return jsonify({'data': results, 'uid': uid, 'weights': weights}), 200
+    return jsonify({'data': result.get('data', []), 'uid': uid, 'weights': {**DEFAULT_WEIGHTS, **weights}}), 200
 
-    except Exception as e:
-        print(f"❌ 分析時發生錯誤：{e}")
-        traceback.print_exc()
-        return jsonify({'error': str(e)}), 500
+
+def job_summary(job):
+    return {k: job[k] for k in ('id', 'uid', 'status', 'progress', 'created', 'started', 'finished', 'error')}
+
+
+@app.route('/jobs', methods=['GET'])
+def list_jobs():
+    jobs = sorted(analysis_jobs.list(), key=lambda j: j['created'], reverse=True)
+    return jsonify([job_summary(job) for job in jobs])
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def get_job(job_id):
+    job = analysis_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': '找不到此工作'}), 404
+    return jsonify(job_summary(job))
+
+
+@app.route('/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_job(job_id):
+    job = analysis_jobs.cancel(job_id)
+    if not job:
+        return jsonify({'error': '找不到此工作'}), 404
+    return jsonify(job_summary(job))
+
+
+@app.route('/jobs/<job_id>/result', methods=['GET'])
+def get_job_result(job_id):
+    job = analysis_jobs.get(job_id)
+    if not job:
+        return jsonify({'error': '找不到此工作'}), 404
+    if job['status'] != 'done':
+        return jsonify({'error': f"工作尚未完成（{job['status']}）", 'status': job['status']}), 409
+    json_path = os.path.join(basedir, 'json_data', f"{job['uid']}.json")
+    if not os.path.exists(json_path):
+        return jsonify({'error': '找不到分析結果檔案'}), 404
+    with open(json_path, 'r', encoding='utf-8') as f:
+        result = json.load(f)
+    # 與同步 /upload 相同的回傳格式
+    return jsonify({'data': result.get('data', []), 'uid': job['uid'], 'weights': job['params']['weights']})
+
+
+# 📡 串流版上傳：以 server-sent events 逐列回傳結果
+# 事件：row（單列結果，riskLevel 為暫定的固定門檻分級）、progress（完成數與 ETA）、
+#       batch（開啟批次擷取時，每完成一批模型呼叫）、
+#       done（全部完成，含 KMeans 分級後的完整 data 與 uid）、error
+@app.route('/upload-stream', methods=['POST'])
+def upload_file_stream():
+    print("📥 收到串流上傳請求")
+
+    params, error = parse_upload_request()
+    if error:
+        return error
+    uid, weights = params['uid'], params['weights']
+    events = queue.Queue()
+
+    def run_analysis():
+        try:
+            analysis_result = asyncio.run(analyze_excel_async(
+                params['path'],
+                weights=weights,
+                resolution_priority=params['resolution_priority'],
+                summary_priority=params['summary_priority'],
+                on_event=events.put
+            ))
+            save_analysis_files(analysis_result, uid)
+            print(f"✅ 串流分析完成，共 {len(analysis_result['data'])} 筆")
+            trigger_kb_build()
+            events.put({'type': 'done', 'uid': uid, 'weights': weights, 'data': analysis_result['data']})
+        except Exception as e:
+            logger.exception("❌ 串流分析時發生錯誤：%s", e)
+            events.put({'type': 'error', 'error': str(e)})
+
+    threading.Thread(target=run_analysis, name=f"analysis-{uid}", daemon=True).start()
+
+    def generate():
+        yield f"event: start\ndata: {json.dumps({'uid': uid})}\n\n"
+        while True:
+            try:
+                event = events.get(timeout=SSE_KEEPALIVE_SECONDS)
+            except queue.Empty:
+                yield ": keep-alive\n\n"  # 註解行，避免長時間無輸出被代理切斷
+                continue
+            payload = json.dumps(make_json_serializable(event), ensure_ascii=False, default=str)
+            yield f"event: {event['type']}\ndata: {payload}\n\n"
+            if event['type'] in ('done', 'error'):
+                break
+
+    return Response(generate(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
     
 
 
@@ -1056,7 +1268,11 @@ def make_json_serializable(obj):
 
     
     
-def save_analysis_files(result, uid):
+def write_analysis_reports(result, uid):
+    """
+    寫入 JSON 與分析報表 Excel，回傳 JSON 路徑。
+    已分群過的結果（/rescore 儲存時）改寫 Clustered 報表並更新各 Cluster 檔，下載與分群畫面才會是新分數。
+    """
     os.makedirs('json_data', exist_ok=True)
     os.makedirs('excel_result_Unclustered', exist_ok=True)  # ✅ 使用新的資料夾
 
@@ -1067,12 +1283,18 @@ def save_analysis_files(result, uid):
         json.dump(make_json_serializable(result), f, ensure_ascii=False, indent=2)
     print("✅ JSON 檔案已寫入成功")
 
-    # 儲存分析報表 Excel（只儲存 result['data']）
-    df = pd.DataFrame(result['data'])
-    # ✅ 儲存到 Unclustered 資料夾並加上 Unclustered 後綴
-    excel_filename = f"{uid}_Unclustered.xlsx"
-    excel_path = os.path.join(basedir, 'excel_result_Unclustered', excel_filename)    
-    df.to_excel(excel_path, index=False)
+    # 儲存分析報表 Excel（只儲存 result['data']，評分特徵只留在 JSON 供 /rescore 使用）
+    df = pd.DataFrame(result['data']).drop(columns=['scoreFeatures'], errors='ignore')
+    clustered_path = os.path.join(basedir, 'excel_result_Clustered', f"{uid}_Clustered.xlsx")
+    if os.path.exists(clustered_path):
+        excel_path = clustered_path
+        df.to_excel(excel_path, index=False)
+        refresh_cluster_exports(df.to_dict(orient='records'))
+    else:
+        # ✅ 儲存到 Unclustered 資料夾並加上 Unclustered 後綴
+        excel_filename = f"{uid}_Unclustered.xlsx"
+        excel_path = os.path.join(basedir, 'excel_result_Unclustered', excel_filename)
+        df.to_excel(excel_path, index=False)
 
     # 確認 JSON 檔案是否寫入成功
     if os.path.exists(json_path):
@@ -1083,8 +1305,13 @@ def save_analysis_files(result, uid):
     print(f"✅ 分析報表已儲存：{excel_path}")
     print("📁 JSON 絕對路徑：", os.path.abspath(json_path))
     print("📁 Excel 絕對路徑：", os.path.abspath(excel_path))
+    return json_path
+
+
+def save_analysis_files(result, uid):
+    json_path = write_analysis_reports(result, uid)
     timestamp = uid.replace("result_", "")
-    original_excel_path = os.path.abspath(os.path.join(basedir, 'uploads', f"original_{timestamp}.xlsx"))
+    original_excel_path = original_upload_path(os.path.join(basedir, 'uploads'), timestamp)
 
         # ✅ 自動送出到 Power Automate
     try:
@@ -1094,8 +1321,8 @@ def save_analysis_files(result, uid):
         print(f"⚠️ 發送到 Power Automate 失敗：{e}")
 
 
-    if os.path.exists(original_excel_path):
-        print("📁 原始檔絕對路徑：", original_excel_path)
+    if original_excel_path:
+        print("📁 原始檔絕對路徑：", os.path.abspath(original_excel_path))
     else:
         print("⚠️ 找不到原始 Excel 路徑！")
 
@@ -1306,7 +1533,7 @@ def compare_file():
         if 'temp_path' in locals() and os.path.exists(temp_path):
             os.remove(temp_path)
             print(f"❗發生錯誤，刪除暫存檔案：{temp_path}")
-        print(f"❌ 發生錯誤：{e}")
+        logger.exception("❌ 發生錯誤：%s", e)
         return jsonify({"error": str(e)}), 500
  
 
@@ -1405,10 +1632,9 @@ def download_original_excel():
 
     # 取出對應的時間戳
     timestamp = uid.replace('result_', '')
-    original_filename = f'original_{timestamp}.xlsx'
-    original_path = os.path.join('uploads', original_filename)
+    original_path = original_upload_path('uploads', timestamp)
 
-    if os.path.exists(original_path):
+    if original_path:
         return send_file(original_path, as_attachment=True)
     else:
         return jsonify({'error': '找不到對應的原始檔案'}), 404
@@ -1460,6 +1686,9 @@ if __name__ == "__main__":
         webbrowser.open("http://127.0.0.1:5000")
     else:
         print("⚠️ Flask 已在運作，不重複開啟瀏覽器")
+    # reloader 的父行程只負責監看檔案，背景工作佇列只在實際服務的子行程啟動（恢復重啟前未完成的工作）
+    if os.environ.get("WERKZEUG_RUN_MAIN") == "true":
+        analysis_jobs.start()
     app.run(debug=True, use_reloader=True)
 
 
@@ -1,8 +1,6 @@
 from sentence_transformers import SentenceTransformer, util
 from sklearn.feature_extraction.text import TfidfVectorizer
 from keybert import KeyBERT
-import spacy
-import nltk
 import pandas as pd
 # 匯入 os 模組處理檔案與路徑
 import os
@@ -11,6 +9,14 @@ import requests
 import torch  # ✅ 新增 torch 匯入以支援相似度比對
 import time
 import json
+import hashlib
+import threading
+import uuid
+import numpy as np
+from log_config import get_logger, SAMPLED
+from model_server import get_encoder, keybert_backend
+
+logger = get_logger(__name__)
 # # ---------- 載入模型 ----------
 # # 檢查模型是否已存在，否則自動下載並儲存
 # model_path = './models/paraphrase-MiniLM-L6-v2'
@@ -23,7 +29,7 @@ import json
 # 初始化模型
 # ========== 🔍 啟動時間計時器 ==========
 t_start = time.time()
-print("🔥 啟動時間診斷中...")
+logger.info("🔥 啟動時間診斷中...")
 
 # ========== ✅ 載入語意模型 ==========
 t_model_load = time.time()
@@ -35,39 +41,61 @@ def get_model_path(folder_or_name):
         path = os.path.join(os.path.abspath('.'), 'models', folder_or_name)
     return path
 
-bert_model = SentenceTransformer(get_model_path('paraphrase-MiniLM-L6-v2'))
-print(f"📦 BERT 模型載入完成，用時：{time.time() - t_model_load:.2f} 秒")
+BERT_MODEL_NAME = 'paraphrase-MiniLM-L6-v2'
+# 設定 MODEL_SERVER_ADDRESS 時由模型伺服器提供向量，本行程不載入模型
+bert_model = get_encoder(BERT_MODEL_NAME, lambda: SentenceTransformer(get_model_path(BERT_MODEL_NAME)))
+logger.info("📦 BERT 模型載入完成，用時：%.2f 秒", time.time() - t_model_load)
 
 # ========== ✅ 初始化 KeyBERT ==========
 t_keybert = time.time()
-keybert_model = KeyBERT(bert_model)
-print(f"🧠 KeyBERT 初始化完成，用時：{time.time() - t_keybert:.2f} 秒")
-
-# ========== ✅ 載入 spaCy 模型 ==========
-t_spacy = time.time()
-nlp = spacy.load("en_core_web_sm")
-print(f"🧬 spaCy 模型載入完成，用時：{time.time() - t_spacy:.2f} 秒")
-
-t_nltk = time.time()
-nltk.download('punkt')
-nltk.download('stopwords')
-
-
-print(f"📚 NLTK 初始化完成，用時：{time.time() - t_nltk:.2f} 秒")
+keybert_model = KeyBERT(keybert_backend(bert_model))
+logger.info("🧠 KeyBERT 初始化完成，用時：%.2f 秒", time.time() - t_keybert)
+
+# ========== ✅ spaCy / NLTK：第一次使用時才載入 ==========
+# 目前的分析流程沒有用到，行程池的每個分析行程不必在啟動時各載入一份、各下載一次 NLTK 資料
+_nlp = None
+_nltk_ready = False
+_nlp_lock = threading.Lock()
+
+
+def get_nlp():
+    global _nlp
+    with _nlp_lock:
+        if _nlp is None:
+            import spacy
+            t_spacy = time.time()
+            _nlp = spacy.load("en_core_web_sm")
+            logger.info("🧬 spaCy 模型載入完成，用時：%.2f 秒", time.time() - t_spacy)
+        return _nlp
+
+
+def ensure_nltk_data():
+    global _nltk_ready
+    with _nlp_lock:
+        if not _nltk_ready:
+            import nltk
+            t_nltk = time.time()
+            nltk.download('punkt')
+            nltk.download('stopwords')
+            _nltk_ready = True
+            logger.info("📚 NLTK 初始化完成，用時：%.2f 秒", time.time() - t_nltk)
 
 # ========== ✅ 總結 ==========
-print(f"🚀 模型初始化總耗時：約 {time.time() - t_start:.2f} 秒")
+logger.info("🚀 模型初始化總耗時：約 %.2f 秒", time.time() - t_start)
 
 
 
 # 指定 data 資料夾路徑
 DATA_DIR = "data/sentences"
+# 語句 embedding 快取（每個 tag 一組 .npy + 對應的句子 hash 清單）
+EMBEDDING_CACHE_DIR = "data/embeddings"
+_embedding_cache_lock = threading.Lock()
 
 
 
 def load_examples_from_json(filepath):
     if not os.path.exists(filepath):
-        print(f"❌ 檔案不存在：{filepath}")
+        logger.error("❌ 檔案不存在：%s", filepath)
         return []
     with open(filepath, encoding="utf-8") as f:
         try:
@@ -76,29 +104,110 @@ def load_examples_from_json(filepath):
                 return data
             elif isinstance(data, dict):
                 # 如果是 dict，可能要指定 key
-                print(f"⚠️ 檔案內容為 dict：{filepath}，請檢查結構")
+                logger.warning("⚠️ 檔案內容為 dict：%s，請檢查結構", filepath)
                 return []
             else:
-                print(f"⚠️ 檔案內容不是 list 或 dict：{filepath}")
+                logger.warning("⚠️ 檔案內容不是 list 或 dict：%s", filepath)
                 return []
         except Exception as e:
-            print(f"❌ 讀取 json 失敗：{e}")
+            logger.error("❌ 讀取 json 失敗：%s", e)
             return []
         
 
+def example_text(example):
+    # 語句檔為 [{"text": ...}]，也相容純字串清單
+    if isinstance(example, dict):
+        return str(example.get("text", next(iter(example.values()), "")))
+    return str(example)
+
+
+def sentence_hash(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def _embedding_cache_paths(tag):
+    return (os.path.join(EMBEDDING_CACHE_DIR, f"{tag}.npy"),
+            os.path.join(EMBEDDING_CACHE_DIR, f"{tag}.json"))
+
+
+def _read_embedding_cache(tag):
+    """讀取 tag 的 embedding 快取，回傳 {句子 hash: 向量}；模型不同或檔案損毀時視為空快取。"""
+    npy_path, index_path = _embedding_cache_paths(tag)
+    if not (os.path.exists(npy_path) and os.path.exists(index_path)):
+        return {}
+    try:
+        with open(index_path, encoding="utf-8") as f:
+            index = json.load(f)
+        if index.get("model") != BERT_MODEL_NAME:
+            logger.warning("⚠️ [%s] embedding 快取模型不符，將重新 encode", tag)
+            return {}
+        matrix = np.load(npy_path)
+        hashes = index.get("hashes", [])
+        if len(hashes) != len(matrix):
+            logger.warning("⚠️ [%s] embedding 快取筆數不一致，將重新 encode", tag)
+            return {}
+        return dict(zip(hashes, matrix))
+    except Exception as e:
+        logger.error("❌ [%s] 讀取 embedding 快取失敗：%s", tag, e)
+        return {}
+
+
+def _write_embedding_cache(tag, hashes, matrix):
+    os.makedirs(EMBEDDING_CACHE_DIR, exist_ok=True)
+    npy_path, index_path = _embedding_cache_paths(tag)
+    # 先寫暫存檔再 os.replace，避免讀到寫一半的快取；暫存檔名帶 pid + 隨機字尾，行程池 / 多執行緒同時寫入不會互相覆蓋
+    suffix = f".{os.getpid()}.{uuid.uuid4().hex[:8]}.tmp"
+    tmp_npy, tmp_index = npy_path + suffix, index_path + suffix
+    try:
+        with open(tmp_npy, "wb") as f:
+            np.save(f, matrix)
+        with open(tmp_index, "w", encoding="utf-8") as f:
+            json.dump({"model": BERT_MODEL_NAME, "hashes": hashes}, f)
+        os.replace(tmp_npy, npy_path)
+        os.replace(tmp_index, index_path)
+    finally:
+        for path in (tmp_npy, tmp_index):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def sync_sentence_embeddings(tag, examples=None):
+    """
+    取得 tag 語句庫的 embedding 矩陣（float32，列順序與 examples 相同）。
+    只 encode 快取中沒有的句子（新增或被修改過的），並把刪除的句子從快取移除。
+    """
+    if examples is None:
+        examples = load_examples_from_json(os.path.join(DATA_DIR, f"{tag}.json"))
+    texts = [example_text(e) for e in examples]
+    hashes = [sentence_hash(t) for t in texts]
+
+    with _embedding_cache_lock:
+        cached = _read_embedding_cache(tag)
+        missing = {h: t for h, t in zip(hashes, texts) if h not in cached}
+        if missing:
+            new_embs = bert_model.encode(list(missing.values()), convert_to_numpy=True, show_progress_bar=False)
+            cached.update(zip(missing.keys(), new_embs.astype(np.float32)))
+            logger.info("🧮 [%s] 新 encode %d 句，其餘 %d 句取自快取", tag, len(missing), len(hashes) - len(missing))
+
+        unique_hashes = list(dict.fromkeys(hashes))
+        if missing or len(cached) != len(unique_hashes):
+            dim = bert_model.get_sentence_embedding_dimension()
+            stored = np.array([cached[h] for h in unique_hashes], dtype=np.float32).reshape(-1, dim)
+            _write_embedding_cache(tag, unique_hashes, stored)
+
+    if not hashes:
+        return np.zeros((0, bert_model.get_sentence_embedding_dimension()), dtype=np.float32)
+    return np.array([cached[h] for h in hashes], dtype=np.float32)
+
+
 def load_embeddings(tag):
     examples = load_examples_from_json(os.path.join(DATA_DIR, f"{tag}.json"))
-    print(f"🟦 [{tag}] 本次載入語句 {len(examples)} 筆")
-    if examples:
-        print(f"    前 3 句：{examples[:3]}")
-        print(f"    倒數 3 句：{examples[-3:]}")
-    else:
-        print("    ⚠️ 沒有語句（空清單）")
+    logger.info("🟦 [%s] 本次載入語句 %d 筆", tag, len(examples))
     if len(examples) == 0:
-        print(f"⚠️ {tag} examples 為空")
+        logger.warning("⚠️ %s examples 為空", tag)
         return [], None
-    embeddings = bert_model.encode(examples, convert_to_tensor=True)
-    print(f"✅ {tag} embedding shape：{embeddings.shape}")
+    embeddings = torch.from_numpy(sync_sentence_embeddings(tag, examples)).to(bert_model.device)
+    logger.debug("✅ %s embedding shape：%s", tag, tuple(embeddings.shape))
     return examples, embeddings
 
 # ========== ✅ 載入語句樣本 ==========
@@ -106,7 +215,8 @@ def load_embeddings(tag):
 
 # 高風險語句樣本
 high_risk_examples = load_examples_from_json(os.path.join(DATA_DIR, "high_risk.json"))
-print(f"✅ 載入高風險語句：{len(high_risk_examples)} 筆，前 3 筆：{high_risk_examples[:3]}，倒數 3 筆：{high_risk_examples[-3:]}")
+logger.info("✅ 載入高風險語句：%d 筆", len(high_risk_examples))
+logger.debug("前 3 筆：%s，倒數 3 筆：%s", high_risk_examples[:3], high_risk_examples[-3:])
 
 # high_risk_examples = [
 #     'cannot sign in', 'login failed', 'unable to login', 'access denied',
@@ -168,17 +278,16 @@ print(f"✅ 載入高風險語句：{len(high_risk_examples)} 筆，前 3 筆：
 #     "Critical application crash leads to data loss.",
 #     "Account disabled, unable to sign in.",
 # ]
-print("high_risk_examples:", len(high_risk_examples))
 
-high_risk_embeddings = bert_model.encode(high_risk_examples, convert_to_tensor=True)
-print(f"✅ 高風險 embedding shape：{high_risk_embeddings.shape}")
+high_risk_embeddings = torch.from_numpy(sync_sentence_embeddings("high_risk", high_risk_examples)).to(bert_model.device)
+logger.debug("✅ 高風險 embedding shape：%s", tuple(high_risk_embeddings.shape))
 
 
 # 升級處理語句樣本
 escalation_examples = load_examples_from_json(os.path.join(DATA_DIR, "escalate.json"))
-print("escalation_examples:", len(escalation_examples))
 
-print(f"✅ 載入升級處理語句：{len(escalation_examples)} 筆，前 3 筆：{escalation_examples[:3]}，倒數 3 筆：{escalation_examples[-3:]}")
+logger.info("✅ 載入升級處理語句：%d 筆", len(escalation_examples))
+logger.debug("前 3 筆：%s，倒數 3 筆：%s", escalation_examples[:3], escalation_examples[-3:])
 
 # escalation_examples = [
 #     'escalation approved', 'escalated', 'escalate to', 
@@ -226,15 +335,15 @@ print(f"✅ 載入升級處理語句：{len(escalation_examples)} 筆，前 3 
 #     "confirmed by engineering",
 #     "added to global allowlist",
 # ]
-escalation_embeddings = bert_model.encode(escalation_examples, convert_to_tensor=True)
-print(f"✅ 升級處理 embedding shape：{escalation_embeddings.shape}")
+escalation_embeddings = torch.from_numpy(sync_sentence_embeddings("escalate", escalation_examples)).to(bert_model.device)
+logger.debug("✅ 升級處理 embedding shape：%s", tuple(escalation_embeddings.shape))
 
 
 # 多人受影響語句樣本
 multi_user_examples = load_examples_from_json(os.path.join(DATA_DIR, "multi_user.json"))
-print("multi_user_examples:", len(multi_user_examples))
 
-print(f"✅ 載入多人受影響語句：{len(multi_user_examples)} 筆，前 3 筆：{multi_user_examples[:3]}，倒數 3 筆：{multi_user_examples[-3:]}")
+logger.info("✅ 載入多人受影響語句：%d 筆", len(multi_user_examples))
+logger.debug("前 3 筆：%s，倒數 3 筆：%s", multi_user_examples[:3], multi_user_examples[-3:])
 
 # multi_user_examples = [
 #     'two meeting rooms', 'multiple rooms', 'both', 'colleague and I',
@@ -260,48 +369,75 @@ print(f"✅ 載入多人受影響語句：{len(multi_user_examples)} 筆，前 3
 #     "not limited to one user",
 #     ]
 
-multi_user_embeddings = bert_model.encode(multi_user_examples, convert_to_tensor=True)
-print(f"✅ 多人受影響 embedding shape：{multi_user_embeddings.shape}")
+multi_user_embeddings = torch.from_numpy(sync_sentence_embeddings("multi_user", multi_user_examples)).to(bert_model.device)
+logger.debug("✅ 多人受影響 embedding shape：%s", tuple(multi_user_embeddings.shape))
 
 
 # ---------- 語意判斷函式 ----------
 def is_high_risk(text, examples, embeddings):
     if not examples or embeddings is None or len(examples) == 0:
-        print("  [高風險比對] 無語句庫，不執行比對")
+        logger.debug("  [高風險比對] 無語句庫，不執行比對", extra=SAMPLED)
         return 0
     test_emb = bert_model.encode([text], convert_to_tensor=True)
     sims = util.cos_sim(test_emb, embeddings).flatten()
     max_idx = int(sims.argmax())
     max_score = sims[max_idx].item()
-    print(f"  [高風險比對] 檢查：'{text[:30]}'")
-    print(f"    - 最高分語句: '{examples[max_idx]}' 相似度: {max_score:.3f}")
+    logger.debug("  [高風險比對] 檢查：'%s'，最高分語句: '%s' 相似度: %.3f", text[:30], examples[max_idx], max_score, extra=SAMPLED)
     return 1 if max_score > 0.5 else 0
 
 def is_escalated(text, examples, embeddings):
     if not examples or embeddings is None or len(examples) == 0:
-        print("  [升級比對] 無語句庫，不執行比對")
+        logger.debug("  [升級比對] 無語句庫，不執行比對", extra=SAMPLED)
         return 0
     test_emb = bert_model.encode([text], convert_to_tensor=True)
     sims = util.cos_sim(test_emb, embeddings).flatten()
     max_idx = int(sims.argmax())
     max_score = sims[max_idx].item()
-    print(f"  [升級比對] 檢查：'{text[:30]}'")
-    print(f"    - 最高分語句: '{examples[max_idx]}' 相似度: {max_score:.3f}")
+    logger.debug("  [升級比對] 檢查：'%s'，最高分語句: '%s' 相似度: %.3f", text[:30], examples[max_idx], max_score, extra=SAMPLED)
     return 1 if max_score > 0.5 else 0
 
 def is_multi_user(text, examples, embeddings):
     if not examples or embeddings is None or len(examples) == 0:
-        print("  [多人比對] 無語句庫，不執行比對")
+        logger.debug("  [多人比對] 無語句庫，不執行比對", extra=SAMPLED)
         return 0
     test_emb = bert_model.encode([text], convert_to_tensor=True)
     sims = util.cos_sim(test_emb, embeddings).flatten()
     max_idx = int(sims.argmax())
     max_score = sims[max_idx].item()
-    print(f"  [多人比對] 檢查：'{text[:30]}'")
-    print(f"    - 最高分語句: '{examples[max_idx]}' 相似度: {max_score:.3f}")
+    logger.debug("  [多人比對] 檢查：'%s'，最高分語句: '%s' 相似度: %.3f", text[:30], examples[max_idx], max_score, extra=SAMPLED)
     return 1 if max_score > 0.5 else 0
 
 
+# ---------- 批次語意判斷（整欄一次 encode + 矩陣相乘） ----------
+def encode_texts_batch(texts, batch_size=64):
+    """
+    將整欄文字去重後一次批次 encode，回傳與 texts 對齊的 embedding tensor。
+    """
+    unique_texts = list(dict.fromkeys(texts))
+    position = {t: i for i, t in enumerate(unique_texts)}
+    unique_embs = bert_model.encode(unique_texts, batch_size=batch_size, convert_to_tensor=True, show_progress_bar=False)
+    order = torch.tensor([position[t] for t in texts], dtype=torch.long, device=unique_embs.device)
+    return unique_embs[order]
+
+
+def batch_semantic_flags(texts, examples, embeddings, threshold=0.5, tag=""):
+    """
+    is_high_risk / is_escalated / is_multi_user 的批次版本：
+    整欄只 encode 一次，再以一次 cos_sim 矩陣運算取得每列對語句庫的最高相似度。
+    """
+    if not texts:
+        return np.zeros(0, dtype=int)
+    if not examples or embeddings is None or len(examples) == 0:
+        logger.info("  [%s批次比對] 無語句庫，不執行比對", tag)
+        return np.zeros(len(texts), dtype=int)
+    text_embs = encode_texts_batch(texts)
+    sims = util.cos_sim(text_embs, embeddings.to(text_embs.device))  # (列數, 語句數)
+    max_scores = sims.max(dim=1).values
+    flags = (max_scores > threshold).int().cpu().numpy()
+    logger.info("✅ [%s批次比對] %d 筆完成，命中 %d 筆", tag, len(texts), int(flags.sum()))
+    return flags
+
+
 # ---------- 自動關鍵字抽取 ----------
 
 def extract_keywords(text, top_n=3):
@@ -379,11 +515,11 @@ def is_actionable_resolution(text):
         cosine_scores = util.cos_sim(target_embedding, reference_embeddings)
         max_score = cosine_scores.max().item()
 
-        print(f"🧠 Resolution 類似度最高分：{max_score:.2f}")  # ✅ 可印出 debug 分數
+        logger.debug("🧠 Resolution 類似度最高分：%.2f", max_score, extra=SAMPLED)
 
         return max_score >= 0.5  # 門檻可調整
     except Exception as e:
-        print("❌ 類似度分析錯誤：", e)
+        logger.error("❌ 類似度分析錯誤：%s", e)
         return False
 
 def extract_cluster_name(texts, max_features=5, top_k=2):
@@ -0,0 +1,75 @@
+import multiprocessing
+import os
+import secrets
+import sys
+from multiprocessing import AuthenticationError
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 行程池模式：一個模型伺服器行程持有所有 SentenceTransformer，N 個分析行程只透過本機 socket 取向量。
+# 啟動方式：
+#   1. python analysis_worker.py            （模型伺服器 + ANALYSIS_POOL_PROCESSES 個分析行程）
+#   2. 以 ANALYSIS_JOB_WORKERS=0、MODEL_SERVER_ADDRESS=127.0.0.1:6010 啟動 Analysis.py
+#      Flask 只負責排工作（/upload mode=job），由本行程池從 jobs/ 取出執行
+# MODEL_SERVER_AUTHKEY：未設定時本行程產生隨機金鑰，只有自己啟動的模型伺服器與分析行程知道；
+#   Analysis.py 也要連模型伺服器時，兩邊請設定同一把金鑰
+ANALYSIS_POOL_PROCESSES = int(os.environ.get("ANALYSIS_POOL_PROCESSES", max(1, (os.cpu_count() or 2) // 2)))
+DEFAULT_MODEL_SERVER_ADDRESS = "127.0.0.1:6010"
+
+
+def run_model_server(address):
+    from model_server import ModelServer
+    ModelServer(address).serve_forever()
+
+
+def run_analysis_worker(index):
+    # 子行程匯入 Analysis 時，MODEL_SERVER_ADDRESS 已設定，模型改由伺服器提供
+    # 語意快取的 log / 向量檔只能由一個行程寫入：每個分析行程用自己的一組（依編號固定，重啟後沿用）
+    os.environ["SEMANTIC_CACHE_NAME"] = f"semantic_cache.worker{index}"
+    from Analysis import analysis_jobs
+    analysis_jobs.serve_shared()
+
+
+def main():
+    address = os.environ.setdefault("MODEL_SERVER_ADDRESS", DEFAULT_MODEL_SERVER_ADDRESS)
+    # 須在匯入 model_server 前設定；子行程（fork / spawn）都從環境變數繼承同一把金鑰
+    os.environ.setdefault("MODEL_SERVER_AUTHKEY", secrets.token_hex(32))
+    from model_server import wait_for_server
+
+    processes = []
+    try:
+        running = wait_for_server(address, timeout=0)
+    except AuthenticationError:
+        logger.error("❌ %s 已有模型伺服器在執行，但金鑰不同；請設定相同的 MODEL_SERVER_AUTHKEY", address)
+        sys.exit(1)
+    if not running:
+        server = multiprocessing.Process(target=run_model_server, args=(address,), name="model-server", daemon=True)
+        server.start()
+        processes.append(server)
+        logger.info("⏳ 等待模型伺服器 %s 載入模型...", address)
+        if not wait_for_server(address):
+            logger.error("❌ 模型伺服器啟動逾時，結束行程池")
+            sys.exit(1)
+    else:
+        logger.info("🔌 使用已在執行的模型伺服器 %s", address)
+
+    from job_queue import JobStore
+    JobStore(os.path.join(os.path.abspath(os.path.dirname(__file__)), 'jobs')).reset_claims()
+
+    for i in range(ANALYSIS_POOL_PROCESSES):
+        worker = multiprocessing.Process(target=run_analysis_worker, args=(i,), name=f"analysis-process-{i}", daemon=True)
+        worker.start()
+        processes.append(worker)
+    logger.info("🧵 已啟動 %d 個分析行程（模型只載入一份）", ANALYSIS_POOL_PROCESSES)
+
+    try:
+        for p in processes:
+            p.join()
+    except KeyboardInterrupt:
+        logger.info("🛑 收到中斷，結束行程池")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+import argparse
+import time
+
+import faiss
+import numpy as np
+
+from kb_index import create_index, index_vectors, search
+
+# 比較各種知識庫索引相對於 flat（精確搜尋）的 recall@k 與查詢延遲，用來決定部署時的 KB_INDEX_TYPE / nprobe / efSearch
+# 用法：
+#   python benchmark_kb_index.py                         以現有 kb_index.faiss 的向量測試
+#   python benchmark_kb_index.py --synthetic 200000      以隨機向量模擬大型知識庫
+NPROBE_SWEEP = [1, 4, 8, 16, 32, 64]
+EF_SEARCH_SWEEP = [16, 32, 64, 128, 256]
+
+
+def load_vectors(args):
+    if args.synthetic:
+        rng = np.random.default_rng(42)
+        # 帶群聚結構的隨機向量，比均勻分布更接近句向量
+        centers = rng.normal(size=(max(args.synthetic // 500, 1), args.dim)).astype(np.float32)
+        vectors = centers[rng.integers(0, len(centers), args.synthetic)]
+        vectors += 0.3 * rng.normal(size=vectors.shape).astype(np.float32)
+        return np.arange(args.synthetic, dtype=np.int64), vectors
+    return index_vectors(faiss.read_index(args.index))
+
+
+def make_queries(vectors, count, rng):
+    # 從知識庫抽樣並加入擾動，模擬「相近但不完全相同」的查詢
+    picks = vectors[rng.choice(len(vectors), size=min(count, len(vectors)), replace=False)]
+    return picks + 0.05 * rng.normal(size=picks.shape).astype(np.float32) * np.linalg.norm(picks, axis=1, keepdims=True) / np.sqrt(picks.shape[1])
+
+
+def run_queries(index, queries, top_k, **params):
+    latencies = []
+    labels = []
+    for q in queries:
+        t0 = time.perf_counter()
+        _, I = search(index, q[None, :], top_k, **params)
+        latencies.append((time.perf_counter() - t0) * 1000)
+        labels.append(I[0])
+    return np.array(labels), np.array(latencies)
+
+
+def recall_at_k(found, truth):
+    hits = sum(len(set(f[f >= 0]) & set(t)) for f, t in zip(found, truth))
+    return hits / truth.size
+
+
+def main():
+    parser = argparse.ArgumentParser(description="知識庫索引 recall / 延遲基準測試")
+    parser.add_argument("--index", default="kb_index.faiss")
+    parser.add_argument("--synthetic", type=int, default=0, help="改用 N 筆隨機向量")
+    parser.add_argument("--dim", type=int, default=384)
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--top-k", type=int, default=5)
+    parser.add_argument("--types", default="ivf_flat,ivf_pq,hnsw")
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    ids, vectors = load_vectors(args)
+    queries = make_queries(vectors, args.queries, rng)
+    print(f"📊 向量 {len(vectors)} 筆、維度 {vectors.shape[1]}、查詢 {len(queries)} 筆、top_k={args.top_k}")
+
+    flat = create_index(ids, vectors, "flat")
+    truth, flat_latency = run_queries(flat, queries, args.top_k)
+    rows = [("flat", "-", 1.0, flat_latency)]
+
+    for index_type in [t.strip() for t in args.types.split(",") if t.strip()]:
+        t0 = time.time()
+        index = create_index(ids, vectors, index_type)
+        print(f"🧭 {index_type} 建立耗時 {time.time() - t0:.2f} 秒")
+        if index_type == "hnsw":
+            sweep = [("efSearch", ef, {"ef_search": ef}) for ef in EF_SEARCH_SWEEP]
+        else:
+            sweep = [("nprobe", n, {"nprobe": n}) for n in NPROBE_SWEEP if n <= index.nlist]
+        for name, value, params in sweep:
+            found, latency = run_queries(index, queries, args.top_k, **params)
+            rows.append((index_type, f"{name}={value}", recall_at_k(found, truth), latency))
+
+    print(f"\n{'索引':<10}{'參數':<16}{'recall@k':>10}{'p50 ms':>10}{'p95 ms':>10}{'加速':>8}")
+    flat_p50 = np.percentile(flat_latency, 50)
+    for index_type, setting, recall, latency in rows:
+        p50, p95 = np.percentile(latency, 50), np.percentile(latency, 95)
+        print(f"{index_type:<10}{setting:<16}{recall:>10.3f}{p50:>10.3f}{p95:>10.3f}{flat_p50 / p50:>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,14 +1,16 @@
 import os
 import sys
 import json
+import uuid
 import faiss
-import pickle
-import sqlite3
 from tqdm import tqdm
 from sentence_transformers import SentenceTransformer
 import numpy as np
 from datetime import datetime
 from dateutil.parser import parse
+from model_server import get_encoder
+from kb_index import choose_index_type, create_index, index_type_of, needs_rebuild, normalize, supports_remove
+from kb_store import KBStore, text_hash
 # ========== ✅ 檢查環境與依賴 ==========
 print("✅ [DEBUG] 你有成功呼叫 build_kb.py")
 
@@ -16,8 +18,9 @@ print("✅ [DEBUG] 你有成功呼叫 build_kb.py")
 LOCK_FILE = "kb_building.lock"
 LOG_FILE = "kb_log.txt"
 KB_INDEX = "kb_index.faiss"
-KB_TEXTS = "kb_texts.pkl"
-KB_METADATA = "kb_metadata.json"
+KB_VECTORS = "kb_vectors.f32"     # 正規化後的向量，第 vid 列即向量 id = vid 的向量
+KB_INDEX_INFO = "kb_index_info.json"  # 索引類型、向量維度與 IVF 訓練時的資料量
+KB_VERSION = "kb_version.json"     # 換上新 index 後更新；gptChat 偵測到版本變更就在背景重新載入
 PROCESSED_LOG = "processed_files.json"
 DATA_DIR = "json_data"
 MODEL_NAME = "all-MiniLM-L6-v2"
@@ -67,46 +70,9 @@ def save_processed_file(file):
 
 
 def save_to_sqlite(metadata_list):
-    conn = sqlite3.connect(SQLITE_DB)
-    c = conn.cursor()
-
-    # 建表（如果不存在）
-    c.execute("""
-            CREATE TABLE IF NOT EXISTS metadata (
-                internalId INTEGER PRIMARY KEY AUTOINCREMENT,
-                id TEXT UNIQUE,
-                text TEXT,
-                subcategory TEXT,
-                configurationItem TEXT,
-                roleComponent TEXT,
-                location TEXT,
-                opened TEXT,
-                analysisTime TEXT
-            )
-    """)
-
-
-    # 插入資料
-    for item in metadata_list:
-        c.execute("""
-            INSERT OR REPLACE INTO metadata (id, text, subcategory, configurationItem, roleComponent, location, opened,analysisTime)
-            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-        """, (
-            item.get("id"),
-            item["text"],
-            item["subcategory"],
-            item["configurationItem"],
-            item["roleComponent"],
-            item["location"],
-            item["opened"],
-            item["analysisTime"]
-        ))
-
-
-    conn.commit()
-    conn.close()
-    print(f"🗃️ 已同步儲存 {len(metadata_list)} 筆資料到 SQLite：{SQLITE_DB}")
-
+    # 單一交易 executemany upsert，只改寫內容有變的列（見 KBStore.upsert）
+    written = KBStore(SQLITE_DB, KB_VECTORS).upsert(metadata_list)
+    print(f"🗃️ 已同步 {len(metadata_list)} 筆資料到 SQLite：{SQLITE_DB}（實際寫入 {written} 筆）")
 
 
 def extract_texts_and_metadata(json_file):
@@ -143,6 +109,56 @@ def extract_texts_and_metadata(json_file):
             })
         return kb_texts, metadata
 
+def write_atomic(path, write):
+    # 先寫暫存檔再 os.replace，gptChat 不會讀到寫一半的檔案
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def write_index_atomic(index, path):
+    tmp_path = path + ".tmp"
+    faiss.write_index(index, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def load_kb_state(store):
+    """
+    載入舊知識庫。只有 index 帶固定向量 id（IndexIDMap / IVF）、且 SQLite 已有 vid 與向量檔時才能增量更新；
+    舊版（IndexFlatL2 + kb_texts.pkl / kb_metadata.json）回傳 None，由 build_kb 全部重建一次。
+    """
+    if not os.path.exists(KB_INDEX) or not os.path.exists(KB_INDEX_INFO) or not store.has_vectors():
+        return None
+    index = faiss.read_index(KB_INDEX)
+    if not (hasattr(index, "id_map") or index_type_of(index).startswith("ivf")):
+        return None
+    with open(KB_INDEX_INFO, "r", encoding="utf-8") as f:
+        index_info = json.load(f)
+    return index, index_info
+
+
+def update_index(index, index_info, vids, embeddings, stale_vids, store):
+    """
+    把新增/變動的向量寫進索引。支援刪除的索引（flat、IVF）直接 remove_ids + add_with_ids；
+    HNSW 只有新增時也直接 add_with_ids 追加到現有的圖。
+    索引類型需要改變（舊版 L2 索引、資料量跨過 KB_ANN_MIN_VECTORS、IVF 需重新訓練）或 HNSW 有變動的列時，
+    以向量檔（memmap）中的全部向量重建，不必重新編碼。
+    """
+    if index is not None and (supports_remove(index) or not stale_vids):
+        if stale_vids:
+            index.remove_ids(np.array(stale_vids, dtype=np.int64))
+        index.add_with_ids(embeddings, vids)
+        if not needs_rebuild(index, index_info):
+            return index, {**index_info, "dim": int(embeddings.shape[1])}
+    ids = store.indexed_vids()
+    vectors = np.asarray(store.vectors(embeddings.shape[1])[ids])
+    index_type = choose_index_type(len(ids))
+    print(f"🧭 重建 {index_type} 索引，共 {len(ids)} 筆")
+    index = create_index(ids, vectors, index_type)
+    return index, {"type": index_type, "trainedOn": int(len(ids)), "dim": int(embeddings.shape[1])}
+
+
 def build_kb():
     processed_files = load_processed_files()
     all_files = [f for f in os.listdir(DATA_DIR) if f.endswith(".json") and f not in processed_files]
@@ -151,74 +167,80 @@ def build_kb():
         return
 
     print(f"📂 有 {len(all_files)} 個新 JSON 檔要加入知識庫")
-    model = SentenceTransformer(MODEL_NAME)
-
-    if os.path.exists(KB_INDEX) and os.path.exists(KB_TEXTS) and os.path.exists(KB_METADATA):
-        print("🔄 載入舊有 FAISS index、文字庫與 metadata")
-        index = faiss.read_index(KB_INDEX)
-        with open(KB_TEXTS, "rb") as f:
-            kb_texts = pickle.load(f)
-        with open(KB_METADATA, "r", encoding="utf-8") as f:
-            metadata = json.load(f)
-    else:
-        print("🆕 建立全新知識庫")
-        index = None
-        kb_texts = []
-        metadata = []
-
-
+    new_items = {}
     for file in tqdm(all_files, desc="📥 加入新知識檔案"):
         path = os.path.join(DATA_DIR, file)
         print(f"📑 處理檔案：{file}")
-        new_texts, new_metadata = extract_texts_and_metadata(path)
-        metadata.extend(new_metadata)
+        _, new_metadata = extract_texts_and_metadata(path)
+        for item in new_metadata:
+            uid = item.get("id")
+            if not uid or uid == "未提供":
+                continue
+            new_items[uid] = item  # 同一批內同 id 以後出現的為準
         save_processed_file(file)
 
-    # 🔄 若有舊的 metadata，先載入並轉成 dict 以 id 為 key
-    print("📂 載入舊的 metadata.json 並準備比對 ID...")
-    if os.path.exists(KB_METADATA):
-        with open(KB_METADATA, "r", encoding="utf-8") as f:
-            old_metadata = json.load(f)
+    store = KBStore(SQLITE_DB, KB_VECTORS)
+    state = load_kb_state(store)
+    if state is None:
+        # 🆕 第一次建庫或舊版知識庫：SQLite 內既有的資料與新資料全部配固定向量 id，重建一次
+        print("🆕 建立可增量更新的知識庫（SQLite + 向量檔 + 固定向量 id）")
+        index, index_info = None, {}
+        items = {item["id"]: item for item in store.all_items()}
+        items.update(new_items)
+        changed = items
+        upserts = items
+        next_vid = 0
+        known = {}
     else:
-        old_metadata = []
-
-    metadata_dict = {item["id"]: item for item in old_metadata if "id" in item}
-
-    print(f"🔍 舊 metadata 共 {len(metadata_dict)} 筆，準備與新資料合併")
-
-    # 🆕 更新或新增每一筆新 metadata（用新資料覆蓋同 id）
-    print(f"➕ 合併新 metadata，共 {len(metadata)} 筆新資料")
-    for item in metadata:
-        uid = item.get("id")
-        if not uid or uid == "未提供":
-            continue
-        metadata_dict[uid] = item
-
-    # 💾 寫回檔案（轉回 list）
-    merged_metadata = list(metadata_dict.values())
-    print(f"💾 寫入合併後的 metadata，共 {len(merged_metadata)} 筆")
-    with open(KB_METADATA, "w", encoding="utf-8") as f:
-        json.dump(merged_metadata, f, ensure_ascii=False, indent=2)
-
-    # ✅ 這裡改為重建 FAISS index 和文字庫
-    print("📐 開始重建 FAISS 向量庫")
-    texts_for_embedding = [item["text"] for item in merged_metadata]
-    embeddings = model.encode(texts_for_embedding, show_progress_bar=True)
-
-    index = faiss.IndexFlatL2(embeddings.shape[1])
-    index.add(np.array(embeddings))
-    print("✅ 向量建立完成，準備儲存 FAISS index")
-
-    faiss.write_index(index, KB_INDEX)
-    with open(KB_TEXTS, "wb") as f:
-        pickle.dump(texts_for_embedding, f)
-    print(f"💾 向量庫與文字庫已儲存，共 {len(texts_for_embedding)} 筆")
-
-    print("🗃️ 寫入 SQLite 資料庫中...")
-    save_to_sqlite(merged_metadata)
+        print("🔄 載入舊有 FAISS index，比對本次資料的文字雜湊")
+        index, index_info = state
+        # 只查本次出現的 id；只有新 id 或文字內容變動的列需要重新編碼
+        known = store.lookup(new_items.keys())
+        changed = {uid: item for uid, item in new_items.items()
+                   if known.get(uid, (None, None))[1] != text_hash(item["text"])}
+        upserts = new_items
+        next_vid = (store.max_vid() or -1) + 1
+    print(f"➕ 本次新資料 {len(new_items)} 筆，其中需要重新編碼 {len(changed)} 筆")
+
+    stale_vids, vids, texts = [], [], []
+    for uid, item in upserts.items():
+        vid = known.get(uid, (None, None))[0]
+        if uid in changed:
+            if vid is not None:
+                stale_vids.append(vid)    # 內容變動：沿用原本的向量 id，先移除舊向量
+            else:
+                vid, next_vid = next_vid, next_vid + 1
+            vids.append(vid)
+            texts.append(item["text"])
+        item["vid"] = vid
+        item["textHash"] = text_hash(item["text"])
+
+    if changed:
+        print(f"📐 編碼 {len(texts)} 筆新增/變動資料")
+        model = get_encoder(MODEL_NAME, lambda: SentenceTransformer(MODEL_NAME))
+        embeddings = normalize(model.encode(texts, show_progress_bar=True))
+        vids = np.array(vids, dtype=np.int64)
+        # 向量檔與 SQLite 先寫，index 最後寫：讀取端拿到的 index 中每個 id 都查得到文字
+        store.write_vectors(vids, embeddings, reset=state is None)
+        print("🗃️ 寫入 SQLite 資料庫中...")
+        save_to_sqlite(list(upserts.values()))
+        index, index_info = update_index(index, index_info, vids, embeddings, stale_vids, store)
+        write_atomic(KB_INDEX_INFO, lambda f: json.dump(index_info, f))
+        write_index_atomic(index, KB_INDEX)
+        # 版本戳記最後寫：讀取端看到新版本時，index 與 SQLite 都已是新的
+        write_atomic(KB_VERSION, lambda f: json.dump({
+            "version": uuid.uuid4().hex,
+            "builtAt": datetime.now().isoformat(),
+            "ntotal": int(index.ntotal),
+        }, f))
+        print(f"💾 向量庫已儲存，共 {index.ntotal} 筆")
+    else:
+        print("🗃️ 寫入 SQLite 資料庫中...")
+        save_to_sqlite(list(upserts.values()))
 
-    print(f"✅ 知識庫更新完成（總共 {len(texts_for_embedding)} 筆）")
-    log(f"✅ [LOG] 成功建立知識庫，共 {len(texts_for_embedding)} 筆")
+    total = index.ntotal if index is not None else 0
+    print(f"✅ 知識庫更新完成（總共 {total} 筆，本次編碼 {len(changed)} 筆）")
+    log(f"✅ [LOG] 成功更新知識庫，共 {total} 筆，本次編碼 {len(changed)} 筆")
 
 
 if __name__ == "__main__":
@@ -1,16 +1,20 @@
 import subprocess
 import os
-import pickle
 import faiss
 import json
 import numpy as np
 from sentence_transformers import SentenceTransformer
+from model_server import get_encoder
+from kb_index import KB_MIN_SCORE, is_cosine_index, search as search_index
+from kb_store import KBStore, LegacyTextStore
 import pandas as pd
 import matplotlib.pyplot as plt
 import re
 import io
 import base64
 import sqlite3
+import threading
+import time
 
 DB_PATH = "resultDB.db"  # 你在 build_kb.py 裡設定的 DB 名稱
 
@@ -18,19 +22,94 @@ DB_PATH = "resultDB.db"  # 你在 build_kb.py 裡設定的 DB 名稱
 
 # ----------- 知識庫向量載入與檢索 -----------
 
+KB_INDEX_FILE = "kb_index.faiss"
+KB_VERSION_FILE = "kb_version.json"   # build_kb 每次換上新 index 後寫入的版本戳記
+KB_RELOAD_POLL_SECONDS = 5            # 背景檢查版本戳記的間隔
+# KB_INDEX_MMAP=1：以 memmap 唯讀開啟 index（IVF 的倒排表不載入記憶體）；
+# Windows 上被 memmap 的檔案無法被 os.replace 取代，預設關閉
+KB_INDEX_MMAP = os.environ.get("KB_INDEX_MMAP") == "1"
+
+
+def read_kb_version():
+    try:
+        with open(KB_VERSION_FILE, encoding="utf-8") as f:
+            return json.load(f).get("version")
+    except (FileNotFoundError, json.JSONDecodeError):
+        return None
+
+
 def load_kb():
+    """回傳 (index, store)；找不到知識庫時回傳 (None, None)。文字與 metadata 留在 SQLite，查詢時才依向量 id 取用。"""
     print("🔄 正在載入知識庫...")
-    if not os.path.exists("kb_index.faiss") or not os.path.exists("kb_texts.pkl"):
+    store = KBStore(DB_PATH)
+    if not os.path.exists(KB_INDEX_FILE) or not (store.has_vectors() or os.path.exists("kb_texts.pkl")):
         print("⚠️ 找不到知識庫檔案，RAG 功能停用")
-        return None, None, None
-    model = SentenceTransformer("all-MiniLM-L6-v2")
-    index = faiss.read_index("kb_index.faiss")
-    with open("kb_texts.pkl", "rb") as f:
-        kb_texts = pickle.load(f)
-    print(f"✅ 已載入知識庫，共 {len(kb_texts)} 筆")
-    return model, index, kb_texts
+        return None, None
+    if not store.has_vectors():
+        print("⚠️ 知識庫為舊版格式，下次建庫時會自動轉換")
+        store = LegacyTextStore("kb_texts.pkl")
+    flags = faiss.IO_FLAG_MMAP | faiss.IO_FLAG_READ_ONLY if KB_INDEX_MMAP else 0
+    index = faiss.read_index(KB_INDEX_FILE, flags)
+    print(f"✅ 已載入知識庫，共 {index.ntotal} 筆")
+    return index, store
+
+
+class KBManager:
+    """
+    持有目前的 (index, store, version)。背景執行緒定期檢查 kb_version.json，
+    build_kb 換上新 index 後在背景載入，再整組替換；查詢端每次只讀一次 snapshot()，
+    進行中的 /chat 繼續用舊 index 直到結束，不需要加鎖，也不需重啟或重載模型。
+    """
+
+    def __init__(self, poll_seconds=KB_RELOAD_POLL_SECONDS):
+        self.poll_seconds = poll_seconds
+        self.current = (None, None, None)
+        self.model = None
+        self.lock = threading.Lock()
+        self.started = False
+
+    def reload(self):
+        # 先讀版本再載入：載入途中若又有新版本，下一輪會再換一次
+        version = read_kb_version()
+        index, store = load_kb()
+        self.current = (index, store, version)  # 單一賦值即為原子替換
+        return index is not None
+
+    def snapshot(self):
+        self.start()
+        return self.current
+
+    def get_model(self):
+        # 知識庫可能在啟動後才建好，模型延遲到第一次需要時才載入
+        with self.lock:
+            if self.model is None:
+                self.model = get_encoder("all-MiniLM-L6-v2", lambda: SentenceTransformer("all-MiniLM-L6-v2"))
+            return self.model
+
+    def start(self):
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+        threading.Thread(target=self._watch, name="kb-reload", daemon=True).start()
+
+    def _watch(self):
+        while True:
+            time.sleep(self.poll_seconds)
+            version = read_kb_version()
+            if version is None or version == self.current[2]:
+                continue
+            try:
+                print(f"🔁 偵測到知識庫新版本 {version}，背景重新載入")
+                self.reload()
+            except Exception as e:
+                # 載入失敗時繼續使用舊版本，下一輪再試
+                print(f"❌ 知識庫重新載入失敗，沿用舊版本：{e}")
 
-kb_model, kb_index, kb_texts = load_kb() # 載入知識庫模型、索引和文本
+
+kb_manager = KBManager()
+if kb_manager.reload():  # 啟動時載入知識庫索引和儲存層
+    kb_manager.get_model()
 
 # ----------- 知識庫摘要壓縮 -----------
 
@@ -215,9 +294,11 @@ def determine_top_k_with_llm(user_input, fallback=3, min_top_k=1, max_top_k=10):
     return fallback
 
  # ----------- 知識庫檢索(語意比對類別) -----------
-def search_knowledge_base(query, top_k=None):
+def search_knowledge_base(query, top_k=None, nprobe=None, ef_search=None, min_score=KB_MIN_SCORE):
+    """回傳 [(文字, cosine 相似度), ...]，由高到低；低於 min_score 的弱相關結果直接捨棄。"""
     print("🔍 執行語意查詢...")
-    if kb_model is None or kb_index is None or kb_texts is None:
+    kb_index, kb_store, _ = kb_manager.snapshot()  # 同一次查詢固定使用同一版知識庫
+    if kb_index is None or kb_store is None:
         print("❌ 知識庫尚未載入")
         return []
     # 如果沒有指定 top_k，就自動判斷
@@ -226,14 +307,24 @@ def search_knowledge_base(query, top_k=None):
         print(f"🤖 動態決定 top_k = {top_k}")
 
     # 將查詢轉換為向量
-    query_vec = kb_model.encode([query])
-    # 使用 FAISS 索引進行檢索 
-    # D是是每筆相似資料的距離分數（越小越相近，對 cosine 來說通常會轉成 1 - similarity）
-    # 是每筆對應的資料索引（可用來查 kb_texts[i] 得到原始句子）
-    D, I = kb_index.search(np.array(query_vec), top_k)
+    query_vec = kb_manager.get_model().encode([query])
+    # 使用 FAISS 索引進行檢索（IVF 用 nprobe、HNSW 用 ef_search 調整召回率與速度，未指定時用 kb_index 的預設值）
+    # D 是每筆的 cosine 相似度（越大越相近）；舊版 L2 知識庫重建前為距離，無法套用門檻
+    # I 是每筆對應的向量 id（固定 id，文字由 kb_store 依 id 到 SQLite 取；不足 top_k 時補 -1）
+    D, I = search_index(kb_index, np.array(query_vec), top_k, nprobe=nprobe, ef_search=ef_search)
+    cosine = is_cosine_index(kb_index)
+    kept = []
+    for score, i in zip(D[0], I[0]):
+        if i < 0:
+            continue
+        if cosine and score < min_score:
+            break  # 結果已依相似度排序，後面只會更低
+        kept.append((int(i), float(score) if cosine else None))
+    texts = kb_store.fetch_texts([i for i, _ in kept])  # 只取通過門檻的幾筆
+    results = [(texts[i], score) for i, score in kept if i in texts]
     print(f"[RAG] 🔍 查詢內容：{query}")
-    print(f"[RAG] 🧠 取出知識庫資料：{[kb_texts[i][:50] for i in I[0]]}")
-    return [kb_texts[i] for i in I[0]]
+    print(f"[RAG] 🧠 取出知識庫資料：{[(t[:50], s) for t, s in results]}（捨棄 {len(I[0]) - len(results)} 筆）")
+    return results
 
 
 
@@ -409,7 +500,10 @@ def handle_follow_up(chat_id, message):
     print(f"🧠 上次查詢類型為：{result_type}")
 
     if result_type == "Field Filter":
-        original = context.get("filters", {})
+        # 上次可能沒有條件（None / {}），也可能存的是單一條件或條件清單
+        original = context.get("filters") or []
+        if isinstance(original, dict):
+            original = [original]
         print(f"🔎 原始過濾條件：{original}")
 
         new_filter_prompt = (
@@ -442,20 +536,16 @@ def handle_follow_up(chat_id, message):
                 print("⚠️ 欄位不在允許清單中")
                 return "⚠️ 無效的欄位"
 
-            filters = [original] + [new_filter]
+            # 空的、沒有 field 的條件不帶進查詢，否則 KBStore.filter 會因欄位不合法而失敗
+            filters = [f for f in original + [new_filter] if isinstance(f, dict) and f.get("field")]
             print(f"🔗 合併過濾條件：{filters}")
 
-            with open("kb_metadata.json", encoding="utf-8") as f:
-                metadata = json.load(f)
-            print(f"📦 載入 metadata，總筆數：{len(metadata)}")
-
-            matches = metadata
-            for f in filters:
-                matches = [m for m in matches if m.get(f["field"]) == f["value"]]
-            print(f"📊 符合條件筆數：{len(matches)}")
+            # 以 SQL 在 metadata 表上篩選（欄位皆有索引），不再每次載入整份 kb_metadata.json
+            count, texts = KBStore(DB_PATH).filter(filters, limit=5)
+            print(f"📊 符合條件筆數：{count}")
 
-            lines = [f"- {item.get('text', '')[:500]}" for item in matches[:5]]
-            return f"🔎 延伸查詢結果（共 {len(matches)} 筆）：\n" + "\n".join(lines)
+            lines = [f"- {text[:500]}" for text in texts]
+            return f"🔎 延伸查詢結果（共 {count} 筆）：\n" + "\n".join(lines)
 
         except Exception as e:
             print(f"❌ 延伸查詢錯誤：{str(e)}")
@@ -861,12 +951,14 @@ def run_offline_gpt(message, model="orca2:13b", history=[], chat_id=None):
     # ✅ 動態決定 top_k 筆數（預設 fallback=3）
     top_k = determine_top_k_with_llm(message, fallback=3) # 呼叫 LLM 決定合適的 top_k, top_k 是檢索的筆數
     print(f"[RAG] 🤖 決定 top_k = {top_k}")
-    retrieved = search_knowledge_base(message, top_k=top_k) # 語意檢索知識庫，返回 top_k 筆相似資料
+    matches = search_knowledge_base(message, top_k=top_k) # 語意檢索知識庫，返回最多 top_k 筆（文字, 相似度）
+    retrieved = [chunk for chunk, _ in matches]  # 弱相關結果已被過濾，送去摘要的段落更少
     if retrieved:
         print(f"[RAG] ✅ 找到 {len(retrieved)} 筆相似資料：")
-        for i, chunk in enumerate(retrieved, 1):
+        for i, (chunk, score) in enumerate(matches, 1):
             preview = chunk.replace('\n', ' ')[:100]
-            print(f"    {i}. {preview}...")
+            score_text = f"{score:.2f}" if score is not None else "-"
+            print(f"    {i}. [{score_text}] {preview}...")
     else:
         print("[RAG] ⚠️ 未找到相似資料")
 
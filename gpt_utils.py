@@ -1,106 +1,184 @@
 from SmartScoring1 import is_actionable_resolution
+from semantic_cache import SemanticCache, SemanticCacheStore
+from log_config import get_logger, SAMPLED
+from model_server import get_encoder
+from ollama_control import AdaptiveLimiter, CircuitBreaker, CircuitOpenError, RetryPolicy, start_retry_budget
 import aiohttp
 import asyncio
+import atexit
 import hashlib
 import json
 import os
+import threading
 from datetime import datetime
-from sentence_transformers import SentenceTransformer, util
+from sentence_transformers import SentenceTransformer
 import numpy as np
 
-MAX_CONCURRENCY = 10
+logger = get_logger(__name__)
+
+MAX_CONCURRENCY = 10                # 自適應並行上限的天花板
 DEFAULT_MODEL_SOLUTION = "mistral"
 DEFAULT_MODEL_SUMMARY = "phi3:mini"
-semaphore = asyncio.Semaphore(MAX_CONCURRENCY)
 
 # ✅ 快取儲存位置
 CACHE_DIR = "cache"
-CACHE_FILE = os.path.join(CACHE_DIR, "semantic_cache.json")
+CACHE_FILE = os.path.join(CACHE_DIR, "semantic_cache.json")  # 舊版整包 JSON，僅用於一次性轉檔
+# log / 向量檔只能有一個寫入者：行程池的每個分析行程由 analysis_worker.py 設定各自的 SEMANTIC_CACHE_NAME
+CACHE_NAME = os.environ.get("SEMANTIC_CACHE_NAME", "semantic_cache")
+CACHE_LOG_FILE = os.path.join(CACHE_DIR, f"{CACHE_NAME}.log")
+CACHE_VECTOR_FILE = os.path.join(CACHE_DIR, f"{CACHE_NAME}.f32")
 MAX_CACHE_SIZE = 3000
-
-# 統計用變數
-cache_hit_count = 0
-cache_total_queries = 0
+MAX_CACHE_BYTES = 64 * 1024 * 1024      # 快取總容量上限（含 embedding）
+CACHE_EVICTION_POLICY = "lru"           # lru / lfu / fifo
+CACHE_TTL_SECONDS = 30 * 24 * 60 * 60   # 每筆快取存活 30 天，None 代表不過期
 
 # ✅ 確保資料夾存在
 os.makedirs(CACHE_DIR, exist_ok=True)
 
 # ✅ 載入語意模型
-embedding_model = SentenceTransformer('all-MiniLM-L6-v2')
+embedding_model = get_encoder('all-MiniLM-L6-v2', lambda: SentenceTransformer('all-MiniLM-L6-v2'))
+
+
+def _log_expired_cache(keys):
+    # 過期的快取也要寫刪除紀錄，否則 log 重播時會一直帶著它們直到壓縮
+    for key in keys:
+        cache_store.append_delete(key)
+
+
+# ✅ 載入快取資料（hash 字典 + 預先配置的向量矩陣；持久化為 append-only log + float32 向量檔）
+semantic_cache = SemanticCache(
+    MAX_CACHE_SIZE,
+    embedding_model.get_sentence_embedding_dimension(),
+    policy=CACHE_EVICTION_POLICY,
+    ttl_seconds=CACHE_TTL_SECONDS,
+    max_bytes=MAX_CACHE_BYTES,
+    on_expire=_log_expired_cache,
+)
+cache_store = SemanticCacheStore(CACHE_LOG_FILE, CACHE_VECTOR_FILE, semantic_cache.dim)
+
+
+def snapshot_semantic_cache():
+    # 複製一份存活快取給背景壓縮使用，避免 slot 被覆寫
+    return semantic_cache.snapshot()
+
+
+def _created_timestamp(entry):
+    try:
+        return datetime.fromisoformat(entry["createdAt"]).timestamp()
+    except Exception:
+        return None
 
-# ✅ 載入快取資料
-if os.path.exists(CACHE_FILE):
-    with open(CACHE_FILE, "r", encoding="utf-8") as f:
-        semantic_cache = json.load(f)
-else:
-    semantic_cache = []
+
+if cache_store.exists():
+    for key, entry, vec in cache_store.load():
+        # 沒有 namespace 的舊快取無法確認是哪個用途 / prompt / model 產生的，不再使用
+        if entry.get("namespace"):
+            evicted = semantic_cache.add(key, entry, vec, namespace=entry["namespace"], created_at=_created_timestamp(entry))
+            for old_key in evicted:
+                cache_store.append_delete(old_key)
+    semantic_cache.purge_expired()  # 最後載入的幾筆若已過期，也在這裡寫刪除紀錄
+    if len(semantic_cache) != cache_store.live:
+        cache_store.compact(snapshot_semantic_cache())
+elif os.path.exists(CACHE_FILE):
+    # 舊版快取未區分用途（solution / ai_summary 共用），直接停用，不轉入新格式
+    logger.info("🔄 [Cache] 舊版 semantic_cache.json 未區分用途，已停用")
+    os.replace(CACHE_FILE, CACHE_FILE + ".migrated")
+logger.info("✅ [Cache] 已載入語意快取 %d 筆", len(semantic_cache))
 
 # ✅ 產生 hash key 用於完全比對
 def make_hash(text):
     return hashlib.sha256(text.encode('utf-8')).hexdigest()
 
+
+# ✅ 快取 namespace：(用途, prompt hash, model)，不同用途或 prompt / model 變更後的回答不會互相命中
+def make_cache_namespace(task, prompt, model):
+    return f"{task}:{make_hash(prompt or '')[:12]}:{model or ''}"
+
+
+def make_cache_key(namespace, text):
+    return make_hash(f"{namespace}\n{text}")
+
 # ✅ 語意快取查詢（含文字 hash + cosine）
 # ✅ 語意快取查詢（含文字 hash + cosine）
-def find_semantic_cache(text, threshold=0.9, source_id=""):
-    global cache_hit_count, cache_total_queries
-    cache_total_queries += 1
-    key = make_hash(text)
-
-    print(f"🔍 [Cache] 查找快取中... {source_id} hash={key[:8]} text='{text[:30]}'")
-
-    for item in semantic_cache:
-        if item.get("hash") == key:
-            if item["response"] == "（AI 擷取失敗）":
-                print(f"🚫 [Cache] 命中但為失敗快取（{source_id}），需送 GPT 再分析")
-                return None
-            cache_hit_count += 1
-            print(f"🎯 [Cache] 完整命中！（{source_id}）")
-            return item["response"]
+def find_semantic_cache(text, namespace, threshold=0.9, source_id=""):
+    key = make_cache_key(namespace, text)
+
+    logger.debug("🔍 [Cache] 查找快取中... %s hash=%s text='%s'", source_id, key[:8], text[:30], extra=SAMPLED)
+
+    item = semantic_cache.get(key)
+    if item is not None:
+        if item["response"] == "（AI 擷取失敗）":
+            logger.debug("🚫 [Cache] 命中但為失敗快取（%s），需送 GPT 再分析", source_id, extra=SAMPLED)
+            semantic_cache.record(hit=False)
+            return None
+        semantic_cache.record(hit=True)
+        logger.debug("🎯 [Cache] 完整命中！（%s）", source_id, extra=SAMPLED)
+        return item["response"]
 
     if len(semantic_cache) == 0:
-        print(f"📭 [Cache] 無任何快取可比對（cache 空）（{source_id}）")
+        logger.debug("📭 [Cache] 無任何快取可比對（cache 空）（%s）", source_id, extra=SAMPLED)
+        semantic_cache.record(hit=False)
         return None
 
     try:
         query_vec = embedding_model.encode(text).astype(np.float32)
-        all_vecs = np.array([item['embedding'] for item in semantic_cache], dtype=np.float32)
-        sims = util.cos_sim(query_vec, all_vecs).flatten()
+        item, score = semantic_cache.search(query_vec, threshold, namespace=namespace)
     except Exception as e:
-        print(f"❌ [Cache] 語意比對時發生錯誤（{source_id}）：{e}")
+        logger.error("❌ [Cache] 語意比對時發生錯誤（%s）：%s", source_id, e)
+        semantic_cache.record(hit=False)
         return None
 
-    best_idx = int(np.argmax(sims))
-    if sims[best_idx] > threshold:
-        response = semantic_cache[best_idx]["response"]
+    if item is not None:
+        response = item["response"]
         if response == "（AI 擷取失敗）":
-            print(f"🚫 [Cache] 語意相似命中但為失敗快取（{sims[best_idx]:.3f}）（{source_id}）")
+            logger.debug("🚫 [Cache] 語意相似命中但為失敗快取（%.3f）（%s）", score, source_id, extra=SAMPLED)
+            semantic_cache.record(hit=False)
             return None
-        cache_hit_count += 1
-        print(f"🎯 [Cache] 語意相似命中！相似度={sims[best_idx]:.3f}（{source_id}）")
+        semantic_cache.record(hit=True)
+        logger.debug("🎯 [Cache] 語意相似命中！相似度=%.3f（%s）", score, source_id, extra=SAMPLED)
         return response
 
-    print(f"❌ [Cache] 無命中，將送 GPT 擷取新資料（{source_id}）")
+    logger.debug("❌ [Cache] 無命中，將送 GPT 擷取新資料（%s）", source_id, extra=SAMPLED)
+    semantic_cache.record(hit=False)
     return None
 
 
 
 
 # ✅ 儲存新的快取紀錄
-def add_to_semantic_cache(text, response):
-    key = make_hash(text)
-    emb = embedding_model.encode(text).tolist()
-    semantic_cache.append({
+def add_to_semantic_cache(text, response, namespace):
+    key = make_cache_key(namespace, text)
+    emb = embedding_model.encode(text).astype(np.float32)
+    entry = {
         "hash": key,
+        "namespace": namespace,
         "input": text,
-        "embedding": emb,
         "response": response,
         "createdAt": datetime.now().isoformat()
-    })
-    if len(semantic_cache) > MAX_CACHE_SIZE:
-        semantic_cache.pop(0)
-    with open(CACHE_FILE, "w", encoding="utf-8") as f:
-        json.dump(semantic_cache, f, ensure_ascii=False, indent=2)
-    print(f"💾 [Cache] 已儲存快取：hash={key[:8]} text='{text[:30]}'")
+    }
+    evicted = semantic_cache.add(key, entry, emb, namespace=namespace)
+    # 只附加這一筆（與被淘汰的紀錄），不再整包重寫
+    cache_store.append(key, entry, emb)
+    for old_key in evicted:
+        cache_store.append_delete(old_key)
+    cache_store.compact_in_background(snapshot_semantic_cache)
+    logger.debug("💾 [Cache] 已儲存快取：hash=%s text='%s'", key[:8], text[:30], extra=SAMPLED)
+
+
+# ✅ prompt 設定變更後，清掉該用途舊 prompt 的快取（其他用途不受影響）
+def invalidate_semantic_cache(task):
+    prompt, _ = get_gpt_prompt_and_model(task)
+    current_prefix = f"{task}:{make_hash(prompt or '')[:12]}:"
+
+    def is_stale(entry):
+        namespace = entry.get("namespace", "")
+        return namespace.startswith(f"{task}:") and not namespace.startswith(current_prefix)
+
+    removed = semantic_cache.remove_where(is_stale)
+    for key in removed:
+        cache_store.append_delete(key)
+    logger.info("🧹 [Cache] %s 的 prompt 已變更，清除舊快取 %d 筆", task, len(removed))
+    return len(removed)
 
 # 🧠 主功能：從段落中抽出解決建議句（含空值與快取）
 
@@ -114,24 +192,59 @@ def get_gpt_prompt_and_model(task="solution"):
             model = config[task].get("model") or ""
             # 檢查是否 prompt/model 缺失
             if not prompt or not model:
-                print(f"⚠️ [PromptMap] {task} 的 prompt 或 model 欄位為空，已啟用預設值！")
+                logger.warning("⚠️ [PromptMap] %s 的 prompt 或 model 欄位為空，已啟用預設值！", task)
             return prompt, model
         else:
-            print(f"⚠️ [PromptMap] {task} 設定不存在，已啟用預設值！")
+            logger.warning("⚠️ [PromptMap] %s 設定不存在，已啟用預設值！", task)
     except Exception as e:
-        print(f"❌ [PromptMap] 讀取 {task} 設定失敗：{e}")
+        logger.error("❌ [PromptMap] 讀取 %s 設定失敗：%s", task, e)
     # 回傳預設值
     if task == "solution":
-        print("⚠️ [PromptMap] 使用 solution 預設 prompt/model")
+        logger.warning("⚠️ [PromptMap] 使用 solution 預設 prompt/model", extra=SAMPLED)
         return "請從以下段落提取一個具體的行動建議", DEFAULT_MODEL_SOLUTION
     elif task == "ai_summary":
-        print("⚠️ [PromptMap] 使用 ai_summary 預設 prompt/model")
+        logger.warning("⚠️ [PromptMap] 使用 ai_summary 預設 prompt/model", extra=SAMPLED)
         return "請用一句話描述事件是什麼", DEFAULT_MODEL_SUMMARY
     else:
-        print(f"⚠️ [PromptMap] 未知用途 {task}，回傳空值")
+        logger.warning("⚠️ [PromptMap] 未知用途 %s，回傳空值", task)
         return "", ""
 
 
+# 🔁 重試策略：指數退避 + jitter，受每次上傳的時間預算限制；Ollama 掛掉時由斷路器直接擋下
+LLM_RETRY_POLICY = RetryPolicy(max_attempts=5, base_delay=0.5, max_delay=8.0)
+UPLOAD_LLM_BUDGET_SECONDS = 15 * 60     # 單次上傳所有 LLM 重試可用的總時間
+
+
+def start_upload_llm_budget(seconds=UPLOAD_LLM_BUDGET_SECONDS):
+    """在一次分析開始時呼叫；之後建立的 task 共用這個截止時間。"""
+    start_retry_budget(seconds)
+
+
+async def call_ollama_with_retry(prompt, model, label, source_id=""):
+    """呼叫模型並檢查結果是否完整；重試用盡、斷路器開啟或預算用完時回傳 None。"""
+    for attempt in range(LLM_RETRY_POLICY.max_attempts):
+        timeout = LLM_RETRY_POLICY.attempt_timeout(OLLAMA_TIMEOUT_SECONDS)
+        if timeout is None:
+            logger.warning("⏱️ %s 本次上傳的 LLM 時間預算已用完，略過（%s）", label, source_id, extra=SAMPLED)
+            return None
+        try:
+            result = await call_ollama_model_async(prompt, model, timeout=timeout)
+            if result and "擷取失敗" not in result and "未偵測" not in result:
+                logger.debug("✅ %s 第 %d 次呼叫成功（%s）", label, attempt + 1, source_id, extra=SAMPLED)
+                return result
+            logger.warning("⚠️ %s 回傳內容不完整，第 %d 次結果為：%s...", label, attempt + 1, result[:30], extra=SAMPLED)
+        except CircuitOpenError:
+            logger.warning("⛔ %s Ollama 暫停呼叫中（斷路器開啟），直接略過（%s）", label, source_id, extra=SAMPLED)
+            return None
+        except Exception as e:
+            logger.warning("⚠️ %s 第 %d 次呼叫失敗（%s）：%s", label, attempt + 1, source_id, e, extra=SAMPLED)
+        if attempt + 1 < LLM_RETRY_POLICY.max_attempts and not await LLM_RETRY_POLICY.sleep_before_retry(attempt):
+            logger.warning("⏱️ %s 剩餘時間預算不足以再重試（%s）", label, source_id, extra=SAMPLED)
+            return None
+
+    logger.error("⛔ %s 分析失敗（%s），已達最大重試次數 %d 次", label, source_id, LLM_RETRY_POLICY.max_attempts)
+    return None
+
 
 async def extract_resolution_suggestion(text, model=DEFAULT_MODEL_SOLUTION, source_id=""):
     if not isinstance(text, str) or not text.strip():
@@ -139,7 +252,7 @@ async def extract_resolution_suggestion(text, model=DEFAULT_MODEL_SOLUTION, sour
 
     ALWAYS_ANALYZE = True
     if not ALWAYS_ANALYZE and not is_actionable_resolution(text):
-        print(f"⏭️ 無語意相近解法語氣，略過分析（{source_id}）：", text[:100])
+        logger.debug("⏭️ 無語意相近解法語氣，略過分析（%s）：%s", source_id, text[:100], extra=SAMPLED)
         return "（未偵測到具體解法語氣，略過分析）"
 
     # 讀取目前的 prompt 與 model 設定
@@ -148,32 +261,19 @@ async def extract_resolution_suggestion(text, model=DEFAULT_MODEL_SOLUTION, sour
 
     lines = text.strip().splitlines()
     text_trimmed = "\n".join(lines[:3])
-    print(f"🔍 [GPT] 準備擷取解決建議：{text_trimmed[:30]}...（{source_id}）")
+    logger.debug("🔍 [GPT] 準備擷取解決建議：%s...（%s）", text_trimmed[:30], source_id, extra=SAMPLED)
 
-    cached = find_semantic_cache(text_trimmed, source_id=source_id)
+    namespace = make_cache_namespace("solution", custom_prompt, model)
+    cached = find_semantic_cache(text_trimmed, namespace, source_id=source_id)
     if cached:
-        print(f"🎯 快取命中：略過 GPT 分析（{source_id}）")
+        logger.debug("🎯 快取命中：略過 GPT 分析（%s）", source_id, extra=SAMPLED)
         return cached
 
     prompt = f"{custom_prompt}\n---\n{text_trimmed}"
-    max_retry = 5
-    retry_count = 0
-
-    while retry_count < max_retry:
-        try:
-            result = await call_ollama_model_async(prompt, model)
-            if result and "擷取失敗" not in result and "未偵測" not in result:
-                print(f"✅ GPT (擷取解決建議)第 {retry_count + 1} 次呼叫成功（{source_id}）")
-                add_to_semantic_cache(text_trimmed, result)
-                return result
-            else:
-                print(f"⚠️ GPT 回傳內容不完整，第 {retry_count + 1} 次結果為：{result[:30]}...")
-        except Exception as e:
-            print(f"⚠️ GPT 呼叫失敗（第 {retry_count + 1} 次）（{source_id}）：{e}")
-        retry_count += 1
-        await asyncio.sleep(2)
-
-    print(f"⛔ GPT 分析失敗（{source_id}），已達最大重試次數 {max_retry} 次")
+    result = await call_ollama_with_retry(prompt, model, "GPT (擷取解決建議)", source_id)
+    if result:
+        add_to_semantic_cache(text_trimmed, result, namespace)
+        return result
     return "（AI (擷取解決建議)擷取失敗）"
 
 
@@ -187,61 +287,257 @@ async def extract_problem_with_custom_prompt(text, model=None, source_id=""):
 
     lines = text.strip().splitlines()
     text_trimmed = "\n".join(lines[:3])
-    print(f"🔍 [GPT] 準備擷取問題摘要：{text_trimmed[:30]}...（{source_id}）")
+    logger.debug("🔍 [GPT] 準備擷取問題摘要：%s...（%s）", text_trimmed[:30], source_id, extra=SAMPLED)
 
-    cached = find_semantic_cache(text_trimmed, source_id=source_id)
+    namespace = make_cache_namespace("ai_summary", custom_prompt, model)
+    cached = find_semantic_cache(text_trimmed, namespace, source_id=source_id)
     if cached:
-        print(f"🎯 快取命中：略過 GPT (擷取問題摘要) 分析（{source_id}）")
+        logger.debug("🎯 快取命中：略過 GPT (擷取問題摘要) 分析（%s）", source_id, extra=SAMPLED)
         return cached
 
     prompt = f"{custom_prompt}\n---\n{text_trimmed}"
-    max_retry = 5
-    retry_count = 0
-
-    while retry_count < max_retry:
-        try:
-            result = await call_ollama_model_async(prompt, model)
-            if result and "擷取失敗" not in result and "未偵測" not in result:
-                print(f"✅ GPT (擷取問題摘要) 第 {retry_count + 1} 次呼叫成功（{source_id}）")
-                add_to_semantic_cache(text_trimmed, result)
-                return result
-            else:
-                print(f"⚠️ GPT 回傳內容不完整，第 {retry_count + 1} 次結果為：{result[:30]}...")
-        except Exception as e:
-            print(f"⚠️ GPT (擷取問題摘要) 第 {retry_count + 1} 次呼叫失敗（{source_id}）：{e}")
-        retry_count += 1
-        await asyncio.sleep(2)
-
-    print(f"⛔ GPT (擷取問題摘要) 分析失敗（{source_id}），已達最大重試次數 {max_retry} 次")
+    result = await call_ollama_with_retry(prompt, model, "GPT (擷取問題摘要)", source_id)
+    if result:
+        add_to_semantic_cache(text_trimmed, result, namespace)
+        return result
     return "（AI (擷取問題摘要)擷取失敗）"
 # 🧠 主功能：擷取問題摘要（同樣支援 source_id）
 
+
+# 🧠 批次擷取（選用）：把多筆短文字包成一個 prompt，要求回傳 JSON 陣列，解析失敗時退回逐筆呼叫
+BATCH_EXTRACTION_SIZE = int(os.environ.get("BATCH_EXTRACTION_SIZE", "8"))  # 每次呼叫包含的筆數
+BATCH_NUM_PREDICT_PER_ITEM = 60     # 每筆預留的輸出 token 數
+
+
+def batch_extraction_enabled():
+    # 以環境變數 BATCH_EXTRACTION_ENABLED=1 開啟；每次呼叫時才讀取，不是匯入時的值
+    return os.environ.get("BATCH_EXTRACTION_ENABLED", "0").lower() in ("1", "true", "yes", "on")
+
+
+_SINGLE_EXTRACTORS = {
+    "solution": extract_resolution_suggestion,
+    "ai_summary": extract_problem_with_custom_prompt,
+}
+
+
+def build_batch_prompt(custom_prompt, texts):
+    parts = [
+        custom_prompt,
+        f"以下共有 {len(texts)} 筆事件，請依上述要求分別回答每一筆。",
+        f"只回傳一個長度為 {len(texts)} 的 JSON 字串陣列，依序對應每一筆，不要加任何說明，例如：[\"第1筆的回答\", \"第2筆的回答\"]",
+    ]
+    for i, text in enumerate(texts, 1):
+        parts.append(f"---\n[{i}]\n{text}")
+    return "\n".join(parts)
+
+
+def parse_batch_response(result, expected):
+    """從模型回覆中取出 JSON 陣列；筆數不符或內容不完整時回傳 None。"""
+    start, end = result.find("["), result.rfind("]")
+    if start < 0 or end <= start:
+        return None
+    try:
+        answers = json.loads(result[start:end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(answers, list) or len(answers) != expected:
+        return None
+    answers = [str(a).strip() for a in answers]
+    if any(not a or "擷取失敗" in a or "未偵測" in a for a in answers):
+        return None
+    return answers
+
+
+async def _extract_chunk(task, custom_prompt, model, namespace, texts, source_ids):
+    prompt = build_batch_prompt(custom_prompt, texts)
+    num_predict = BATCH_NUM_PREDICT_PER_ITEM * len(texts) + 20
+    try:
+        timeout = LLM_RETRY_POLICY.attempt_timeout(OLLAMA_TIMEOUT_SECONDS)
+        if timeout is None:
+            raise TimeoutError("本次上傳的 LLM 時間預算已用完")
+        result = await call_ollama_model_async(prompt, model, timeout=timeout, num_predict=num_predict)
+        answers = parse_batch_response(result, len(texts))
+    except Exception as e:
+        logger.warning("⚠️ [Batch] %s 批次呼叫失敗（%s～%s）：%s", task, source_ids[0], source_ids[-1], e)
+        answers = None
+
+    if answers is not None:
+        logger.debug("✅ [Batch] %s 批次擷取成功：%d 筆（%s～%s）", task, len(texts), source_ids[0], source_ids[-1])
+        for text, answer in zip(texts, answers):
+            add_to_semantic_cache(text, answer, namespace)
+        return answers
+
+    # 解析失敗：退回逐筆呼叫
+    logger.warning("🔁 [Batch] %s 批次結果無法解析，改為逐筆擷取（%d 筆）", task, len(texts))
+    extractor = _SINGLE_EXTRACTORS[task]
+    return await asyncio.gather(*[extractor(text, model=model, source_id=sid) for text, sid in zip(texts, source_ids)])
+
+
+async def extract_batch_with_custom_prompt(texts, task, model=None, source_ids=None, batch_size=BATCH_EXTRACTION_SIZE,
+                                           on_event=None):
+    """
+    批次版的 extract_resolution_suggestion / extract_problem_with_custom_prompt，回傳與 texts 對齊的結果。
+    快取命中的筆數不送模型；相同文字只送一次。
+    on_event：選用的回呼，每完成一批收到 {'type': 'batch', 'task', 'done', 'total'}；回呼丟出例外（例如取消）會中止其餘批次。
+    """
+    source_ids = source_ids or [f"Row#{i + 1}" for i in range(len(texts))]
+    custom_prompt, custom_model = get_gpt_prompt_and_model(task)
+    if task == "solution":
+        model = model or DEFAULT_MODEL_SOLUTION  # 與 extract_resolution_suggestion 的預設一致
+    model = model or custom_model
+    namespace = make_cache_namespace(task, custom_prompt, model)
+
+    results = [None] * len(texts)
+    pending = {}  # 去頭後的文字 -> 需要這個結果的列
+    for i, text in enumerate(texts):
+        if not isinstance(text, str) or not text.strip():
+            results[i] = "（無原始描述）"
+            continue
+        trimmed = "\n".join(text.strip().splitlines()[:3])
+        if trimmed not in pending:
+            cached = find_semantic_cache(trimmed, namespace, source_id=source_ids[i])
+            if cached:
+                results[i] = cached
+                continue
+        pending.setdefault(trimmed, []).append(i)
+
+    unique_texts = list(pending.keys())
+    chunks = [unique_texts[i:i + batch_size] for i in range(0, len(unique_texts), batch_size)]
+    logger.info("📦 [Batch] %s：%d 筆中 %d 筆需送模型，共 %d 次呼叫", task, len(texts), len(unique_texts), len(chunks))
+    finished = [0]
+
+    async def run_chunk(chunk):
+        answers = await _extract_chunk(task, custom_prompt, model, namespace, chunk, [source_ids[pending[t][0]] for t in chunk])
+        finished[0] += 1
+        if on_event:
+            on_event({'type': 'batch', 'task': task, 'done': finished[0], 'total': len(chunks)})
+        return answers
+
+    chunk_results = await asyncio.gather(*[run_chunk(chunk) for chunk in chunks])
+    for chunk, answers in zip(chunks, chunk_results):
+        for text, answer in zip(chunk, answers):
+            for i in pending[text]:
+                results[i] = answer
+    return results
+
 # 📊 快取命中率報告
 def print_cache_report():
-    if cache_total_queries == 0:
-        print("📊 本次未執行任何語意快取查詢。")
+    stats = semantic_cache.stats()
+    total = stats["hits"] + stats["misses"]
+    if total == 0:
+        logger.info("📊 本次未執行任何語意快取查詢。")
         return
-    ratio = cache_hit_count / cache_total_queries * 100
-    print(f"📊 快取命中 {cache_hit_count} / {cache_total_queries} 筆，命中率 {ratio:.1f}%")
+    logger.info("📊 快取命中 %d / %d 筆，命中率 %.1f%%（目前 %d 筆，約 %.1f MB）",
+                stats['hits'], total, stats['hitRate'] * 100, stats['entries'], stats['bytes'] / 1024 / 1024)
+
+# 🔧 共用的 Ollama 連線池：固定在一個背景 event loop 上，跨列、跨次分析重複使用 keep-alive 連線
+OLLAMA_URL = "http://localhost:11434/api/generate"
+OLLAMA_CONNECTOR_LIMIT = 20        # 同時開啟的連線上限
+OLLAMA_KEEPALIVE_SECONDS = 60      # 閒置連線保留秒數
+
+# 各模型的起始並行數（之後由 AIMD 依延遲與錯誤率自動調整，最多 MAX_CONCURRENCY）
+OLLAMA_INITIAL_CONCURRENCY = {"phi3:mini": 6, "mistral": 3}
+OLLAMA_DEFAULT_CONCURRENCY = 4
+OLLAMA_TIMEOUT_SECONDS = 120
+OLLAMA_BREAKER_FAILURES = 5        # 連續失敗幾次後暫停呼叫
+OLLAMA_BREAKER_RESET_SECONDS = 30  # 暫停多久後放行一個探測請求
+
+_ollama_loop = None
+_ollama_session = None
+_ollama_loop_lock = threading.Lock()
+_ollama_limiters = {}
+_ollama_breakers = {}
+
+
+def _get_ollama_loop():
+    global _ollama_loop
+    with _ollama_loop_lock:
+        if _ollama_loop is None or _ollama_loop.is_closed():
+            _ollama_loop = asyncio.new_event_loop()
+            threading.Thread(target=_ollama_loop.run_forever, name="ollama-io", daemon=True).start()
+        return _ollama_loop
+
+
+async def _get_ollama_session():
+    # 只會在 Ollama 專用 loop 上呼叫，因此 session 永遠綁定同一個 loop
+    global _ollama_session
+    if _ollama_session is None or _ollama_session.closed:
+        connector = aiohttp.TCPConnector(limit=OLLAMA_CONNECTOR_LIMIT, keepalive_timeout=OLLAMA_KEEPALIVE_SECONDS)
+        _ollama_session = aiohttp.ClientSession(connector=connector, headers={"Content-Type": "application/json"})
+    return _ollama_session
+
+
+def get_ollama_limiter(model):
+    # 每個模型各自一個限流器；phi3 與 mistral 的吞吐差很多，不共用上限
+    limiter = _ollama_limiters.get(model)
+    if limiter is None:
+        initial = OLLAMA_INITIAL_CONCURRENCY.get(model, OLLAMA_DEFAULT_CONCURRENCY)
+        limiter = _ollama_limiters[model] = AdaptiveLimiter(model, initial=initial, max_limit=MAX_CONCURRENCY)
+    return limiter
+
+
+def get_ollama_breaker(model):
+    breaker = _ollama_breakers.get(model)
+    if breaker is None:
+        breaker = _ollama_breakers[model] = CircuitBreaker(
+            model, failure_threshold=OLLAMA_BREAKER_FAILURES, reset_timeout=OLLAMA_BREAKER_RESET_SECONDS)
+    return breaker
+
+
+def ollama_limiter_stats():
+    return {model: limiter.stats() for model, limiter in _ollama_limiters.items()}
+
+
+async def _post_ollama_generate(payload, timeout):
+    # 斷路器與限流器都只在 Ollama 專用 loop 上操作，所有分析請求共用同一組狀態
+    breaker = get_ollama_breaker(payload["model"])
+    if not breaker.allow():
+        raise CircuitOpenError(f"{payload['model']} 暫停呼叫中")
+    limiter = get_ollama_limiter(payload["model"])
+    started_at = await limiter.acquire()
+    ok, units = False, payload["options"]["num_predict"]
+    try:
+        session = await _get_ollama_session()
+        async with session.post(OLLAMA_URL, json=payload, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+            response.raise_for_status()
+            result = await response.json()
+        ok = True
+        units = result.get("eval_count") or units
+        breaker.record_success()
+        return result.get("response", "").strip()
+    except asyncio.CancelledError:
+        ok = None  # 呼叫端取消，不代表 Ollama 壅塞
+        breaker.cancel_probe()
+        raise
+    except Exception:
+        breaker.record_failure()
+        raise
+    finally:
+        await limiter.release(started_at, ok, units)
+
+
+def close_ollama_session():
+    """關閉共用連線池（程式結束前呼叫）。"""
+    if _ollama_loop is None or _ollama_session is None or _ollama_session.closed:
+        return
+    asyncio.run_coroutine_threadsafe(_ollama_session.close(), _ollama_loop).result(timeout=10)
+
+
+atexit.register(close_ollama_session)
+
 
 # 🔧 非同步呼叫本地 Ollama API
-async def call_ollama_model_async(prompt, model="phi3:mini", timeout=120):
-    async with semaphore:
-        url = "http://localhost:11434/api/generate"
-        headers = {"Content-Type": "application/json"}
-
-        payload = {
-            "model": model,
-            "prompt": prompt,
-            "stream": False,
-            "options": {
-                "num_predict": 50,
-                "temperature": 0.5
-            }
+async def call_ollama_model_async(prompt, model="phi3:mini", timeout=OLLAMA_TIMEOUT_SECONDS, num_predict=50):
+    payload = {
+        "model": model,
+        "prompt": prompt,
+        "stream": False,
+        "options": {
+            "num_predict": num_predict,
+            "temperature": 0.5
         }
+    }
 
-        async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
-            async with session.post(url, json=payload, headers=headers) as response:
-                response.raise_for_status()
-                result = await response.json()
-                return result.get("response", "").strip()
+    # 交給共用連線池所在的 loop 送出（並行數也在那裡控制），呼叫端的 loop 只負責等待結果
+    future = asyncio.run_coroutine_threadsafe(_post_ollama_generate(payload, timeout), _get_ollama_loop())
+    return await asyncio.wrap_future(future)
@@ -0,0 +1,267 @@
+import json
+import os
+import queue
+import threading
+import time
+import uuid
+from datetime import datetime
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+PROGRESS_FLUSH_SECONDS = 1.0   # 進度寫回磁碟的最短間隔
+JOB_POLL_SECONDS = 1.0         # 行程池 worker 沒有工作時，多久再掃一次 jobs/
+
+
+class JobCancelled(Exception):
+    """工作被使用者取消；由進度回呼丟出，中止正在執行的分析。"""
+
+
+class JobStore:
+    """
+    每個工作存成 jobs/{job_id}.json（先寫暫存檔再 os.replace），
+    程式重啟後可由 load_all() 找回排隊中/執行到一半的工作。
+    多個行程共用同一個資料夾時，以 {job_id}.claim 搶工作、{job_id}.cancel 傳遞取消。
+    """
+
+    def __init__(self, root="jobs"):
+        self.root = root
+        self.lock = threading.Lock()
+        os.makedirs(root, exist_ok=True)
+
+    def _path(self, job_id):
+        return os.path.join(self.root, f"{job_id}.json")
+
+    def _marker(self, job_id, kind):
+        return os.path.join(self.root, f"{job_id}.{kind}")
+
+    def save(self, job):
+        path = self._path(job["id"])
+        tmp_path = f"{path}.{os.getpid()}.tmp"  # 各行程各用暫存檔，避免互相覆蓋
+        with self.lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(job, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+
+    def load(self, job_id):
+        try:
+            with open(self._path(job_id), "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    def load_all(self):
+        jobs = []
+        for name in os.listdir(self.root):
+            if name.endswith(".json"):
+                job = self.load(name[:-5])
+                if job:
+                    jobs.append(job)
+        return sorted(jobs, key=lambda j: j["created"])
+
+    def claim(self, job_id):
+        """以 O_CREAT | O_EXCL 建立 claim 檔，多個行程同時搶時只有一個會成功。"""
+        try:
+            fd = os.open(self._marker(job_id, "claim"), os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+        except FileExistsError:
+            return False
+        os.write(fd, str(os.getpid()).encode("ascii"))
+        os.close(fd)
+        return True
+
+    def release(self, job_id, kinds=("claim", "cancel")):
+        for kind in kinds:
+            try:
+                os.remove(self._marker(job_id, kind))
+            except FileNotFoundError:
+                pass
+
+    def request_cancel(self, job_id):
+        with open(self._marker(job_id, "cancel"), "w", encoding="utf-8") as f:
+            f.write(datetime.now().isoformat())
+
+    def cancel_requested(self, job_id):
+        return os.path.exists(self._marker(job_id, "cancel"))
+
+    def reset_claims(self):
+        """行程池啟動前呼叫（此時沒有任何 worker）：清掉殘留的 claim，執行到一半的工作改回排隊。"""
+        for name in os.listdir(self.root):
+            if name.endswith(".claim"):
+                os.remove(os.path.join(self.root, name))
+        for job in self.load_all():
+            if job["status"] == "running":
+                logger.info("🔁 [Job] 恢復未完成的工作：%s", job['id'])
+                job["status"] = "queued"
+                self.save(job)
+
+
+class JobQueue:
+    """
+    背景分析工作佇列：submit() 立刻回傳 job id，由 workers 個執行緒依序呼叫 runner(job, on_event)。
+    runner 透過 on_event 回報 {'type': 'progress', ...} 與批次擷取階段的 {'type': 'batch', ...}；
+    取消時 on_event 會丟出 JobCancelled。
+    workers=0 時本行程只排工作，由其他行程的 serve_shared()（analysis_worker.py）執行，狀態一律讀 store。
+    """
+
+    def __init__(self, store, runner, workers=2):
+        self.store = store
+        self.runner = runner
+        self.workers = workers
+        self.pending = queue.Queue()
+        self.jobs = {}
+        self.cancelled = set()
+        self.lock = threading.Lock()
+        self.started = False
+        self.local = workers > 0
+
+    def start(self):
+        # Analysis.py 啟動時（reloader 子行程）呼叫；其餘入口也會先呼叫，確保重啟後未完成的工作會恢復
+        with self.lock:
+            if self.started:
+                return
+            self.started = True
+            if not self.local:
+                logger.info("📮 [Job] 本行程只排工作，交由分析行程池執行")
+                return
+            for job in self.store.load_all():
+                self.jobs[job["id"]] = job
+                if job["status"] in ("queued", "running"):
+                    logger.info("🔁 [Job] 恢復未完成的工作：%s", job['id'])
+                    job["status"] = "queued"
+                    self.store.save(job)
+                    # 上次執行中斷時留下的 claim；與行程池共用 jobs/ 時本行程須以 ANALYSIS_JOB_WORKERS=0 啟動
+                    self.store.release(job["id"], kinds=("claim",))
+                    self.pending.put(job["id"])
+        for i in range(self.workers):
+            threading.Thread(target=self._worker, name=f"analysis-worker-{i}", daemon=True).start()
+        logger.info("🧵 [Job] 已啟動 %d 個分析 worker", self.workers)
+
+    def submit(self, params, uid):
+        self.start()
+        job = {
+            "id": uuid.uuid4().hex[:12],
+            "uid": uid,
+            "status": "queued",
+            "params": params,
+            "progress": {"done": 0, "total": None, "eta": None},
+            "created": datetime.now().isoformat(),
+            "started": None,
+            "finished": None,
+            "error": None,
+        }
+        with self.lock:
+            self.jobs[job["id"]] = job
+        self.store.save(job)
+        self.pending.put(job["id"])
+        logger.info("📥 [Job] 已排入工作 %s（%s）", job['id'], uid)
+        return job
+
+    def get(self, job_id):
+        self.start()
+        if not self.local:
+            return self.store.load(job_id)
+        with self.lock:
+            job = self.jobs.get(job_id)
+            return dict(job) if job else self.store.load(job_id)
+
+    def list(self):
+        self.start()
+        if not self.local:
+            return self.store.load_all()
+        with self.lock:
+            return [dict(job) for job in self.jobs.values()]
+
+    def cancel(self, job_id):
+        """回傳取消後的工作；已結束的工作不受影響。"""
+        self.start()
+        with self.lock:
+            job = self.jobs.get(job_id) if self.local else self.store.load(job_id)
+            if not job or job["status"] not in ("queued", "running"):
+                return job
+            self.cancelled.add(job_id)
+            self.store.request_cancel(job_id)
+            # 排隊中的工作：先搶下 claim 再標記取消，其他行程就不會再拿去執行
+            if job["status"] == "queued" and self.store.claim(job_id):
+                self._finish(job, "cancelled")
+        logger.info("🛑 [Job] 已要求取消工作 %s", job_id)
+        return job
+
+    def _finish(self, job, status, error=None):
+        job["status"] = status
+        job["error"] = error
+        job["finished"] = datetime.now().isoformat()
+        self.store.save(job)
+        self.store.release(job["id"])
+
+    def _worker(self):
+        while True:
+            job_id = self.pending.get()
+            with self.lock:
+                job = self.jobs.get(job_id)
+                if not job or job["status"] != "queued":
+                    continue
+                # 與 serve_shared 一樣先搶 claim，同一個工作不會被本行程與其他行程各跑一次
+                if not self.store.claim(job_id):
+                    logger.info("⏭️ [Job] 工作 %s 已由其他行程執行，略過", job_id)
+                    continue
+                job["status"] = "running"
+                job["started"] = datetime.now().isoformat()
+            self._run(job)
+
+    def serve_shared(self, poll_seconds=JOB_POLL_SECONDS):
+        """行程池模式：輪詢共用的 jobs/，搶到 claim 的排隊工作就在本行程執行（不會返回）。"""
+        logger.info("🧵 [Job] 分析行程 %d 開始輪詢 %s", os.getpid(), self.store.root)
+        while True:
+            job = None
+            for candidate in self.store.load_all():
+                if candidate["status"] == "queued" and self.store.claim(candidate["id"]):
+                    job = self.store.load(candidate["id"])  # 搶到後重讀，確認期間沒有被取消
+                    if job and job["status"] == "queued":
+                        break
+                    job = None
+            if job is None:
+                time.sleep(poll_seconds)
+                continue
+            with self.lock:
+                job["status"] = "running"
+                job["started"] = datetime.now().isoformat()
+                self.jobs[job["id"]] = job
+            self._run(job)
+
+    def _run(self, job):
+        job_id = job["id"]
+        self.store.save(job)
+        logger.info("▶️ [Job] 開始執行 %s", job_id)
+        last_flush = [0.0]
+
+        def on_event(event):
+            if job_id in self.cancelled:
+                raise JobCancelled(job_id)
+            if event.get("type") not in ("progress", "batch"):
+                return
+            # 批次擷取階段還沒有任何一列完成，靠每批完成的 batch 事件檢查取消
+            final = event["type"] == "progress" and event["done"] == event["total"]
+            if event["type"] == "progress":
+                job["progress"] = {"done": event["done"], "total": event["total"], "eta": event["eta"]}
+            now = time.time()
+            if now - last_flush[0] >= PROGRESS_FLUSH_SECONDS or final:
+                last_flush[0] = now
+                # 其他行程的取消以標記檔傳遞，跟著進度存檔的頻率檢查即可
+                if self.store.cancel_requested(job_id):
+                    raise JobCancelled(job_id)
+                self.store.save(job)
+
+        try:
+            self.runner(job, on_event)
+            with self.lock:
+                self._finish(job, "done")
+            logger.info("✅ [Job] 工作完成 %s", job_id)
+        except JobCancelled:
+            with self.lock:
+                self._finish(job, "cancelled")
+            logger.info("🛑 [Job] 工作已取消 %s", job_id)
+        except Exception as e:
+            logger.exception("❌ [Job] 工作失敗 %s：%s", job_id, e)
+            with self.lock:
+                self._finish(job, "failed", str(e))
@@ -0,0 +1,157 @@
+import os
+import time
+
+import faiss
+import numpy as np
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 知識庫索引類型：flat（精確搜尋）/ flat_fp16（float16 儲存，記憶體減半）/ ivf_flat / ivf_pq / hnsw；
+# 可用環境變數 KB_INDEX_TYPE 指定。所有索引都以內積比對 L2 正規化後的向量，分數即 cosine 相似度
+KB_INDEX_TYPES = ("flat", "flat_fp16", "ivf_flat", "ivf_pq", "hnsw")
+KB_METRIC = faiss.METRIC_INNER_PRODUCT
+KB_INDEX_TYPE = os.environ.get("KB_INDEX_TYPE", "flat").lower()
+KB_ANN_MIN_VECTORS = int(os.environ.get("KB_ANN_MIN_VECTORS", "20000"))  # 筆數未達此值時一律用 flat
+KB_ANN_RETRAIN_FACTOR = 4      # 資料量成長到訓練時的幾倍就重新訓練 IVF 分群
+KB_IVF_MIN_POINTS_PER_LIST = 39  # faiss 建議每個分群至少 39 筆訓練資料
+KB_PQ_SUBQUANTIZERS = 16       # IVF-PQ 子向量數（需整除向量維度）
+KB_PQ_BITS = 8
+KB_HNSW_M = 32
+KB_HNSW_EF_CONSTRUCTION = 40
+KB_DEFAULT_NPROBE = int(os.environ.get("KB_NPROBE", "16"))
+KB_DEFAULT_EF_SEARCH = int(os.environ.get("KB_EF_SEARCH", "64"))
+KB_MIN_SCORE = float(os.environ.get("KB_MIN_SCORE", "0.35"))  # cosine 低於此值的檢索結果視為不相關
+
+
+def normalize(vectors):
+    """回傳 L2 正規化後的 float32 副本（不改動傳入的陣列），內積即 cosine 相似度。"""
+    vectors = np.array(vectors, dtype=np.float32, order="C")
+    if vectors.ndim == 1:
+        vectors = vectors.reshape(1, -1)
+    if len(vectors):
+        faiss.normalize_L2(vectors)
+    return vectors
+
+
+def choose_index_type(ntotal, requested=KB_INDEX_TYPE):
+    """資料量太小時近似索引不划算（也訓練不起來），退回 flat。"""
+    if requested not in KB_INDEX_TYPES:
+        logger.warning("⚠️ 未知的 KB_INDEX_TYPE=%s，改用 flat", requested)
+        return "flat"
+    if requested not in ("flat", "flat_fp16") and ntotal < KB_ANN_MIN_VECTORS:
+        return "flat"
+    return requested
+
+
+def ivf_nlist(ntotal):
+    # 常用經驗值 4·√N，並確保每個分群有足夠的訓練資料
+    return max(1, min(int(4 * np.sqrt(ntotal)), ntotal // KB_IVF_MIN_POINTS_PER_LIST))
+
+
+def index_type_of(index):
+    inner = faiss.downcast_index(index.index) if hasattr(index, "id_map") else index
+    if isinstance(inner, faiss.IndexIVFPQ):
+        return "ivf_pq"
+    if isinstance(inner, faiss.IndexIVFFlat):
+        return "ivf_flat"
+    if isinstance(inner, faiss.IndexHNSWFlat):
+        return "hnsw"
+    if isinstance(inner, faiss.IndexScalarQuantizer):
+        return "flat_fp16"
+    return "flat"
+
+
+def is_cosine_index(index):
+    # 舊版知識庫是 L2 距離、未正規化向量，距離無法換算成相似度
+    return index.metric_type == KB_METRIC
+
+
+def supports_remove(index):
+    # HNSW 圖不支援刪除節點（追加沒問題），有內容變動時需要用剩下的向量重建
+    return index_type_of(index) != "hnsw"
+
+
+def index_vectors(index):
+    """取出索引內所有 (向量 id, 向量)，用於換索引類型或重建 HNSW，不必重新編碼。"""
+    if index.ntotal == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros((0, index.d), dtype=np.float32)
+    if hasattr(index, "id_map"):
+        ids = faiss.vector_to_array(index.id_map).astype(np.int64)
+        vectors = faiss.downcast_index(index.index).reconstruct_n(0, index.ntotal)
+        return ids, vectors
+    # IVF 索引自己保存 id（不一定連續），用 Hashtable 型的 direct map 依 id 還原向量
+    invlists = index.invlists
+    ids = np.concatenate([
+        faiss.rev_swig_ptr(invlists.get_ids(i), invlists.list_size(i)).copy()
+        for i in range(index.nlist) if invlists.list_size(i) > 0
+    ]).astype(np.int64)
+    index.set_direct_map_type(faiss.DirectMap.Hashtable)
+    return ids, index.reconstruct_batch(ids)
+
+
+def create_index(ids, vectors, index_type):
+    """建立指定類型的索引並加入向量（先做 L2 正規化）；IVF / PQ 以目前全部向量訓練。"""
+    vectors = normalize(vectors)
+    dim = vectors.shape[1]
+    t0 = time.time()
+    if index_type in ("ivf_flat", "ivf_pq"):
+        nlist = ivf_nlist(len(vectors))
+        quantizer = faiss.IndexFlatIP(dim)
+        if index_type == "ivf_pq":
+            index = faiss.IndexIVFPQ(quantizer, dim, nlist, KB_PQ_SUBQUANTIZERS, KB_PQ_BITS, KB_METRIC)
+        else:
+            index = faiss.IndexIVFFlat(quantizer, dim, nlist, KB_METRIC)
+        index.train(vectors)
+        index.nprobe = KB_DEFAULT_NPROBE
+        index.add_with_ids(vectors, ids)   # IVF 自帶 id，支援 add_with_ids / remove_ids
+        logger.info("🧭 已訓練 %s（nlist=%d，%d 筆），用時 %.2f 秒", index_type, nlist, len(vectors), time.time() - t0)
+        return index
+    if index_type == "hnsw":
+        inner = faiss.IndexHNSWFlat(dim, KB_HNSW_M, KB_METRIC)
+        inner.hnsw.efConstruction = KB_HNSW_EF_CONSTRUCTION
+        inner.hnsw.efSearch = KB_DEFAULT_EF_SEARCH
+        index = faiss.IndexIDMap2(inner)
+    elif index_type == "flat_fp16":
+        index = faiss.IndexIDMap(faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_fp16, KB_METRIC))
+    else:
+        index = faiss.IndexIDMap(faiss.IndexFlatIP(dim))
+    if len(vectors):
+        index.add_with_ids(vectors, ids)
+    logger.info("🧭 已建立 %s 索引（%d 筆），用時 %.2f 秒", index_type, len(vectors), time.time() - t0)
+    return index
+
+
+def needs_rebuild(index, index_info, requested=KB_INDEX_TYPE):
+    """舊版 L2 索引、索引類型與應有類型不同，或 IVF 資料量已成長到需要重新訓練時回傳 True。"""
+    ntotal = index.ntotal
+    if not is_cosine_index(index) or index_type_of(index) != choose_index_type(ntotal, requested):
+        return True
+    trained_on = (index_info or {}).get("trainedOn")
+    return index_type_of(index).startswith("ivf") and bool(trained_on) and ntotal >= trained_on * KB_ANN_RETRAIN_FACTOR
+
+
+def search_params(index, nprobe=None, ef_search=None):
+    """
+    依索引類型回傳單次查詢用的 SearchParameters（不改動共用索引的設定，多執行緒查詢互不影響）；
+    flat 索引回傳 None（直接用 index.search）。
+    """
+    index_type = index_type_of(index)
+    if index_type.startswith("ivf"):
+        return faiss.SearchParametersIVF(nprobe=nprobe or KB_DEFAULT_NPROBE)
+    if index_type == "hnsw":
+        return faiss.SearchParametersHNSW(efSearch=ef_search or KB_DEFAULT_EF_SEARCH)
+    return None
+
+
+def search(index, query_vectors, top_k, nprobe=None, ef_search=None):
+    """回傳 (D, I)；cosine 索引的 D 為相似度（越大越相近），舊版 L2 索引為距離。"""
+    params = search_params(index, nprobe, ef_search)
+    if is_cosine_index(index):
+        query_vectors = normalize(query_vectors)
+    else:
+        query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+    if params is None:
+        return index.search(query_vectors, top_k)
+    return index.search(query_vectors, top_k, params=params)
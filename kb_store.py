@@ -0,0 +1,191 @@
+import hashlib
+import os
+import pickle
+import sqlite3
+from contextlib import closing
+
+import numpy as np
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 知識庫的文字與 metadata 都在 SQLite（metadata 表），向量另存成可 memmap 的 float32 檔（第 vid 列即向量 id = vid）
+KB_DB = "resultDB.db"
+KB_VECTORS = "kb_vectors.f32"
+KB_COLUMNS = ["id", "text", "subcategory", "configurationItem", "roleComponent", "location", "opened",
+              "analysisTime", "vid", "textHash"]
+# 可用來篩選的欄位（也是 LLM 產生的 SQL 最常篩選 / 分組的欄位），皆建有索引
+KB_FILTER_COLUMNS = ["subcategory", "configurationItem", "roleComponent", "location", "analysisTime"]
+KB_FETCH_CHUNK = 500   # 單一 IN (...) 查詢最多帶幾個參數（SQLite 參數上限為 999）
+
+
+def text_hash(text):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()
+
+
+class KBStore:
+    """
+    知識庫儲存層：文字 / metadata 只在需要時依 vid 或條件查詢，不整份載入記憶體；
+    向量檔以 np.memmap 讀取，重建索引時才會用到。每次查詢各自開連線，可多執行緒同時使用。
+    """
+
+    def __init__(self, db_path=KB_DB, vectors_path=KB_VECTORS):
+        self.db_path = db_path
+        self.vectors_path = vectors_path
+
+    def connect(self):
+        conn = sqlite3.connect(self.db_path)
+        # WAL：寫入時查詢不會被鎖住；synchronous=NORMAL 在 WAL 下仍可保證不損毀
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        return conn
+
+    def migrate(self, conn):
+        """建表、補上 vid / textHash 欄位與次要索引；重複執行不會有影響。"""
+        conn.execute("""
+                CREATE TABLE IF NOT EXISTS metadata (
+                    internalId INTEGER PRIMARY KEY AUTOINCREMENT,
+                    id TEXT UNIQUE,
+                    text TEXT,
+                    subcategory TEXT,
+                    configurationItem TEXT,
+                    roleComponent TEXT,
+                    location TEXT,
+                    opened TEXT,
+                    analysisTime TEXT
+                )
+        """)
+        existing = {row[1] for row in conn.execute("PRAGMA table_info(metadata)")}
+        if "vid" not in existing:
+            conn.execute("ALTER TABLE metadata ADD COLUMN vid INTEGER")
+        if "textHash" not in existing:
+            conn.execute("ALTER TABLE metadata ADD COLUMN textHash TEXT")
+        conn.execute("CREATE UNIQUE INDEX IF NOT EXISTS idx_metadata_vid ON metadata (vid)")
+        for column in KB_FILTER_COLUMNS:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS idx_metadata_{column} ON metadata ({column})")
+
+    # ---------- 寫入（build_kb） ----------
+
+    def upsert(self, items):
+        """以 id 做 upsert（保留原本的 internalId）；內容完全相同的列不會被改寫。回傳實際寫入筆數。"""
+        updates = ", ".join(f"{c} = excluded.{c}" for c in KB_COLUMNS[1:])
+        changed = " OR ".join(f"metadata.{c} IS NOT excluded.{c}" for c in KB_COLUMNS[1:])
+        sql = f"""
+            INSERT INTO metadata ({", ".join(KB_COLUMNS)})
+            VALUES ({", ".join("?" for _ in KB_COLUMNS)})
+            ON CONFLICT(id) DO UPDATE SET {updates}
+            WHERE {changed}
+        """
+        rows = [tuple(item.get(c) for c in KB_COLUMNS) for item in items]
+        with closing(self.connect()) as conn:
+            with conn:  # 單一交易：全部成功才 commit
+                self.migrate(conn)
+                # 重新配號時舊 vid 可能暫時重複，先清掉這批列中 vid 有變的
+                conn.executemany("UPDATE metadata SET vid = NULL WHERE id = ? AND vid IS NOT ?",
+                                 [(item.get("id"), item.get("vid")) for item in items])
+                before = conn.total_changes
+                conn.executemany(sql, rows)
+                return conn.total_changes - before
+
+    def lookup(self, ids):
+        """回傳 {id: (vid, textHash)}，只查這批 id。"""
+        result = {}
+        ids = list(ids)
+        with closing(self.connect()) as conn:
+            self.migrate(conn)
+            for start in range(0, len(ids), KB_FETCH_CHUNK):
+                chunk = ids[start:start + KB_FETCH_CHUNK]
+                placeholders = ",".join("?" for _ in chunk)
+                for uid, vid, digest in conn.execute(
+                        f"SELECT id, vid, textHash FROM metadata WHERE id IN ({placeholders})", chunk):
+                    result[uid] = (vid, digest)
+        return result
+
+    def all_items(self):
+        """舊版知識庫轉換用：取出全部列（一次性）。"""
+        with closing(self.connect()) as conn:
+            self.migrate(conn)
+            conn.row_factory = sqlite3.Row
+            return [dict(row) for row in conn.execute(
+                f"SELECT {', '.join(KB_COLUMNS)} FROM metadata WHERE id IS NOT NULL AND id != '未提供'")]
+
+    def max_vid(self):
+        """尚未轉換（沒有 vid 欄位）或沒有資料時回傳 None；唯讀，不會改動資料庫。"""
+        if not os.path.exists(self.db_path):
+            return None
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            try:
+                return conn.execute("SELECT MAX(vid) FROM metadata").fetchone()[0]
+            except sqlite3.OperationalError:
+                return None
+
+    def indexed_vids(self):
+        with closing(self.connect()) as conn:
+            return np.array([row[0] for row in conn.execute(
+                "SELECT vid FROM metadata WHERE vid IS NOT NULL ORDER BY vid")], dtype=np.int64)
+
+    def write_vectors(self, vids, vectors, reset=False):
+        """把向量寫到第 vid 列（原地覆寫變動的列，新 vid 接在檔尾）。"""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        mode = "wb" if reset or not os.path.exists(self.vectors_path) else "r+b"
+        row_bytes = vectors.shape[1] * 4
+        with open(self.vectors_path, mode) as f:
+            for vid, vector in zip(vids, vectors):
+                f.seek(int(vid) * row_bytes)
+                f.write(vector.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+
+    def vectors(self, dim):
+        """以 memmap 開啟向量檔（唯讀），只有實際存取的列才會讀進記憶體。"""
+        if not os.path.exists(self.vectors_path):
+            return np.zeros((0, dim), dtype=np.float32)
+        rows = os.path.getsize(self.vectors_path) // (dim * 4)
+        if rows == 0:
+            return np.zeros((0, dim), dtype=np.float32)
+        return np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, dim))
+
+    # ---------- 讀取（gptChat） ----------
+
+    def fetch_texts(self, vids):
+        """依 vid 取文字，回傳 {vid: text}；查不到的 vid 不會出現在結果中。"""
+        vids = [int(v) for v in vids if v >= 0]
+        if not vids:
+            return {}
+        placeholders = ",".join("?" for _ in vids)
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            return dict(conn.execute(f"SELECT vid, text FROM metadata WHERE vid IN ({placeholders})", vids))
+
+    def filter(self, filters, limit=5):
+        """
+        以 SQL（走欄位索引）篩選 metadata；filters 為 [{"field": ..., "value": ...}, ...]，條件以 AND 串接。
+        回傳 (符合筆數, 前 limit 筆的文字)。欄位必須在 KB_FILTER_COLUMNS 內。
+        """
+        clauses, params = [], []
+        for f in filters:
+            if f.get("field") not in KB_FILTER_COLUMNS:
+                raise ValueError(f"不支援的篩選欄位：{f.get('field')}")
+            clauses.append(f"{f['field']} = ?")
+            params.append(f.get("value"))
+        where = " AND ".join(clauses) or "1"
+        with closing(sqlite3.connect(self.db_path)) as conn:
+            count = conn.execute(f"SELECT COUNT(*) FROM metadata WHERE {where}", params).fetchone()[0]
+            texts = [row[0] for row in conn.execute(
+                f"SELECT text FROM metadata WHERE {where} ORDER BY internalId LIMIT ?", params + [limit])]
+        return count, texts
+
+    def has_vectors(self):
+        return os.path.exists(self.vectors_path) and self.max_vid() is not None
+
+
+class LegacyTextStore:
+    """尚未轉換的舊版知識庫（kb_texts.pkl，向量 id 即清單位置）；下一次 build_kb 會轉成 KBStore。"""
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            texts = pickle.load(f)
+        self.texts = dict(enumerate(texts)) if isinstance(texts, list) else texts
+
+    def fetch_texts(self, vids):
+        return {int(v): self.texts[int(v)] for v in vids if int(v) in self.texts}
@@ -0,0 +1,83 @@
+import atexit
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+
+# 可用環境變數調整：LOG_LEVEL=DEBUG 看逐列細節；LOG_FILE=logs/analysis.log 另存檔案
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FILE = os.environ.get("LOG_FILE")
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(name)s] %(message)s"
+LOG_SAMPLE_BURST = 5          # 每種逐列訊息先完整輸出前幾筆
+LOG_SAMPLE_EVERY = int(os.environ.get("LOG_SAMPLE_EVERY", "100"))  # 之後每 N 筆輸出一筆
+
+# 逐列訊息加上 extra=SAMPLED 即受取樣限制
+SAMPLED = {"sampled": True}
+
+_listener = None
+_setup_lock = threading.Lock()
+
+
+class SamplingFilter(logging.Filter):
+    """
+    只作用於帶 sampled=True 的紀錄：同一個 logger + 訊息樣板先放行 LOG_SAMPLE_BURST 筆，之後每 every 筆放行一筆。
+    訊息需用 %-style 參數（logger.info("... %s", x)），樣板才會相同。
+    """
+
+    def __init__(self, burst=LOG_SAMPLE_BURST, every=LOG_SAMPLE_EVERY):
+        super().__init__()
+        self.burst = burst
+        self.every = max(every, 1)
+        self.counts = {}
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        if not getattr(record, "sampled", False):
+            return True
+        key = (record.name, record.msg)
+        with self.lock:
+            count = self.counts.get(key, 0) + 1
+            self.counts[key] = count
+        if count <= self.burst:
+            return True
+        return (count - self.burst) % self.every == 0
+
+
+def setup_logging(level=LOG_LEVEL):
+    """
+    設定根 logger：所有紀錄先進 QueueHandler（呼叫端只做入列），
+    由 QueueListener 背景執行緒寫到 console / 檔案，避免 Windows console 的 I/O 拖慢分析。
+    重複呼叫不會重複加 handler。
+    """
+    global _listener
+    with _setup_lock:
+        if _listener is not None:
+            return
+        formatter = logging.Formatter(LOG_FORMAT)
+        console = logging.StreamHandler(sys.stdout)
+        console.setFormatter(formatter)
+        handlers = [console]
+        if LOG_FILE:
+            os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+            file_handler = logging.handlers.RotatingFileHandler(
+                LOG_FILE, maxBytes=10 * 1024 * 1024, backupCount=5, encoding="utf-8")
+            file_handler.setFormatter(formatter)
+            handlers.append(file_handler)
+
+        log_queue = queue.Queue(-1)
+        queue_handler = logging.handlers.QueueHandler(log_queue)
+        queue_handler.addFilter(SamplingFilter())
+        root = logging.getLogger()
+        root.addHandler(queue_handler)
+        root.setLevel(level)
+
+        _listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+        _listener.start()
+        atexit.register(_listener.stop)
+
+
+def get_logger(name):
+    setup_logging()
+    return logging.getLogger(name)
@@ -0,0 +1,237 @@
+import os
+import queue
+import sys
+import threading
+import time
+from multiprocessing.connection import Client, Listener
+
+import numpy as np
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+# 設定 MODEL_SERVER_ADDRESS（例如 127.0.0.1:6010）後，各行程改向模型伺服器要向量，不再各自載入模型
+MODEL_SERVER_ADDRESS = os.environ.get("MODEL_SERVER_ADDRESS")
+# 連線會 unpickle 收到的資料，authkey 等同執行權限：沒有預設值，必須由環境變數提供
+# （analysis_worker.py 未設定時會產生隨機金鑰傳給子行程）
+MODEL_SERVER_AUTHKEY = os.environ.get("MODEL_SERVER_AUTHKEY", "").encode("utf-8")
+INSECURE_AUTHKEYS = {b"", b"analysis-model-server"}  # 空值與舊版寫死的預設值
+MODEL_SERVER_MODELS = ["paraphrase-MiniLM-L6-v2", "all-MiniLM-L6-v2"]  # 伺服器啟動時載入的模型
+MODEL_SERVER_BATCH_WAIT_MS = 5       # 收到第一個請求後，最多再等幾毫秒合併其他行程的請求
+MODEL_SERVER_MAX_BATCH_TEXTS = 512   # 一次合併編碼的句子上限
+MODEL_SERVER_ENCODE_BATCH_SIZE = 64  # 傳給 SentenceTransformer.encode 的 batch_size
+MODEL_SERVER_BACKLOG = 64            # 多個 worker 同時連線時的等待佇列長度（Listener 預設只有 1）
+
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    return (host or "127.0.0.1", int(port))
+
+
+def require_authkey(authkey):
+    if authkey in INSECURE_AUTHKEYS:
+        raise RuntimeError("MODEL_SERVER_AUTHKEY 未設定或仍是舊版預設值，請設定隨機金鑰（例如 python -c \"import secrets; print(secrets.token_hex(32))\"）")
+    return authkey
+
+
+def resolve_model_path(name):
+    """與 SmartScoring1.get_model_path 相同的找法：有本地 models/ 資料夾就用本地模型，否則用模型名稱下載。"""
+    base = getattr(sys, '_MEIPASS', os.path.abspath('.'))
+    for root in (base, os.path.abspath('.')):
+        path = os.path.join(root, 'models', name)
+        if os.path.exists(path):
+            return path
+    return name
+
+
+class ModelServer:
+    """
+    持有 SentenceTransformer 模型的單一行程。每條連線一個執行緒收請求，
+    每個模型一個編碼執行緒：把同一時間到達的請求合併成一批 encode，再依序切回各請求。
+    """
+
+    def __init__(self, address, authkey=MODEL_SERVER_AUTHKEY, model_names=MODEL_SERVER_MODELS):
+        self.address = address
+        self.authkey = authkey
+        self.model_names = list(model_names)
+        self.models = {}
+        self.queues = {}
+
+    def load_models(self):
+        from sentence_transformers import SentenceTransformer
+
+        for name in self.model_names:
+            t0 = time.time()
+            self.models[name] = SentenceTransformer(resolve_model_path(name))
+            self.queues[name] = queue.Queue()
+            threading.Thread(target=self._encode_loop, args=(name,), name=f"encode-{name}", daemon=True).start()
+            logger.info("📦 [ModelServer] 已載入 %s，用時：%.2f 秒", name, time.time() - t0)
+
+    def _encode_loop(self, name):
+        model = self.models[name]
+        pending = self.queues[name]
+        while True:
+            batch = [pending.get()]
+            size = len(batch[0][0])
+            deadline = time.time() + MODEL_SERVER_BATCH_WAIT_MS / 1000
+            while size < MODEL_SERVER_MAX_BATCH_TEXTS:
+                timeout = deadline - time.time()
+                if timeout <= 0:
+                    break
+                try:
+                    item = pending.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                batch.append(item)
+                size += len(item[0])
+
+            texts = [t for item in batch for t in item[0]]
+            try:
+                embeddings = model.encode(texts, batch_size=MODEL_SERVER_ENCODE_BATCH_SIZE,
+                                          convert_to_numpy=True, show_progress_bar=False).astype(np.float32)
+                error = None
+            except Exception as e:
+                logger.exception("❌ [ModelServer] %s 編碼失敗：%s", name, e)
+                embeddings, error = None, str(e)
+            start = 0
+            for item_texts, reply in batch:
+                end = start + len(item_texts)
+                reply.put(("error", error) if error else ("ok", embeddings[start:end]))
+                start = end
+            logger.debug("🧮 [ModelServer] %s 合併 %d 個請求、%d 句", name, len(batch), len(texts))
+
+    def _handle(self, conn):
+        reply = queue.Queue(maxsize=1)
+        try:
+            while True:
+                try:
+                    op, name, payload = conn.recv()
+                except (EOFError, OSError):
+                    return
+                if name not in self.models:
+                    conn.send(("error", f"模型伺服器沒有載入 {name}"))
+                elif op == "info":
+                    model = self.models[name]
+                    conn.send(("ok", {"dimension": model.get_sentence_embedding_dimension()}))
+                elif op == "encode":
+                    self.queues[name].put((list(payload), reply))
+                    conn.send(reply.get())
+                else:
+                    conn.send(("error", f"未知的操作：{op}"))
+        finally:
+            conn.close()
+
+    def serve_forever(self):
+        require_authkey(self.authkey)
+        self.load_models()
+        with Listener(parse_address(self.address), backlog=MODEL_SERVER_BACKLOG, authkey=self.authkey) as listener:
+            logger.info("🚀 [ModelServer] 監聽 %s，模型：%s", self.address, ", ".join(self.model_names))
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # 驗證失敗等單一連線問題不影響伺服器
+                    logger.warning("⚠️ [ModelServer] 拒絕連線：%s", e)
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+
+class RemoteEncoder:
+    """
+    與 SentenceTransformer 介面相容的用戶端（encode / get_sentence_embedding_dimension / device），
+    實際編碼交給模型伺服器。每個執行緒各用一條連線，多執行緒同時呼叫不需加鎖。
+    """
+
+    device = "cpu"
+
+    def __init__(self, model_name, address=MODEL_SERVER_ADDRESS, authkey=MODEL_SERVER_AUTHKEY):
+        self.model_name = model_name
+        self.address = address
+        self.authkey = require_authkey(authkey)
+        self.local = threading.local()
+        self.dimension = None
+
+    def _request(self, op, payload=None):
+        for attempt in range(2):
+            conn = getattr(self.local, "conn", None)
+            if conn is None:
+                conn = self.local.conn = Client(parse_address(self.address), authkey=self.authkey)
+            try:
+                conn.send((op, self.model_name, payload))
+                status, result = conn.recv()
+                break
+            except (EOFError, OSError):
+                # 伺服器重啟後舊連線失效，重連一次
+                self.local.conn = None
+                if attempt:
+                    raise
+        if status != "ok":
+            raise RuntimeError(result)
+        return result
+
+    def get_sentence_embedding_dimension(self):
+        if self.dimension is None:
+            self.dimension = self._request("info")["dimension"]
+        return self.dimension
+
+    def encode(self, sentences, batch_size=32, show_progress_bar=None, convert_to_numpy=True,
+               convert_to_tensor=False, normalize_embeddings=False, **kwargs):
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        if texts:
+            embeddings = self._request("encode", texts)
+        else:
+            embeddings = np.zeros((0, self.get_sentence_embedding_dimension()), dtype=np.float32)
+        if normalize_embeddings and len(embeddings):
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.maximum(norms, 1e-12)
+        if single:
+            embeddings = embeddings[0]
+        if convert_to_tensor:
+            import torch
+            return torch.from_numpy(np.ascontiguousarray(embeddings))
+        return embeddings
+
+
+def wait_for_server(address, authkey=MODEL_SERVER_AUTHKEY, timeout=300):
+    """等模型伺服器可以連線（載入模型需要一段時間）；逾時回傳 False。"""
+    require_authkey(authkey)
+    deadline = time.time() + timeout
+    while True:
+        try:
+            Client(parse_address(address), authkey=authkey).close()
+            return True
+        except OSError:
+            if time.time() >= deadline:
+                return False
+            time.sleep(0.5)
+
+
+def get_encoder(model_name, local_loader):
+    """有設定 MODEL_SERVER_ADDRESS 時回傳 RemoteEncoder，否則呼叫 local_loader() 在本行程載入模型。"""
+    if MODEL_SERVER_ADDRESS:
+        logger.info("🔌 %s 改由模型伺服器 %s 提供", model_name, MODEL_SERVER_ADDRESS)
+        return RemoteEncoder(model_name)
+    return local_loader()
+
+
+def keybert_backend(encoder):
+    """KeyBERT 只接受 SentenceTransformer 或 BaseEmbedder；遠端模式時包一層 BaseEmbedder。"""
+    if not isinstance(encoder, RemoteEncoder):
+        return encoder
+    from keybert.backend import BaseEmbedder
+
+    class RemoteEmbedder(BaseEmbedder):
+        def __init__(self):
+            super().__init__()
+            self.embedding_model = encoder
+
+        def embed(self, documents, verbose=False):
+            return encoder.encode(documents)
+
+    return RemoteEmbedder()
+
+
+if __name__ == "__main__":
+    ModelServer(MODEL_SERVER_ADDRESS or "127.0.0.1:6010").serve_forever()
@@ -0,0 +1,191 @@
+import asyncio
+import contextvars
+import random
+import time
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+DECREASE_COOLDOWN_SECONDS = 2.0
+
+
+class AdaptiveLimiter:
+    """
+    Ollama 並行請求數的 AIMD 控制器：
+    - 成功且延遲正常：上限緩慢增加（每一輪約 +1）
+    - 失敗、逾時或延遲明顯變長：上限乘以 backoff_factor
+    延遲以「每個輸出 token 的秒數」計，與目前觀察到的最佳值（baseline）比較，批次與單筆呼叫可共用同一標準。
+    Condition 在第一次使用時才建立，綁定實際執行請求的 event loop。
+    """
+
+    def __init__(self, name, initial=4, min_limit=1, max_limit=10, latency_tolerance=2.0, backoff_factor=0.5):
+        self.name = name
+        self.limit = float(initial)
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.latency_tolerance = latency_tolerance
+        self.backoff_factor = backoff_factor
+        self.in_flight = 0
+        self.baseline = None          # 觀察到的最佳每 token 延遲
+        self.last_decrease = 0.0
+        self.successes = 0
+        self.failures = 0
+        self._loop = None
+        self._condition = None
+
+    def _get_condition(self):
+        loop = asyncio.get_running_loop()
+        if self._condition is None or self._loop is not loop:
+            self._loop = loop
+            self._condition = asyncio.Condition()
+        return self._condition
+
+    async def acquire(self):
+        condition = self._get_condition()
+        async with condition:
+            await condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+        return time.monotonic()
+
+    async def release(self, started_at, ok, units=1):
+        latency = time.monotonic() - started_at
+        if ok:
+            self._on_success(latency / max(units, 1))
+        elif ok is not None:
+            self._on_failure()
+        condition = self._get_condition()
+        async with condition:
+            self.in_flight -= 1
+            condition.notify_all()
+
+    def _decrease(self, reason):
+        # 同一波壅塞只降一次：同時回來的失敗/慢回應在冷卻時間內不重複降速
+        now = time.monotonic()
+        if now - self.last_decrease < DECREASE_COOLDOWN_SECONDS:
+            return
+        self.last_decrease = now
+        old = self.limit
+        self.limit = max(float(self.min_limit), self.limit * self.backoff_factor)
+        logger.warning("📉 [Limiter:%s] %s，並行上限 %.1f → %.1f", self.name, reason, old, self.limit)
+
+    def _on_success(self, latency_per_unit):
+        self.successes += 1
+        if self.baseline is None or latency_per_unit < self.baseline:
+            self.baseline = latency_per_unit
+        else:
+            # baseline 緩慢上修，避免一次很快的回應讓之後永遠判定為壅塞
+            self.baseline = self.baseline * 0.99 + latency_per_unit * 0.01
+        if latency_per_unit > self.baseline * self.latency_tolerance:
+            self._decrease(f"延遲升高（{latency_per_unit:.3f}s/token，baseline {self.baseline:.3f}）")
+        else:
+            self.limit = min(float(self.max_limit), self.limit + 1.0 / self.limit)
+
+    def _on_failure(self):
+        self.failures += 1
+        self._decrease("呼叫失敗")
+
+    def stats(self):
+        return {
+            "limit": round(self.limit, 2),
+            "inFlight": self.in_flight,
+            "successes": self.successes,
+            "failures": self.failures,
+            "baseline": self.baseline,
+        }
+
+
+class CircuitOpenError(Exception):
+    """斷路器開啟中：Ollama 近期連續失敗，直接拒絕呼叫。"""
+
+
+class CircuitBreaker:
+    """
+    連續失敗 failure_threshold 次即開啟，reset_timeout 秒內所有呼叫直接失敗；
+    之後放行一個探測請求（half-open），成功才恢復，失敗則再開啟一輪。
+    """
+
+    def __init__(self, name, failure_threshold=5, reset_timeout=30.0):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probe_in_flight = False
+
+    def allow(self):
+        if self.state == "closed":
+            return True
+        if self.state == "open" and time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self.probe_in_flight = False
+        if self.state == "half_open" and not self.probe_in_flight:
+            self.probe_in_flight = True
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != "closed":
+            logger.info("🟢 [Circuit:%s] 探測成功，恢復呼叫", self.name)
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.probe_in_flight = False
+
+    def cancel_probe(self):
+        # 探測請求被呼叫端取消：沒有結論，讓下一個請求接手探測
+        if self.state == "half_open":
+            self.probe_in_flight = False
+
+    def record_failure(self):
+        self.consecutive_failures += 1
+        if self.state == "half_open" or self.consecutive_failures >= self.failure_threshold:
+            if self.state != "open":
+                logger.error("🔴 [Circuit:%s] 連續失敗 %d 次，暫停呼叫 %.0f 秒", self.name, self.consecutive_failures, self.reset_timeout)
+            self.state = "open"
+            self.opened_at = time.monotonic()
+            self.probe_in_flight = False
+
+
+# 每次上傳分析的 LLM 時間預算（monotonic 截止時間）；由 start_retry_budget 設定，
+# 透過 contextvars 傳到同一次分析建立的所有 task
+_retry_deadline = contextvars.ContextVar("retry_deadline", default=None)
+
+
+def start_retry_budget(seconds):
+    _retry_deadline.set(time.monotonic() + seconds if seconds else None)
+
+
+def remaining_retry_budget():
+    deadline = _retry_deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+
+class RetryPolicy:
+    """指數退避 + full jitter，且不超過本次上傳剩餘的時間預算。"""
+
+    def __init__(self, max_attempts=5, base_delay=0.5, max_delay=8.0):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * (2 ** attempt)))
+
+    def attempt_timeout(self, timeout):
+        """本次呼叫可用的 timeout；預算已用完時回傳 None。"""
+        remaining = remaining_retry_budget()
+        if remaining is None:
+            return timeout
+        if remaining <= 0:
+            return None
+        return min(timeout, remaining)
+
+    async def sleep_before_retry(self, attempt):
+        """等待下一次重試；剩餘預算不足以等待時回傳 False。"""
+        delay = self.backoff(attempt)
+        remaining = remaining_retry_budget()
+        if remaining is not None and remaining <= delay:
+            return False
+        await asyncio.sleep(delay)
+        return True
@@ -0,0 +1,173 @@
+import numpy as np
+import pandas as pd
+from sklearn.cluster import KMeans
+
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+DEFAULT_WEIGHTS = {
+    'keyword': 5.0,
+    'multi_user': 3.0,
+    'escalation': 2.0,
+    'config_item': 5.0,
+    'role_component': 3.0,
+    'time_cluster': 2.0
+}
+
+# 分級由低到高；固定門檻：impactScore >= 6 低風險、>= 12 中風險、>= 18 高風險
+RISK_LABELS = np.array(['忽略', '低風險', '中風險', '高風險'])
+FIXED_RISK_THRESHOLDS = [6, 12, 18]
+
+KMEANS_MIN_COUNT = 4         # 最少資料筆數
+KMEANS_MIN_RANGE = 5.0       # 分數最大最小值差
+KMEANS_MIN_STDDEV = 3.0      # 標準差下限
+
+# 各列的評分特徵（與權重無關，權重變更時只需重算分數）
+FEATURE_COLUMNS = [
+    'keyword_score', 'user_impact_score', 'escalation_score',
+    'configuration_item_freq', 'role_component_freq', 'time_cluster_score'
+]
+
+
+def _column_counts(df, column):
+    """每列該欄位值在整張表出現的次數；空值或欄位不存在時為 0。"""
+    if column not in df.columns:
+        return np.zeros(len(df))
+    counts = df[column].map(df[column].value_counts())
+    return counts.fillna(0).to_numpy(dtype=float)
+
+
+def compute_feature_frame(df, keyword_flags, user_impact_flags, escalation_flags, time_cluster_scores):
+    """把語意旗標、時間群聚與出現頻率整理成每列一筆的特徵表（index 與 df 相同）。"""
+    config_counts = _column_counts(df, 'Configuration item')
+    config_max = config_counts.max() if len(config_counts) else 0
+    config_freq = config_counts / config_max if config_max > 0 else np.zeros(len(df))
+
+    role_counts = _column_counts(df, 'Role/Component')
+    role_freq = np.select([role_counts >= 5, role_counts >= 3, role_counts == 2], [3, 2, 1], default=0)
+
+    return pd.DataFrame({
+        'keyword_score': np.asarray(keyword_flags, dtype=int),
+        'user_impact_score': np.asarray(user_impact_flags, dtype=int),
+        'escalation_score': np.asarray(escalation_flags, dtype=int),
+        'configuration_item_freq': config_freq,
+        'role_component_freq': role_freq,
+        'time_cluster_score': np.asarray(time_cluster_scores, dtype=int),
+    }, index=df.index)
+
+
+def _round2(values):
+    # 逐值用 Python round(x, 2)，與逐列計算時一致；np.round 是乘 100、rint 再除回去，
+    # 第三位小數為 5 的值可能進位方向不同，門檻 6 / 12 / 18 附近的分級就會跟著變
+    return np.array([round(float(v), 2) for v in values], dtype=float)
+
+
+def compute_scores(features, weights):
+    """整欄計算 severity / frequency / impact（皆取到小數第 2 位，impact 以取整後的兩項計算）。"""
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    severity = _round2(
+        features['keyword_score'] * weights['keyword'] +
+        features['user_impact_score'] * weights['multi_user'] +
+        features['escalation_score'] * weights['escalation']
+    )
+    frequency = _round2(
+        features['configuration_item_freq'] * weights['config_item'] +
+        features['role_component_freq'] * weights['role_component'] +
+        features['time_cluster_score'] * weights['time_cluster']
+    )
+    impact = _round2(np.sqrt(severity ** 2 + frequency ** 2))
+    return pd.DataFrame({'severity': severity, 'frequency': frequency, 'impact': impact}, index=features.index)
+
+
+def kmeans_risk_bins(impact_scores):
+    """
+    分數夠分散時以 KMeans（4 群）分級，回傳相鄰群中心的中點作為分級門檻；
+    一維資料中，依中點切分與「歸到最近的群中心」結果相同。不符合條件時回傳 None。
+    """
+    scores = np.asarray(impact_scores, dtype=float)
+    if len(scores) == 0:
+        return None
+    score_range = scores.max() - scores.min()
+    score_std = scores.std()
+    logger.info("📈 分群判斷指標：count=%d, range=%.2f, stddev=%.2f", len(scores), score_range, score_std)
+    if len(scores) < KMEANS_MIN_COUNT or score_range < KMEANS_MIN_RANGE or score_std < KMEANS_MIN_STDDEV:
+        logger.info("⚠️ 不啟用 KMeans，改用固定門檻分級")
+        return None
+
+    kmeans = KMeans(n_clusters=4, random_state=42)
+    kmeans.fit(scores.reshape(-1, 1))
+    centroids = np.sort(kmeans.cluster_centers_.flatten())
+    logger.info("📌 KMeans 分群中心：%s", centroids[::-1].tolist())
+    return ((centroids[:-1] + centroids[1:]) / 2).tolist()
+
+
+def apply_scores(results, score_table, risk_levels, weights):
+    """把整欄算好的分數寫回每列結果（欄位與 analyze_row_async 產出的相同）。"""
+    weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+    scaled_weights = {k: round(v / 10, 2) for k, v in weights.items()}
+    for r, s, level in zip(results, score_table.to_dict(orient='records'), risk_levels):
+        r['severityScore'] = s['severity']
+        r['frequencyScore'] = s['frequency']
+        r['impactScore'] = s['impact']
+        r['severityScoreNorm'] = round(s['severity'] / 10, 2)
+        r['frequencyScoreNorm'] = round(s['frequency'] / 20, 2)
+        r['impactScoreNorm'] = round(s['impact'] / 30, 2)
+        r['riskLevel'] = level
+        r['weights'] = scaled_weights
+
+
+def assign_risk_levels(impact_scores, bins=None):
+    """以 np.digitize 一次分級；bins 為 None 時使用固定門檻。"""
+    bins = FIXED_RISK_THRESHOLDS if bins is None else bins
+    return RISK_LABELS[np.digitize(np.asarray(impact_scores, dtype=float), bins)].tolist()
+
+
+def get_risk_level(score, bins=None):
+    """單筆分級（純函式，門檻由呼叫端傳入）。"""
+    return assign_risk_levels([score], bins)[0]
+
+
+class ScoringContext:
+    """
+    單次分析（或一次 /rescore）的評分狀態：權重、特徵表與分級門檻。
+    每個請求各自建立，不經過模組層級的全域變數，多執行緒 / 多行程同時分析不會互相影響。
+    """
+
+    def __init__(self, weights=None):
+        self.weights = {**DEFAULT_WEIGHTS, **(weights or {})}
+        self.risk_bins = None        # None：固定門檻；fit_risk_bins 後為 KMeans 門檻
+        self.features = None
+
+    def build_features(self, df, keyword_flags, user_impact_flags, escalation_flags, time_cluster_scores):
+        self.features = compute_feature_frame(df, keyword_flags, user_impact_flags, escalation_flags, time_cluster_scores)
+        return self.features
+
+    def score(self, features=None):
+        return compute_scores(self.features if features is None else features, self.weights)
+
+    def fit_risk_bins(self, impact_scores):
+        self.risk_bins = kmeans_risk_bins(impact_scores)
+        return self.risk_bins
+
+    def risk_levels(self, impact_scores):
+        return assign_risk_levels(impact_scores, self.risk_bins)
+
+    def risk_level(self, score):
+        return get_risk_level(score, self.risk_bins)
+
+
+def rescore_results(results, weights):
+    """
+    以結果中保存的 scoreFeatures 與新權重重算分數與分級（不需重跑語意比對或 LLM）。
+    回傳重算的筆數；沒有 scoreFeatures 的舊結果不會被修改。
+    """
+    rescorable = [r for r in results if isinstance(r.get('scoreFeatures'), dict)]
+    if not rescorable:
+        return 0
+    context = ScoringContext(weights)
+    features = pd.DataFrame([r['scoreFeatures'] for r in rescorable], columns=FEATURE_COLUMNS).fillna(0)
+    score_table = context.score(features)
+    context.fit_risk_bins(score_table['impact'])
+    apply_scores(rescorable, score_table, context.risk_levels(score_table['impact']), context.weights)
+    return len(rescorable)
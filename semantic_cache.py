@@ -0,0 +1,402 @@
+import json
+import os
+import threading
+import time
+import numpy as np
+from collections import OrderedDict
+from log_config import get_logger
+
+logger = get_logger(__name__)
+
+
+class SemanticCache:
+    """
+    語意快取引擎：
+    - hash 字典：完全比對 O(1)
+    - 預先配置的 float32 矩陣（已正規化）：一次矩陣乘法完成 cosine 相似比對，新增時只更新單列
+    - 淘汰策略：lru（最久未用）/ lfu（命中次數最少）/ fifo，並支援每筆 TTL 與總容量（bytes）上限
+    - namespace：每筆快取屬於一個 namespace，相似比對只在同 namespace 內進行
+    - 執行緒安全：查詢 / 新增 / 淘汰都在同一把鎖內（job queue、串流分析與 Flask 請求會同時使用）
+    - on_expire(keys)：因 TTL 過期而移除快取時呼叫（在鎖外），用來寫入持久化的刪除紀錄
+    """
+
+    POLICIES = ("lru", "lfu", "fifo")
+
+    def __init__(self, capacity, dim, policy="lru", ttl_seconds=None, max_bytes=None, on_expire=None):
+        if policy not in self.POLICIES:
+            raise ValueError(f"未知的快取淘汰策略：{policy}")
+        self.capacity = capacity
+        self.dim = dim
+        self.policy = policy
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.on_expire = on_expire
+        self.lock = threading.Lock()
+        self.vectors = np.zeros((capacity, dim), dtype=np.float32)
+        self.occupied = np.zeros(capacity, dtype=bool)
+        self.created = np.zeros(capacity, dtype=np.float64)      # 建立時間（epoch 秒），TTL 用
+        self.last_access = np.zeros(capacity, dtype=np.float64)  # 最近一次命中時間
+        self.hit_counts = np.zeros(capacity, dtype=np.int64)     # 每筆命中次數，LFU 用
+        self.entry_bytes = np.zeros(capacity, dtype=np.int64)
+        self.total_bytes = 0
+        self.entries = [None] * capacity      # slot -> 快取內容（不含 embedding）
+        self.slot_keys = [None] * capacity    # slot -> hash
+        self.slot_namespaces = np.full(capacity, -1, dtype=np.int32)  # slot -> namespace 編號
+        self.namespace_ids = {}               # namespace 字串 -> 編號
+        self.slots = OrderedDict()            # hash -> slot；lru 依最近使用排序、fifo 依插入排序（舊的在前）
+        self.free_slots = list(range(capacity - 1, -1, -1))
+        self.high_water = 0                   # 曾使用過的最大 slot + 1，查詢只需掃到這裡
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        with self.lock:
+            return len(self.slots)
+
+    def __contains__(self, key):
+        with self.lock:
+            return key in self.slots
+
+    @staticmethod
+    def _normalize(vector):
+        vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm > 0 else vector
+
+    def _estimate_bytes(self, entry):
+        text_bytes = sum(len(str(v).encode("utf-8")) for v in entry.values())
+        return text_bytes + self.dim * 4
+
+    def _is_expired(self, slot, now):
+        return self.ttl_seconds is not None and now - self.created[slot] > self.ttl_seconds
+
+    def _touch(self, key, slot, now):
+        self.hit_counts[slot] += 1
+        self.last_access[slot] = now
+        if self.policy == "lru":
+            self.slots.move_to_end(key)
+
+    def _notify_expired(self, keys):
+        if keys and self.on_expire is not None:
+            self.on_expire(keys)
+
+    def record(self, hit):
+        """統計命中 / 未命中（失敗快取由呼叫端判斷後記為未命中）。"""
+        with self.lock:
+            if hit:
+                self.hits += 1
+            else:
+                self.misses += 1
+
+    def stats(self):
+        with self.lock:
+            total = self.hits + self.misses
+            return {
+                "entries": len(self.slots),
+                "bytes": int(self.total_bytes),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / total if total else 0.0,
+            }
+
+    def get(self, key):
+        with self.lock:
+            slot = self.slots.get(key)
+            if slot is None:
+                return None
+            now = time.time()
+            expired = self._is_expired(slot, now)
+            if expired:
+                self._remove(key)
+            else:
+                self._touch(key, slot, now)
+                return self.entries[slot]
+        self._notify_expired([key])
+        return None
+
+    def search(self, query_vec, threshold, namespace=None):
+        """回傳同 namespace 內 (最相近的快取內容, 相似度)；低於門檻或已過期時內容為 None。"""
+        query = self._normalize(query_vec)
+        with self.lock:
+            if not self.slots:
+                return None, 0.0
+            namespace_id = self.namespace_ids.get(namespace, -1)
+            if namespace_id < 0:
+                return None, 0.0
+            now = time.time()
+            hw = self.high_water
+            sims = self.vectors[:hw] @ query
+            valid = self.occupied[:hw] & (self.slot_namespaces[:hw] == namespace_id)
+            if self.ttl_seconds is not None:
+                valid = valid & (now - self.created[:hw] <= self.ttl_seconds)
+            sims[~valid] = -np.inf
+            best = int(np.argmax(sims))
+            score = float(sims[best])
+            if score > threshold:
+                key = self.slot_keys[best]
+                self._touch(key, best, now)
+                return self.entries[best], score
+            return None, score
+
+    def _pick_victim(self):
+        if self.policy == "lfu":
+            # 命中次數最少者；同分時淘汰最久未用的
+            used = np.flatnonzero(self.occupied[:self.high_water])
+            order = np.lexsort((self.last_access[used], self.hit_counts[used]))
+            return self.slot_keys[used[order[0]]]
+        return next(iter(self.slots))
+
+    def _purge_expired(self):
+        if self.ttl_seconds is None or not self.slots:
+            return []
+        now = time.time()
+        hw = self.high_water
+        expired = np.flatnonzero(self.occupied[:hw] & (now - self.created[:hw] > self.ttl_seconds))
+        keys = [self.slot_keys[slot] for slot in expired]
+        for key in keys:
+            self._remove(key)
+        return keys
+
+    def purge_expired(self):
+        """移除所有過期的快取（會呼叫 on_expire），回傳被移除的 hash。"""
+        with self.lock:
+            keys = self._purge_expired()
+        self._notify_expired(keys)
+        return keys
+
+    def remove_where(self, predicate):
+        """移除所有 predicate(快取內容) 為真的快取，回傳被移除的 hash。"""
+        with self.lock:
+            keys = [key for key, slot in self.slots.items() if predicate(self.entries[slot])]
+            for key in keys:
+                self._remove(key)
+        return keys
+
+    def add(self, key, entry, vector, namespace=None, created_at=None):
+        """
+        新增或覆蓋一筆快取；超過筆數或 bytes 上限時依策略淘汰。
+        回傳因容量被淘汰的 hash 清單（過期的由 on_expire 通知）。
+        """
+        vector = self._normalize(vector)
+        size = self._estimate_bytes(entry)
+        evicted = []
+        expired = []
+        with self.lock:
+            if key in self.slots:
+                self._remove(key)
+            else:
+                expired = self._purge_expired()
+            if not self.free_slots:
+                victim = self._pick_victim()
+                self._remove(victim)
+                evicted.append(victim)
+            if self.max_bytes is not None:
+                while self.slots and self.total_bytes + size > self.max_bytes:
+                    victim = self._pick_victim()
+                    self._remove(victim)
+                    evicted.append(victim)
+
+            now = time.time()
+            slot = self.free_slots.pop()
+            self.slots[key] = slot
+            self.entries[slot] = entry
+            self.slot_keys[slot] = key
+            self.slot_namespaces[slot] = self.namespace_ids.setdefault(namespace, len(self.namespace_ids))
+            self.vectors[slot] = vector
+            self.occupied[slot] = True
+            self.created[slot] = created_at if created_at is not None else now
+            self.last_access[slot] = now
+            self.hit_counts[slot] = 0
+            self.entry_bytes[slot] = size
+            self.total_bytes += size
+            self.high_water = max(self.high_water, slot + 1)
+        self._notify_expired(expired)
+        return evicted
+
+    def remove(self, key):
+        with self.lock:
+            return self._remove(key)
+
+    def _remove(self, key):
+        slot = self.slots.pop(key, None)
+        if slot is None:
+            return False
+        self.total_bytes -= int(self.entry_bytes[slot])
+        self.entries[slot] = None
+        self.slot_keys[slot] = None
+        self.slot_namespaces[slot] = -1
+        self.vectors[slot] = 0
+        self.occupied[slot] = False
+        self.hit_counts[slot] = 0
+        self.entry_bytes[slot] = 0
+        self.free_slots.append(slot)
+        return True
+
+    def snapshot(self):
+        """依淘汰順序（最先被淘汰的在前）回傳 [(hash, 快取內容, embedding)] 的複本，供壓縮在背景使用。"""
+        with self.lock:
+            return [(key, dict(self.entries[slot]), self.vectors[slot].copy()) for key, slot in self.slots.items()]
+
+
+class SemanticCacheStore:
+    """
+    語意快取的 append-only 持久化：
+    - log 檔（JSON Lines）：每次新增寫一行 put、淘汰寫一行 del
+    - 向量檔（raw float32）：每筆 embedding 依序附加，log 以 row 編號對應，啟動時以 memmap 讀取
+    寫入成本只跟單筆大小有關；失效紀錄過多時在背景執行緒壓縮重寫。
+    """
+
+    COMPACT_MIN_RECORDS = 500   # log 至少累積這麼多筆才考慮壓縮
+    COMPACT_RATIO = 2.0         # log 筆數超過存活筆數的倍數就壓縮
+
+    def __init__(self, log_path, vector_path, dim):
+        self.log_path = log_path
+        self.vector_path = vector_path
+        self.dim = dim
+        self.row_bytes = dim * 4
+        self.lock = threading.Lock()
+        self.rows = 0             # 向量檔目前的列數
+        self.log_records = 0      # log 目前的行數
+        self.live = 0             # 存活筆數
+        self.compacting = False
+        self.pending = []         # 壓縮期間新寫入的紀錄，換檔前補寫到新檔
+
+    def exists(self):
+        return os.path.exists(self.log_path)
+
+    def load(self):
+        """
+        重播 log，依插入順序回傳存活的 [(hash, 快取內容, embedding)]。
+        上次寫到一半中斷時，先把向量檔截到整數列、log 只留完整且向量存在的紀錄，
+        之後附加的向量與 log 的 row 編號才會對得上。
+        """
+        self.rows = 0
+        if os.path.exists(self.vector_path):
+            size = os.path.getsize(self.vector_path)
+            self.rows = size // self.row_bytes
+            if size % self.row_bytes:
+                logger.warning("⚠️ [Cache] 向量檔結尾有不完整的一列，截斷為 %d 列", self.rows)
+                with open(self.vector_path, "r+b") as vec_f:
+                    vec_f.truncate(self.rows * self.row_bytes)
+        if not self.exists():
+            return []
+        vectors = np.memmap(self.vector_path, dtype=np.float32, mode="r", shape=(self.rows, self.dim)) if self.rows else None
+        live = OrderedDict()
+        kept_lines = []
+        dropped = 0
+        with open(self.log_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    dropped += 1  # 寫到一半的最後一行
+                    continue
+                key = record.get("hash")
+                if record.get("op") == "del":
+                    live.pop(key, None)
+                elif record.get("op") == "put":
+                    if record.get("row", self.rows) >= self.rows:
+                        dropped += 1  # 向量沒寫進去的紀錄，留著會對到之後新寫入的向量
+                        continue
+                    live.pop(key, None)
+                    live[key] = record
+                kept_lines.append(line if line.endswith("\n") else line + "\n")
+        if dropped:
+            logger.warning("⚠️ [Cache] 移除 %d 筆不完整的快取紀錄", dropped)
+            tmp_log = self.log_path + ".tmp"
+            with open(tmp_log, "w", encoding="utf-8") as f:
+                f.writelines(kept_lines)
+            os.replace(tmp_log, self.log_path)
+        self.log_records = len(kept_lines)
+        self.live = len(live)
+        items = []
+        for key, record in live.items():
+            entry = {k: v for k, v in record.items() if k not in ("op", "row")}
+            items.append((key, entry, np.array(vectors[record["row"]])))
+        return items
+
+    def _write_put(self, log_f, vec_f, key, entry, vector, row):
+        vec_f.write(np.asarray(vector, dtype=np.float32).reshape(self.dim).tobytes())
+        log_f.write(json.dumps({"op": "put", "row": row, **entry, "hash": key}, ensure_ascii=False) + "\n")
+
+    def append(self, key, entry, vector):
+        with self.lock:
+            with open(self.vector_path, "ab") as vec_f, open(self.log_path, "a", encoding="utf-8") as log_f:
+                self._write_put(log_f, vec_f, key, entry, vector, self.rows)
+            self.rows += 1
+            self.log_records += 1
+            self.live += 1
+            if self.compacting:
+                self.pending.append(("put", key, entry, np.array(vector, dtype=np.float32)))
+
+    def append_delete(self, key):
+        with self.lock:
+            with open(self.log_path, "a", encoding="utf-8") as log_f:
+                log_f.write(json.dumps({"op": "del", "hash": key}) + "\n")
+            self.log_records += 1
+            self.live = max(self.live - 1, 0)
+            if self.compacting:
+                self.pending.append(("del", key, None, None))
+
+    def needs_compaction(self):
+        return (not self.compacting and self.log_records >= self.COMPACT_MIN_RECORDS
+                and self.log_records > self.live * self.COMPACT_RATIO)
+
+    def compact(self, items):
+        """以存活的 [(hash, 快取內容, embedding)] 快照重寫 log 與向量檔（先寫暫存檔再替換）。"""
+        tmp_log, tmp_vec = self.log_path + ".tmp", self.vector_path + ".tmp"
+        rows = 0
+        with open(tmp_vec, "wb") as vec_f, open(tmp_log, "w", encoding="utf-8") as log_f:
+            for key, entry, vector in items:
+                self._write_put(log_f, vec_f, key, entry, vector, rows)
+                rows += 1
+        # 補寫快照之後才進來的紀錄；檔案關閉後才能替換（Windows 不允許替換開啟中的檔案）
+        with self.lock:
+            records, live = rows, rows
+            with open(tmp_vec, "ab") as vec_f, open(tmp_log, "a", encoding="utf-8") as log_f:
+                for op, key, entry, vector in self.pending:
+                    if op == "put":
+                        self._write_put(log_f, vec_f, key, entry, vector, rows)
+                        rows += 1
+                        live += 1
+                    else:
+                        log_f.write(json.dumps({"op": "del", "hash": key}) + "\n")
+                        live -= 1
+                    records += 1
+            os.replace(tmp_vec, self.vector_path)
+            os.replace(tmp_log, self.log_path)
+            self.rows = rows
+            self.log_records = records
+            self.live = max(live, 0)
+            self.pending = []
+            self.compacting = False
+        logger.info("🧹 [Cache] 快取檔已壓縮，剩 %d 筆紀錄", self.log_records)
+
+    def compact_in_background(self, snapshot):
+        """
+        snapshot 為回傳存活 [(hash, 快取內容, embedding)] 的函式。
+        判斷是否需要壓縮、標記 compacting 與取快照都在同一把鎖內完成，
+        之後的 append / append_delete 一定會進 pending，不會落在快照與 pending 之間而遺失。
+        """
+        with self.lock:
+            if not self.needs_compaction():
+                return False
+            self.compacting = True
+            self.pending = []
+            try:
+                items = snapshot()
+            except Exception:
+                self.compacting = False
+                raise
+
+        def _run():
+            try:
+                self.compact(items)
+            except Exception as e:
+                logger.error("❌ [Cache] 快取壓縮失敗：%s", e)
+                with self.lock:
+                    self.compacting = False
+                    self.pending = []
+
+        threading.Thread(target=_run, daemon=True).start()
+        return True
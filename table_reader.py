@@ -0,0 +1,138 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+READ_CHUNK_ROWS = 5000                  # 每次產出的列數
+SUPPORTED_TABLE_EXTENSIONS = {"xlsx", "csv", "parquet"}
+
+
+def table_extension(filename):
+    return filename.rsplit(".", 1)[1].lower() if "." in filename else ""
+
+
+def _unique_headers(raw_headers):
+    # 與 pd.read_excel 相同：空白標題為 "Unnamed: i"，重複標題加上 .1、.2…
+    headers, seen = [], {}
+    for i, h in enumerate(raw_headers):
+        name = f"Unnamed: {i}" if h is None or str(h).strip() == "" else str(h)
+        if name in seen:
+            seen[name] += 1
+            name = f"{name}.{seen[name]}"
+        else:
+            seen[name] = 0
+        headers.append(name)
+    return headers
+
+
+def _cell_value(value):
+    # 與 pandas 的 openpyxl 讀取器一致：整數值的浮點數轉回 int
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    return value
+
+
+def _to_frame(rows, headers, columns):
+    df = pd.DataFrame(rows, columns=headers)
+    if columns is not None:
+        df = df[[c for c in columns if c in df.columns]]
+    df = df.infer_objects()
+    # 與 pd.read_excel 相同：只有數字 / 布林值（含空白格）的欄位轉成數值欄，整數欄有空白時為 float64（str() 得 "5.0"）
+    for col in df.columns[df.dtypes == object]:
+        values = df[col]
+        if all(isinstance(v, (int, float, np.number)) for v in values.dropna()):
+            df[col] = values.astype("float64") if values.isna().any() else values.astype("int64")
+    # None → NaN，讓 pd.notna / str() 的行為與 pd.read_excel 相同
+    return df.replace({None: np.nan})
+
+
+def _iter_xlsx_chunks(source, chunk_rows, columns):
+    from openpyxl import load_workbook
+
+    # read_only 模式逐列解析 XML，不會把整本活頁簿載入記憶體
+    wb = load_workbook(source, read_only=True, data_only=True)
+    try:
+        rows_iter = wb.worksheets[0].iter_rows(values_only=True)  # 與 pd.read_excel 預設相同：第一張工作表
+        header_row = next(rows_iter, None)
+        if header_row is None:
+            return
+        width = len(header_row)
+        headers = _unique_headers(header_row)
+        rows = []
+        for values in rows_iter:
+            if all(v is None for v in values):
+                continue  # 略過空白列
+            values = [_cell_value(v) for v in values[:width]]
+            rows.append(values + [None] * (width - len(values)))
+            if len(rows) >= chunk_rows:
+                yield _to_frame(rows, headers, columns)
+                rows = []
+        if rows:
+            yield _to_frame(rows, headers, columns)
+    finally:
+        wb.close()
+
+
+def _iter_csv_chunks(source, chunk_rows, columns):
+    usecols = (lambda c: c in columns) if columns is not None else None
+    for chunk in pd.read_csv(source, chunksize=chunk_rows, usecols=usecols, encoding="utf-8-sig"):
+        yield chunk
+
+
+def _iter_parquet_chunks(source, chunk_rows, columns):
+    try:
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise ImportError("讀取 .parquet 需要安裝 pyarrow（pip install pyarrow）")
+
+    parquet_file = pq.ParquetFile(source)
+    if columns is not None:
+        columns = [c for c in columns if c in parquet_file.schema_arrow.names]
+    for batch in parquet_file.iter_batches(batch_size=chunk_rows, columns=columns):
+        yield batch.to_pandas()
+
+
+_CHUNK_READERS = {
+    "xlsx": _iter_xlsx_chunks,
+    "csv": _iter_csv_chunks,
+    "parquet": _iter_parquet_chunks,
+}
+
+
+def iter_table_chunks(source, filename=None, chunk_rows=READ_CHUNK_ROWS, columns=None):
+    """
+    逐塊讀取 .xlsx / .csv / .parquet，每次產出最多 chunk_rows 列的 DataFrame。
+    source 可為路徑或檔案物件（檔案物件需另外提供 filename 判斷格式）；columns 指定時只保留這些欄位。
+    """
+    ext = table_extension(filename or str(source))
+    reader = _CHUNK_READERS.get(ext)
+    if reader is None:
+        raise ValueError(f"不支援的檔案格式：.{ext}")
+    return reader(source, chunk_rows, columns)
+
+
+def read_table(source, filename=None, columns=None):
+    """讀取整張表；取代 pd.read_excel，但以串流方式解析，避免 openpyxl 完整載入。"""
+    chunks = list(iter_table_chunks(source, filename, columns=columns))
+    if not chunks:
+        return pd.DataFrame()
+    return pd.concat(chunks, ignore_index=True)
+
+
+def preview_table(source, filename=None, limit=50):
+    """只讀到前 limit 列就停止，回傳 (欄位名稱, 前 limit 列 DataFrame)。"""
+    chunks = iter_table_chunks(source, filename, chunk_rows=limit)
+    first = next(chunks, None)
+    if first is None:
+        return [], pd.DataFrame()
+    chunks.close()
+    return first.columns.tolist(), first.head(limit)
+
+
+def original_upload_path(upload_dir, timestamp):
+    """找出某次上傳的原始檔（副檔名可能是 .xlsx / .csv / .parquet）；找不到時回傳 None。"""
+    for ext in ("xlsx", "csv", "parquet"):
+        path = os.path.join(upload_dir, f"original_{timestamp}.{ext}")
+        if os.path.exists(path):
+            return path
+    return None